@@ -0,0 +1,100 @@
+import sys
+import json
+import argparse
+import lib.benchmark as benchmark
+
+
+parser = argparse.ArgumentParser('CG-ODE benchmarks (CPU)')
+subparsers = parser.add_subparsers(dest='command')
+
+parser_run = subparsers.add_parser('run', help="time the benchmark cases over a grid of configurations")
+parser_run.add_argument('--output', type=str, default='benchmark.json', help="JSON result file")
+parser_run.add_argument('--num_atoms', type=str, default='10,50', help="comma separated numbers of nodes N")
+parser_run.add_argument('--batch_size', type=str, default='8', help="comma separated batch sizes K")
+parser_run.add_argument('--condition_length', type=str, default='21', help="comma separated encoder lengths T1")
+parser_run.add_argument('--ode_dims', type=str, default='20', help="comma separated latent dimensions")
+parser_run.add_argument('--cases', type=str, default=','.join(benchmark.CASES), help="comma separated cases")
+parser_run.add_argument('--repeat', type=int, default=10, help="measured iterations per case")
+parser_run.add_argument('--warmup', type=int, default=2, help="unmeasured iterations per case")
+parser_run.add_argument('--threads', type=int, default=1, help="torch CPU threads")
+parser_run.add_argument('--compile', action='store_true', help="torch.compile the ODE function before timing")
+
+parser_precision = subparsers.add_parser('precision', help="float32 vs bfloat16 autocast: speed and accuracy of the ODE solve and training step")
+parser_precision.add_argument('--output', type=str, default='precision.json', help="JSON result file")
+parser_precision.add_argument('--formats', type=str, default='covid,social', help="comma separated synthetic dataset formats")
+parser_precision.add_argument('--num_atoms', type=str, default='10,50', help="comma separated numbers of nodes N")
+parser_precision.add_argument('--batch_size', type=str, default='8', help="comma separated batch sizes K")
+parser_precision.add_argument('--condition_length', type=str, default='21', help="comma separated encoder lengths T1")
+parser_precision.add_argument('--ode_dims', type=str, default='20', help="comma separated latent dimensions")
+parser_precision.add_argument('--repeat', type=int, default=10, help="measured iterations per case")
+parser_precision.add_argument('--warmup', type=int, default=2, help="unmeasured iterations per case")
+parser_precision.add_argument('--threads', type=int, default=1, help="torch CPU threads")
+
+parser_workspace = subparsers.add_parser('workspace', help="allocations and time of no-grad fixed-step solves, odeint vs preallocated workspace")
+parser_workspace.add_argument('--output', type=str, default='workspace.json', help="JSON result file")
+parser_workspace.add_argument('--methods', type=str, default='rk4', help="comma separated fixed-step solvers (euler, midpoint, rk4)")
+parser_workspace.add_argument('--num_atoms', type=str, default='10,50', help="comma separated numbers of nodes N")
+parser_workspace.add_argument('--batch_size', type=str, default='8', help="comma separated batch sizes K")
+parser_workspace.add_argument('--condition_length', type=str, default='21', help="comma separated encoder lengths T1")
+parser_workspace.add_argument('--ode_dims', type=str, default='20', help="comma separated latent dimensions")
+parser_workspace.add_argument('--repeat', type=int, default=10, help="measured iterations per case")
+parser_workspace.add_argument('--warmup', type=int, default=2, help="unmeasured iterations per case")
+parser_workspace.add_argument('--threads', type=int, default=1, help="torch CPU threads")
+
+parser_compare = subparsers.add_parser('compare', help="flag regressions of a result file against a baseline")
+parser_compare.add_argument('baseline', type=str, help="baseline JSON result file")
+parser_compare.add_argument('current', type=str, help="JSON result file to check")
+parser_compare.add_argument('--threshold', type=float, default=0.1, help="relative slowdown reported as a regression")
+args = parser.parse_args()
+
+
+def int_list(value):
+    return [int(v) for v in value.split(",")]
+
+
+if __name__ == '__main__':
+    if args.command == "run":
+        grid = {"num_atoms": int_list(args.num_atoms), "batch_size": int_list(args.batch_size),
+                "condition_length": int_list(args.condition_length), "ode_dims": int_list(args.ode_dims)}
+        results = benchmark.run(grid, cases=args.cases.split(","), repeat=args.repeat, warmup=args.warmup,
+                                num_threads=args.threads, compile=args.compile)
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print("Results written to " + args.output)
+
+    elif args.command == "precision":
+        grid = {"num_atoms": int_list(args.num_atoms), "batch_size": int_list(args.batch_size),
+                "condition_length": int_list(args.condition_length), "ode_dims": int_list(args.ode_dims)}
+        results = benchmark.run_precision(grid, formats=args.formats.split(","), repeat=args.repeat, warmup=args.warmup,
+                                          num_threads=args.threads)
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print("Results written to " + args.output)
+
+    elif args.command == "workspace":
+        grid = {"num_atoms": int_list(args.num_atoms), "batch_size": int_list(args.batch_size),
+                "condition_length": int_list(args.condition_length), "ode_dims": int_list(args.ode_dims)}
+        results = benchmark.run_workspace(grid, methods=args.methods.split(","), repeat=args.repeat, warmup=args.warmup,
+                                          num_threads=args.threads)
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print("Results written to " + args.output)
+
+    elif args.command == "compare":
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        for key in ["torch", "num_threads", "processor", "cpu_count", "compile"]:
+            if baseline["environment"].get(key) != current["environment"].get(key):
+                print("Warning: %s differs (%s vs %s)" % (key, baseline["environment"].get(key), current["environment"].get(key)))
+
+        rows, regressions = benchmark.compare(baseline, current, threshold=args.threshold)
+        for key, old, new, ratio, flag in rows:
+            print("%-95s %12s %12s %8s  %s" % (key, "-" if old is None else "%.6f" % old, "%.6f" % new,
+                                               "-" if ratio is None else "%.2fx" % ratio, flag))
+        print("%d regression(s) above %.0f%%" % (len(regressions), args.threshold * 100))
+        sys.exit(1 if len(regressions) > 0 else 0)
+
+    else:
+        parser.print_help()
@@ -0,0 +1,37 @@
+import time
+import argparse
+import torch
+from lib.forecast import write_table
+from lib.ensemble import EnsembleForecaster, expand_checkpoints
+
+
+parser = argparse.ArgumentParser('CG-ODE ensemble forecasts of several covid checkpoints')
+parser.add_argument('--load', type=str, required=True, help="comma separated checkpoint paths or glob patterns, e.g. 'experiments/*_epoch_*_mape_*.ckpt'")
+parser.add_argument('--start_dates', type=str, required=True, help="comma separated first forecast days, YYYY-MM-DD")
+parser.add_argument('--pred_length', type=int, default=None, help="forecast days, defaults to the first checkpoint's pred_length")
+parser.add_argument('--datapath', type=str, default=None, help="defaults to the first checkpoint's datapath")
+parser.add_argument('--dataset', type=str, default=None, help="defaults to the first checkpoint's dataset")
+parser.add_argument('--workers', type=int, default=0, help="worker processes running the members in parallel (CPU), 0 runs them in this process")
+parser.add_argument('--threads', type=int, default=1, help="torch CPU threads per worker process")
+parser.add_argument('--output', type=str, default='ensemble_forecast.csv', help=".csv or .parquet output file, ensemble mean plus one column per member")
+parser.add_argument('-r', '--random-seed', type=int, default=0, help="z0 sampling seed of the first member, member i uses seed + i")
+args = parser.parse_args()
+
+
+if __name__ == '__main__':
+    ckpt_paths = expand_checkpoints([p.strip() for p in args.load.split(",") if p.strip() != ""])
+    start_dates = [d.strip() for d in args.start_dates.split(",") if d.strip() != ""]
+    device = torch.device("cuda:0" if torch.cuda.is_available() and args.workers == 0 else "cpu")
+    ensemble = EnsembleForecaster(ckpt_paths, device, datapath=args.datapath, dataset=args.dataset, seed=args.random_seed,
+                                  workers=args.workers, threads=args.threads)
+    try:
+        start = time.perf_counter()
+        df = ensemble.forecast(start_dates, pred_length=args.pred_length)
+        seconds = time.perf_counter() - start
+    finally:
+        ensemble.close()
+    write_table(df, args.output)
+    for i, path in enumerate(ckpt_paths):
+        print("member_%d: %s" % (i, path))
+    print("%d forecasts (%d start dates x %d states, %d members) in %.2f s written to %s" % (
+        len(df), len(start_dates), ensemble.reference.num_states, len(ckpt_paths), seconds, args.output))
@@ -0,0 +1,39 @@
+import sys
+import json
+import argparse
+import torch
+from lib.forecast import Forecaster
+from lib.export import export_model, load_exported, parity_check
+import lib.utils as utils
+
+
+parser = argparse.ArgumentParser('CG-ODE TorchScript export of a trained covid checkpoint')
+parser.add_argument('--load', type=str, required=True, help="checkpoint path")
+parser.add_argument('--output', type=str, default='cgode_scripted.pt', help="TorchScript file")
+parser.add_argument('--datapath', type=str, default=None, help="defaults to the checkpoint's datapath")
+parser.add_argument('--dataset', type=str, default=None, help="defaults to the checkpoint's dataset")
+parser.add_argument('--check_dates', type=str, default=None, help="comma separated start dates of the parity check, the last 3 available start dates by default")
+parser.add_argument('--no_check', action='store_true', help="skip the parity check against the eager model (no dataset needed)")
+parser.add_argument('--tolerance', type=float, default=1e-4, help="maximum absolute difference of the normalized outputs")
+args = parser.parse_args()
+
+
+if __name__ == '__main__':
+    forecaster = Forecaster(args.load, torch.device("cpu"), datapath=args.datapath, dataset=args.dataset)
+    forecaster.model.set_bf16(False)  # the exported module runs in float32, compare against float32
+    export_model(forecaster.model, forecaster.args, args.output, forecaster.transform.state_dict())
+    print("TorchScript module written to " + args.output)
+    if args.no_check:
+        sys.exit(0)
+
+    if args.check_dates is not None:
+        check_dates = args.check_dates.split(",")
+    else:
+        check_dates = [utils.transfer_date(forecaster.num_days - i) for i in [14, 7, 0]]
+    module, _, _ = load_exported(args.output)
+    result = parity_check(forecaster, module, check_dates)
+    print(json.dumps(result, indent=2))
+    if result["max_abs_diff"] > args.tolerance:
+        print("Parity check FAILED: max abs diff %.3g above %.3g" % (result["max_abs_diff"], args.tolerance))
+        sys.exit(1)
+    print("Parity check passed")
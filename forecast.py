@@ -0,0 +1,42 @@
+import argparse
+import torch
+from lib.forecast import Forecaster, write_table
+from lib.forecast_cache import ForecastCache
+
+
+parser = argparse.ArgumentParser('CG-ODE batch forecasting from a trained covid checkpoint')
+parser.add_argument('--load', type=str, required=True, help="checkpoint path")
+parser.add_argument('--start_dates', type=str, default=None, help="comma separated first forecast days, YYYY-MM-DD")
+parser.add_argument('--start_dates_file', type=str, default=None, help="file with one start date per line")
+parser.add_argument('--pred_length', type=int, default=None, help="forecast days, defaults to the checkpoint's pred_length")
+parser.add_argument('--datapath', type=str, default=None, help="defaults to the checkpoint's datapath")
+parser.add_argument('--dataset', type=str, default=None, help="defaults to the checkpoint's dataset")
+parser.add_argument('--batch_size', type=int, default=None, help="start dates per model call, all by default")
+parser.add_argument('--output', type=str, default='forecast.csv', help=".csv or .parquet output file")
+parser.add_argument('--num_samples', type=int, default=1, help="z0 draws per state, solved in one batch; above 1 the output has the sample mean and quantile columns")
+parser.add_argument('--quantiles', type=str, default='0.05,0.25,0.5,0.75,0.95', help="comma separated quantiles written with --num_samples")
+parser.add_argument('--quantize', action='store_true', help="dynamic int8 quantization of the linear layers (CPU)")
+parser.add_argument('--cache_dir', type=str, default=None, help="on-disk forecast cache shared between runs, keyed by checkpoint and preprocessed window")
+parser.add_argument('-r', '--random-seed', type=int, default=None, help="z0 sampling seed, defaults to the checkpoint's")
+args = parser.parse_args()
+
+
+if __name__ == '__main__':
+    start_dates = []
+    if args.start_dates is not None:
+        start_dates += [d.strip() for d in args.start_dates.split(",") if d.strip() != ""]
+    if args.start_dates_file is not None:
+        with open(args.start_dates_file) as f:
+            start_dates += [line.strip() for line in f if line.strip() != ""]
+    if len(start_dates) == 0:
+        parser.error("no start dates given, use --start_dates or --start_dates_file")
+
+    device = torch.device("cuda:0" if torch.cuda.is_available() and not args.quantize else "cpu")
+    cache = ForecastCache(directory=args.cache_dir) if args.cache_dir is not None else None
+    forecaster = Forecaster(args.load, device, datapath=args.datapath, dataset=args.dataset, seed=args.random_seed,
+                            quantize=args.quantize, cache=cache)
+    quantiles = [float(q) for q in args.quantiles.split(",")]
+    df = forecaster.forecast(start_dates, pred_length=args.pred_length, batch_size=args.batch_size,
+                             num_samples=args.num_samples, quantiles=quantiles)
+    write_table(df, args.output)
+    print("%d forecasts (%d start dates x %d states) written to %s" % (len(df), len(start_dates), forecaster.num_states, args.output))
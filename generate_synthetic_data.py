@@ -0,0 +1,28 @@
+import argparse
+import numpy as np
+from lib.synthetic_data import write_covid_dataset, write_social_dataset
+
+
+parser = argparse.ArgumentParser('Synthetic datasets for scaling benchmarks')
+parser.add_argument('--format', type=str, default='covid', choices=['covid', 'social'], help="covid (run_models_covid.py) or social (run_models_social.py) layout")
+parser.add_argument('--datapath', type=str, default='data_synthetic/', help="output data path, pass it as --datapath to the run_models scripts")
+parser.add_argument('--dataset', type=str, default=None, help="dataset directory name, Dec for covid and social for social by default")
+parser.add_argument('--num_nodes', type=int, default=50, help="number of states (covid) or agents (social)")
+parser.add_argument('--num_days', type=int, default=233, help="covid: days in train.npy. social: number of time steps")
+parser.add_argument('--num_test_days', type=int, default=31, help="covid: days in test.npy")
+parser.add_argument('--density', type=float, default=0.3, help="covid: fraction of non-zero off-diagonal mobility flows")
+parser.add_argument('--float32_graphs', action='store_true', help="covid: store mobility graphs as float32 (half the size)")
+parser.add_argument('--random_seed', type=int, default=0, help="random_seed")
+args = parser.parse_args()
+
+
+if __name__ == '__main__':
+    if args.format == "covid":
+        path = write_covid_dataset(args.datapath, dataset=args.dataset or "Dec", num_states=args.num_nodes,
+                                   num_train_days=args.num_days, num_test_days=args.num_test_days,
+                                   density=args.density, seed=args.random_seed,
+                                   dtype=np.float32 if args.float32_graphs else np.float64)
+    else:
+        path = write_social_dataset(args.datapath, dataset=args.dataset or "social", num_nodes=args.num_nodes,
+                                    num_steps=args.num_days, seed=args.random_seed)
+    print("Synthetic dataset written to " + path)
@@ -0,0 +1,122 @@
+import importlib
+import traceback
+import queue
+import torch
+import torch.multiprocessing as mp
+from torch.distributions.normal import Normal
+from lib.create_coupled_ode_model import create_CoupledODE_model
+import lib.utils as utils
+
+
+def eval_worker(args, input_dim, loader_module, num_threads, jobs, results):
+    '''
+    Test evaluation process. Loads and preprocesses the test windows once, then evaluates
+    every weight snapshot received on jobs until it gets None.
+    '''
+    try:
+        torch.set_num_threads(num_threads)
+        torch.manual_seed(args.random_seed)
+        device = torch.device("cpu")
+
+        z0_prior = Normal(torch.Tensor([0.0]).to(device), torch.Tensor([1.]).to(device))
+        obsrv_std = torch.Tensor([0.01]).to(device)
+        model = create_CoupledODE_model(args, input_dim, z0_prior, obsrv_std, device)
+
+        dataloader = importlib.import_module(loader_module).ParseData(args = args)
+        encoder, decoder, graph, num_batch = dataloader.load_test_data(pred_length = args.pred_length,
+                                                                       condition_length = args.condition_length)
+        results.put(("ready", None, None))
+    except Exception:
+        results.put(("error", None, traceback.format_exc()))
+        return
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        epoch, state_dict, kl_coef = job
+        try:
+            model.load_state_dict(state_dict)
+            total, MAPE_each, RMSE_each = utils.evaluate_test_batches(model, encoder, decoder, graph, num_batch, device,
+                                                                      args, kl_coef, metrics_only = True)
+            results.put(("result", epoch, (total, utils.print_MAPE(MAPE_each), utils.print_MAPE(RMSE_each))))
+        except Exception:
+            results.put(("error", epoch, traceback.format_exc()))
+
+
+class AsyncEvaluator(object):
+    '''
+    Runs test evaluation in a separate process while training continues.
+    submit() sends a CPU snapshot of the weights; poll() returns the finished results in
+    submission order, each with the payload that was passed to submit().
+    '''
+
+    def __init__(self, args, input_dim, loader_module, num_threads = 1, max_pending = 2):
+        '''
+
+        :param loader_module: module providing ParseData, e.g. "lib.load_data_covid".
+        :param max_pending: submit() blocks while this many evaluations are in flight.
+        '''
+        ctx = mp.get_context("spawn")
+        self.jobs = ctx.Queue()
+        self.results = ctx.Queue()
+        self.max_pending = max_pending
+        self.pending = {}  # epoch -> payload
+        self.process = ctx.Process(target = eval_worker,
+                                   args = (args, input_dim, loader_module, num_threads, self.jobs, self.results),
+                                   daemon = True)
+        self.process.start()
+        self.ready = False
+
+    def submit(self, epoch, state_dict, kl_coef, payload = None):
+        '''
+        Queue weights for evaluation.
+        :param state_dict: CPU snapshot of the weights (see checkpoint.clone_to_cpu), not modified afterwards.
+        :return: results that finished while waiting for a free slot.
+        '''
+        finished = []
+        while len(self.pending) >= self.max_pending:
+            finished += self._get(block = True)
+        self.pending[epoch] = payload
+        self.jobs.put((epoch, state_dict, kl_coef))
+        return finished
+
+    def poll(self):
+        '''
+        :return: list of (epoch, (total, MAPE_each, RMSE_each), payload) finished so far, without blocking.
+        '''
+        return self._get(block = False)
+
+    def drain(self):
+        '''
+        Wait for every submitted evaluation.
+        '''
+        finished = []
+        while len(self.pending) > 0:
+            finished += self._get(block = True)
+        return finished
+
+    def close(self):
+        if self.process.is_alive():
+            self.jobs.put(None)
+            self.process.join()
+
+    def _get(self, block):
+        finished = []
+        while True:
+            try:
+                kind, epoch, value = self.results.get(block = block, timeout = 5 if block else None)
+            except queue.Empty:
+                if block and not self.process.is_alive():
+                    raise Exception("Test evaluation process died.")
+                if block:
+                    continue
+                return finished
+            if kind == "error":
+                raise Exception("Test evaluation failed:\n" + value)
+            elif kind == "ready":
+                self.ready = True
+                continue
+            finished.append((epoch, value, self.pending.pop(epoch)))
+            if block:
+                return finished
@@ -4,6 +4,7 @@ from torch.distributions import kl_divergence
 import torch.nn as nn
 import torch
 import lib.utils as utils
+import lib.instrumentation as instrumentation
 import numpy as np
 
 
@@ -44,16 +45,18 @@ class VAE_Baseline(nn.Module):
 
 		#Transfer from inc to cum
 
-		truth = utils.inc_to_cum(truth)
-		pred_y = utils.inc_to_cum(pred_y)
 		num_times = truth.shape[1]
 		time_index = [num_times-1] # last timestamp
 
 		if istest:
-			truth = truth[:,time_index,:]
-			pred_y = pred_y[:,time_index,:]   #[N,1,D]
+			# Only the last cumulative value is evaluated: sum of all increments.
+			truth = torch.sum(truth,dim=1,keepdim=True)
+			pred_y = torch.sum(pred_y,dim=1,keepdim=True)   #[N,1,D]
 			if truth_gt != None:
 				truth_gt = truth_gt[:,time_index,:]
+		else:
+			truth = utils.inc_to_cum(truth)
+			pred_y = utils.inc_to_cum(pred_y)
 
 		# Compute likelihood of the data under the predictions
 		log_density_data = compute_loss(pred_y, truth, truth_gt,mask = mask,method=method)
@@ -90,7 +93,7 @@ class VAE_Baseline(nn.Module):
 
 		print(np.sum(pred_node))
 
-	def compute_all_losses(self, batch_dict_encoder,batch_dict_decoder,batch_dict_graph ,num_atoms,edge_lamda, kl_coef = 1.,istest=False):
+	def compute_all_losses(self, batch_dict_encoder,batch_dict_decoder,batch_dict_graph ,num_atoms,edge_lamda, kl_coef = 1.,istest=False,metrics_only=False):
 		'''
 
 		:param batch_dict_encoder:
@@ -98,26 +101,21 @@ class VAE_Baseline(nn.Module):
 		:param batch_dict_graph: #[K,T2,N,N], ground_truth graph with log normalization
 		:param num_atoms:
 		:param kl_coef:
+		:param metrics_only: only MAPE/MSE are needed. Skips the edge decoder and the likelihood terms.
 		:return:
 		'''
 
-		pred_node,pred_edge, info,temporal_weights= self.get_reconstruction(batch_dict_encoder,batch_dict_decoder,num_atoms = num_atoms)
-		# pred_node [ K*N , time_length, d]
-		# pred_edge [ K*N*N, time_length, d]
-
-		if istest:
-			mask_index = batch_dict_decoder["masks"]
-			pred_node = pred_node[:,mask_index,:]
-			pred_edge = pred_edge[:,mask_index,:]
-
+		# Edge predictions are only read by the edge likelihood.
+		decode_edge = (not metrics_only) and edge_lamda != 0
 
+		# At test time only the masked timestamps are decoded.
+		mask_index = batch_dict_decoder["masks"] if istest else None
 
-		# Reshape batch_dict_graph
-		k = batch_dict_graph.shape[0]
-		T2 = batch_dict_graph.shape[1]
-		truth_graph = torch.reshape(batch_dict_graph,(k,T2,-1)) # [K,T,N*N]
-		truth_graph = torch.unsqueeze(truth_graph.permute(0,2,1),dim=3) #[K,N*N,T,1]
-		truth_graph = torch.reshape(truth_graph,(-1,T2,1)) #[K*N*N,T,1]
+		pred_node,pred_edge, info,temporal_weights= self.get_reconstruction(batch_dict_encoder,batch_dict_decoder,num_atoms = num_atoms,
+																		   time_index = mask_index,decode_edge = decode_edge)
+		# pred_node [ K*N , time_length, d]
+		# pred_edge [ K*N*N, time_length, d], None if not decoded
+		loss_start = instrumentation.start("loss")
 
 		# print("get_reconstruction done -- computing likelihood")
 
@@ -156,16 +154,36 @@ class VAE_Baseline(nn.Module):
 		kldiv_z0 = torch.mean(kldiv_z0)  # Contains infinity.
 
 
-		# Compute likelihood of all the points
-		rec_likelihood_node = self.get_gaussian_likelihood(
-			batch_dict_decoder["data"], pred_node,temporal_weights,
-			mask=None)   #negative value
+		results = {}
+
+		if not metrics_only:
+			# Compute likelihood of all the points
+			rec_likelihood_node = self.get_gaussian_likelihood(
+				batch_dict_decoder["data"], pred_node,temporal_weights,
+				mask=None)   #negative value
+
+			if decode_edge:
+				# Reshape batch_dict_graph
+				k = batch_dict_graph.shape[0]
+				T2 = batch_dict_graph.shape[1]
+				truth_graph = torch.reshape(batch_dict_graph,(k,T2,-1)) # [K,T,N*N]
+				truth_graph = torch.unsqueeze(truth_graph.permute(0,2,1),dim=3) #[K,N*N,T,1]
+				truth_graph = torch.reshape(truth_graph,(-1,T2,1)) #[K*N*N,T,1]
 
-		rec_likelihood_edge = self.get_gaussian_likelihood(
-			truth_graph, pred_edge, temporal_weights,
-			mask=None)  # negative value
+				rec_likelihood_edge = self.get_gaussian_likelihood(
+					truth_graph, pred_edge, temporal_weights,
+					mask=None)  # negative value
 
-		rec_likelihood = (1-edge_lamda)*rec_likelihood_node + edge_lamda * rec_likelihood_edge
+				rec_likelihood = (1-edge_lamda)*rec_likelihood_node + edge_lamda * rec_likelihood_edge
+			else:
+				rec_likelihood = rec_likelihood_node
+
+			# loss (NaN fallback selected on device, avoiding a host sync)
+			loss = - torch.logsumexp(rec_likelihood - kl_coef * kldiv_z0,0)
+			loss = torch.where(torch.isnan(loss), - torch.mean(rec_likelihood - kl_coef * kldiv_z0,0), loss)
+
+			results["loss"] = torch.mean(loss)
+			results["likelihood"] = torch.mean(rec_likelihood).detach()
 
 
 		mape_node = self.get_loss(
@@ -179,21 +197,12 @@ class VAE_Baseline(nn.Module):
 
 
 
-		# loss
-
-		loss = - torch.logsumexp(rec_likelihood - kl_coef * kldiv_z0,0)
-		if torch.isnan(loss):
-			loss = - torch.mean(rec_likelihood - kl_coef * kldiv_z0,0)
-
-
-
-		results = {}
-		results["loss"] = torch.mean(loss)
-		results["likelihood"] = torch.mean(rec_likelihood).data.item()
-		results["MAPE"] = torch.mean(mape_node).data.item()
-		results["MSE"] = torch.mean(mse_node).data.item()
-		results["kl_first_p"] =  kldiv_z0.detach().data.item()
-		results["std_first_p"] = torch.mean(fp_std).detach().data.item()
+		# Metrics stay on device as 0-dim tensors; see utils.MetricsAccumulator.
+		results["MAPE"] = torch.mean(mape_node).detach()
+		results["MSE"] = torch.mean(mse_node).detach()
+		results["kl_first_p"] =  kldiv_z0.detach()
+		results["std_first_p"] = torch.mean(fp_std).detach()
+		instrumentation.stop("loss", loss_start)
 
 		# if istest:
 		# 	print("Predicted Inc Deaths are:")
@@ -0,0 +1,451 @@
+'''
+CPU micro-benchmarks of the CG-ODE pipeline on synthetic covid datasets (lib.synthetic_data).
+
+Cases: preprocessing (ParseData.transfer_one_graph / transfer_data), the GNN encoder, Edge_NRI,
+Node_GCN, compute_edge_initials, one DiffeqSolver solve and one training step
+(compute_all_losses + backward). Forward-only cases run under torch.no_grad().
+
+compare_precision times the ODE solve and the training step with and without bfloat16 autocast
+and measures the deviation of the bf16 solution, losses and gradients from float32, on synthetic
+covid or social datasets.
+
+compare_workspace counts the tensor allocations of a no-grad fixed-step solve through torchdiffeq
+and through the preallocated workspace of lib.workspace_solver, with timings and the difference.
+'''
+import os
+import sys
+import time
+import json
+import socket
+import shutil
+import tempfile
+import platform
+import itertools
+import subprocess
+import argparse
+import numpy as np
+import torch
+from torch.distributions.normal import Normal
+from lib.load_data_covid import ParseData
+import lib.load_data_social as load_data_social
+from lib.create_coupled_ode_model import create_CoupledODE_model
+from lib.diffeq_solver import compute_edge_initials
+from lib.synthetic_data import write_covid_dataset, write_social_dataset
+from lib.memory import AllocationCounter
+import lib.utils as utils
+
+
+CASES = ["transfer_one_graph", "transfer_data", "encoder", "Edge_NRI", "Node_GCN", "compute_edge_initials",
+         "ode_solve", "train_step"]
+PRECISION_CASES = ["ode_solve", "train_step"]
+
+
+def default_args(**overrides):
+    '''
+    Model / data arguments with the defaults of run_models_covid.py.
+    '''
+    args = argparse.Namespace(dataset = "Dec", datapath = "data/", pred_length = 14, condition_length = 21,
+                              features = "Confirmed,Deaths,Recovered,Mortality_Rate,Testing_Rate,Population,Mobility",
+                              split_interval = 3, feature_out = "Deaths", batch_size = 8, random_seed = 1991,
+                              dropout = 0.2, edge_lamda = 0.5, z0_encoder = "GTrans", rec_dims = 64, ode_dims = 20,
+                              rec_layers = 1, gen_layers = 1, augment_dim = 0, solver = "rk4",
+                              output_dim = 1, feature_out_index = [1], rank = 0, world_size = 1)
+    for key, value in overrides.items():
+        setattr(args, key, value)
+    return args
+
+
+def default_social_args(**overrides):
+    '''
+    Model / data arguments with the defaults of run_models_social.py.
+    '''
+    args = argparse.Namespace(dataset = "social", datapath = "data/", pred_length = 10, condition_length = 20,
+                              training_end_time = 320, add_popularity = True, features_inc = True, split_interval = 5,
+                              batch_size = 8, random_seed = 1991, dropout = 0.2, edge_lamda = 0.5, z0_encoder = "GTrans",
+                              rec_dims = 64, ode_dims = 30, rec_layers = 1, gen_layers = 1, augment_dim = 0,
+                              solver = "euler", output_dim = 2, feature_out_index = [0, 1], rank = 0, world_size = 1)
+    for key, value in overrides.items():
+        setattr(args, key, value)
+    return args
+
+
+def environment():
+    '''
+    Metadata stored with every result file.
+    '''
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], stderr = subprocess.DEVNULL,
+                                         cwd = os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (subprocess.CalledProcessError, OSError):
+        commit = None
+    return {
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "host": socket.gethostname(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "num_threads": torch.get_num_threads(),
+        "python": sys.version.split()[0],
+        "torch": torch.__version__,
+        "numpy": np.__version__,
+        "git_commit": commit,
+    }
+
+
+def time_function(fn, repeat = 10, warmup = 2, min_time = 0.):
+    '''
+    :param min_time: keep repeating until this many seconds were measured.
+    :return: dict of timing statistics in seconds
+    '''
+    for _ in range(warmup):
+        fn()
+    times = []
+    while len(times) < repeat or sum(times) < min_time:
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    times = np.asarray(times)
+    return {"median_s": float(np.median(times)), "mean_s": float(times.mean()), "min_s": float(times.min()),
+            "std_s": float(times.std()), "repeat": len(times)}
+
+
+class Workload(object):
+    '''
+    Synthetic dataset, data loaders, model and one batch for a configuration.
+    '''
+
+    def __init__(self, num_atoms, batch_size, condition_length, ode_dims, pred_length = None, workdir = None, seed = 0,
+                 format = "covid"):
+        self.workdir = workdir
+        num_windows = batch_size + 5 + 1  # one training batch plus the 5 validation windows
+        datapath = os.path.join(workdir, "%s_N%d" % (format, num_atoms)) + "/"
+        if format == "covid":
+            args = default_args(batch_size = batch_size, condition_length = condition_length, ode_dims = ode_dims,
+                                datapath = datapath)
+        elif format == "social":
+            args = default_social_args(batch_size = batch_size, condition_length = condition_length, ode_dims = ode_dims,
+                                       datapath = datapath)
+        else:
+            raise ValueError("Unknown dataset format " + format)
+        if pred_length is not None:
+            args.pred_length = pred_length
+        num_days = args.condition_length + args.pred_length + args.split_interval * (num_windows - 1)
+        self.args = args
+        self.format = format
+
+        if format == "covid":
+            write_covid_dataset(args.datapath, args.dataset, num_states = num_atoms, num_train_days = num_days,
+                                num_test_days = args.pred_length, seed = seed)
+            torch.manual_seed(seed)
+            self.dataloader = ParseData(args = args)
+        else:
+            args.training_end_time = num_days + 1  # increments drop the first step
+            write_social_dataset(args.datapath, args.dataset, num_nodes = num_atoms, num_steps = num_days + 2, seed = seed)
+            torch.manual_seed(seed)
+            self.dataloader = load_data_social.ParseData(args = args)
+        encoder, decoder, graph, _, num_atoms = self.dataloader.load_train_data(is_train = True)
+        args.num_atoms = num_atoms
+        self.batch_encoder = utils.get_next_batch_new(encoder, "cpu")
+        self.batch_graph = utils.get_next_batch_new(graph, "cpu")
+        self.batch_decoder = utils.get_next_batch(decoder, "cpu")
+
+        # Preprocessed windows for the preprocessing cases
+        if format == "covid":
+            features = np.load(args.datapath + args.dataset + "/train.npy")
+            graphs = np.load(args.datapath + args.dataset + "/graph_train.npy")
+            features = self.dataloader.feature_preprocessing(features, graphs, method = "norm_const", is_inc = True)
+            graphs = self.dataloader.graph_preprocessing(graphs, method = "norm_const", is_self_loop = True)
+            input_dim = self.dataloader.num_features
+        else:
+            features = np.load(args.datapath + args.dataset + "/locations.npy")[1:args.training_end_time + 1]
+            features = self.dataloader.add_popularity(np.transpose(features, (1, 0, 2)))
+            features = self.dataloader.feature_norm(features)
+            graphs = np.load(args.datapath + args.dataset + "/graphs.npy")[:args.training_end_time - 1]
+            input_dim = features.shape[-1]
+        features, graphs = self.dataloader.generateTrainSamples(features, graphs)
+        self.feature_observed, self.times_observed, _, _ = self.dataloader.split_data(features[:batch_size])
+        self.graphs = graphs[:batch_size]
+
+        z0_prior = Normal(torch.Tensor([0.0]), torch.Tensor([1.]))
+        self.model = create_CoupledODE_model(args, input_dim, z0_prior, torch.Tensor([0.01]), torch.device("cpu"))
+
+        # ODE-state inputs of the ODE function cases
+        with torch.no_grad():
+            batch = self.batch_encoder
+            mu, std = self.model.encoder_z0(batch.x, batch.edge_weight, batch.edge_index, batch.pos, batch.edge_time,
+                                            batch.batch, batch.y)
+            self.first_point = utils.sample_standard_gaussian(mu, std)  # [K*N,D]
+            self.edge_initials = compute_edge_initials(self.first_point, num_atoms, self.model.w_node_to_edge_initial)
+            ode_func = self.model.diffeq_solver.ode_func
+            K_N = self.first_point.shape[0]
+            ode_func.set_index_and_graph(K_N, K_N / num_atoms)
+            ode_func.set_initial_z0(self.first_point)
+            _, edge_value = ode_func.edge_ode_func_net(self.first_point, self.edge_initials, num_atoms)
+            self.edge_value = ode_func.normalize_graph(edge_value, K_N)
+
+        self.optimizer = torch.optim.AdamW(self.model.parameters(), lr = 5e-3, weight_decay = 1e-5)
+
+    def case(self, name):
+        '''
+        :return: zero-argument callable running one iteration of the case.
+        '''
+        args = self.args
+        model = self.model
+        ode_func = model.diffeq_solver.ode_func
+
+        def no_grad(fn):
+            def wrapper():
+                with torch.no_grad():
+                    fn()
+            return wrapper
+
+        if name == "transfer_one_graph":
+            return lambda: self.dataloader.transfer_one_graph(self.feature_observed[0], self.graphs[0], self.times_observed)
+        elif name == "transfer_data":
+            return lambda: self.dataloader.transfer_data(self.feature_observed, self.graphs, self.times_observed,
+                                                         args.batch_size)
+        elif name == "encoder":
+            batch = self.batch_encoder
+            return no_grad(lambda: model.encoder_z0(batch.x, batch.edge_weight, batch.edge_index, batch.pos,
+                                                    batch.edge_time, batch.batch, batch.y))
+        elif name == "Edge_NRI":
+            return no_grad(lambda: ode_func.edge_ode_func_net(self.first_point, self.edge_initials, args.num_atoms))
+        elif name == "Node_GCN":
+            return no_grad(lambda: ode_func.node_ode_func_net(self.first_point, self.edge_value, self.first_point))
+        elif name == "compute_edge_initials":
+            return no_grad(lambda: compute_edge_initials(self.first_point, args.num_atoms, model.w_node_to_edge_initial))
+        elif name == "ode_solve":
+            time_steps = self.batch_decoder["time_steps"]
+            return no_grad(lambda: model.diffeq_solver(self.first_point, time_steps, model.w_node_to_edge_initial))
+        elif name == "train_step":
+            def train_step():
+                self.optimizer.zero_grad()
+                res = model.compute_all_losses(self.batch_encoder, self.batch_decoder, self.batch_graph,
+                                               args.num_atoms, edge_lamda = args.edge_lamda, kl_coef = 1, istest = False)
+                res["loss"].backward()
+            return train_step
+        raise ValueError("Unknown benchmark case " + name)
+
+
+def run(grid, cases = CASES, repeat = 10, warmup = 2, num_threads = 1, workdir = None, log = print, compile = False):
+    '''
+    Time every case for every configuration of the grid.
+
+    :param grid: dict of lists, keys num_atoms, batch_size, condition_length, ode_dims.
+    :param compile: torch.compile the ODE function (CoupledODEFunc.compile_rhs), compilation happens during the warmup.
+    :return: {"environment": ..., "results": [{"case", "config", "median_s", ...}]}
+    '''
+    torch.set_num_threads(num_threads)
+    own_workdir = workdir is None
+    if own_workdir:
+        workdir = tempfile.mkdtemp(prefix = "cgode_bench_")
+
+    keys = ["num_atoms", "batch_size", "condition_length", "ode_dims"]
+    results = []
+    try:
+        for values in itertools.product(*[grid[key] for key in keys]):
+            config = dict(zip(keys, values))
+            workload = Workload(workdir = workdir, **config)
+            workload.model.train()
+            if compile:
+                workload.model.diffeq_solver.ode_func.compile_rhs()
+            for name in cases:
+                stats = time_function(workload.case(name), repeat = repeat, warmup = warmup)
+                results.append(dict({"case": name, "config": config}, **stats))
+                log("%-22s %-70s median %.6fs" % (name, json.dumps(config), stats["median_s"]))
+    finally:
+        if own_workdir:
+            shutil.rmtree(workdir, ignore_errors = True)
+
+    return {"environment": dict(environment(), compile = compile), "results": results}
+
+
+def _relative_error(value, reference):
+    return float(torch.norm(value.float() - reference.float()) / torch.norm(reference.float()).clamp_min(1e-12))
+
+
+def precision_outputs(workload, bf16, seed = 0):
+    '''
+    ODE solution, losses and gradients of one batch with dropout off and fixed z0 draws.
+    '''
+    args = workload.args
+    model = workload.model
+    model.set_bf16(bf16)
+    model.eval()
+    with torch.no_grad():
+        solution, K_N = model.diffeq_solver(workload.first_point, workload.batch_decoder["time_steps"],
+                                            model.w_node_to_edge_initial)
+    model.zero_grad()
+    torch.manual_seed(seed)
+    res = model.compute_all_losses(workload.batch_encoder, workload.batch_decoder, workload.batch_graph,
+                                   args.num_atoms, edge_lamda = args.edge_lamda, kl_coef = 1, istest = False)
+    res["loss"].backward()
+    gradients = torch.cat([p.grad.detach().reshape(-1) for p in model.parameters() if p.grad is not None])
+    model.zero_grad()
+    model.set_bf16(False)
+    model.train()
+    return {"node": solution[:K_N], "edge": solution[K_N:], "loss": res["loss"].detach(),
+            "MAPE": float(res["MAPE"]), "gradients": gradients}
+
+
+def compare_precision(workload, cases = PRECISION_CASES, repeat = 10, warmup = 2):
+    '''
+    Timings of float32 vs bfloat16 autocast and deviation of the bf16 outputs from float32.
+
+    :return: {"timings": [{"case", "float32", "bf16", "speedup"}], "accuracy": {...}}
+    '''
+    model = workload.model
+    timings = []
+    for name in cases:
+        row = {"case": name}
+        for key, bf16 in [("float32", False), ("bf16", True)]:
+            model.set_bf16(bf16)
+            row[key] = time_function(workload.case(name), repeat = repeat, warmup = warmup)
+        model.set_bf16(False)
+        row["speedup"] = row["float32"]["median_s"] / row["bf16"]["median_s"]
+        timings.append(row)
+
+    reference = precision_outputs(workload, bf16 = False)
+    result = precision_outputs(workload, bf16 = True)
+    accuracy = {
+        "node_state_rel_error": _relative_error(result["node"], reference["node"]),
+        "edge_state_rel_error": _relative_error(result["edge"], reference["edge"]),
+        "solution_dtype": str(result["node"].dtype),
+        "loss_float32": float(reference["loss"]), "loss_bf16": float(result["loss"]),
+        "loss_rel_error": _relative_error(result["loss"], reference["loss"]),
+        "MAPE_float32": reference["MAPE"], "MAPE_bf16": result["MAPE"],
+        "gradient_rel_error": _relative_error(result["gradients"], reference["gradients"]),
+        "gradient_cosine": float(torch.nn.functional.cosine_similarity(result["gradients"], reference["gradients"], dim = 0)),
+    }
+    return {"timings": timings, "accuracy": accuracy}
+
+
+def run_precision(grid, formats = ("covid", "social"), cases = PRECISION_CASES, repeat = 10, warmup = 2, num_threads = 1,
+                  workdir = None, log = print):
+    '''
+    compare_precision for every dataset format and configuration of the grid.
+    '''
+    torch.set_num_threads(num_threads)
+    own_workdir = workdir is None
+    if own_workdir:
+        workdir = tempfile.mkdtemp(prefix = "cgode_bench_")
+
+    keys = ["num_atoms", "batch_size", "condition_length", "ode_dims"]
+    results = []
+    try:
+        for format in formats:
+            for values in itertools.product(*[grid[key] for key in keys]):
+                config = dict(zip(keys, values))
+                workload = Workload(workdir = workdir, format = format, **config)
+                workload.model.train()
+                result = compare_precision(workload, cases = cases, repeat = repeat, warmup = warmup)
+                results.append(dict({"format": format, "config": config}, **result))
+                for row in result["timings"]:
+                    log("%-7s %-11s %-70s float32 %.6fs bf16 %.6fs speedup %.2fx" % (
+                        format, row["case"], json.dumps(config), row["float32"]["median_s"], row["bf16"]["median_s"],
+                        row["speedup"]))
+                accuracy = result["accuracy"]
+                log("%-7s %-11s node rel err %.2e, edge rel err %.2e, loss rel err %.2e, MAPE %.6f -> %.6f, grad cosine %.6f" % (
+                    format, "accuracy", accuracy["node_state_rel_error"], accuracy["edge_state_rel_error"],
+                    accuracy["loss_rel_error"], accuracy["MAPE_float32"], accuracy["MAPE_bf16"], accuracy["gradient_cosine"]))
+    finally:
+        if own_workdir:
+            shutil.rmtree(workdir, ignore_errors = True)
+
+    return {"environment": environment(), "results": results}
+
+
+def compare_workspace(workload, method = "rk4", repeat = 10, warmup = 2):
+    '''
+    No-grad eval-mode ODE solve of the workload batch with odeint and with the workspace solver.
+
+    :return: {"odeint": {...}, "workspace": {...}, "max_abs_diff", "speedup"}, with allocation counts,
+        allocated MB and timing statistics per path.
+    '''
+    model = workload.model
+    solver = model.diffeq_solver
+    method_before, use_before = solver.ode_method, solver.use_workspace
+    solver.ode_method = method
+    model.eval()
+    time_steps = workload.batch_decoder["time_steps"]
+
+    def solve():
+        with torch.no_grad():
+            return solver(workload.first_point, time_steps, model.w_node_to_edge_initial)[0]
+
+    result = {}
+    outputs = {}
+    try:
+        for name, use_workspace in [("odeint", False), ("workspace", True)]:
+            solver.use_workspace = use_workspace
+            solve()  # builds the workspace
+            with AllocationCounter() as counter:
+                outputs[name] = solve()
+            result[name] = dict(counter.summary(), **time_function(solve, repeat = repeat, warmup = warmup))
+    finally:
+        solver.ode_method, solver.use_workspace = method_before, use_before
+        model.train()
+    result["max_abs_diff"] = float((outputs["workspace"] - outputs["odeint"]).abs().max())
+    result["speedup"] = result["odeint"]["median_s"] / result["workspace"]["median_s"]
+    return result
+
+
+def run_workspace(grid, methods = ("rk4",), repeat = 10, warmup = 2, num_threads = 1, workdir = None, log = print):
+    '''
+    compare_workspace for every fixed-step method and configuration of the grid.
+    '''
+    torch.set_num_threads(num_threads)
+    own_workdir = workdir is None
+    if own_workdir:
+        workdir = tempfile.mkdtemp(prefix = "cgode_bench_")
+
+    keys = ["num_atoms", "batch_size", "condition_length", "ode_dims"]
+    results = []
+    try:
+        for values in itertools.product(*[grid[key] for key in keys]):
+            config = dict(zip(keys, values))
+            workload = Workload(workdir = workdir, **config)
+            for method in methods:
+                result = compare_workspace(workload, method = method, repeat = repeat, warmup = warmup)
+                results.append(dict({"method": method, "config": config}, **result))
+                log("%-9s %-70s allocations %6d -> %4d, %9.1f MB -> %7.1f MB, %.6fs -> %.6fs (%.2fx), max diff %.1e" % (
+                    method, json.dumps(config), result["odeint"]["allocations"], result["workspace"]["allocations"],
+                    result["odeint"]["allocated_MB"], result["workspace"]["allocated_MB"], result["odeint"]["median_s"],
+                    result["workspace"]["median_s"], result["speedup"], result["max_abs_diff"]))
+    finally:
+        if own_workdir:
+            shutil.rmtree(workdir, ignore_errors = True)
+
+    return {"environment": environment(), "results": results}
+
+
+def _key(result):
+    return result["case"] + " " + json.dumps(result["config"], sort_keys = True)
+
+
+def compare(baseline, current, threshold = 0.1, statistic = "median_s"):
+    '''
+    Compare two result dicts of run().
+
+    :param threshold: relative slowdown flagged as a regression.
+    :return: (rows, regressions): rows are (key, baseline seconds, current seconds, ratio, flag)
+    '''
+    baseline_results = dict((_key(r), r) for r in baseline["results"])
+    rows = []
+    regressions = []
+    for result in current["results"]:
+        key = _key(result)
+        if key not in baseline_results:
+            rows.append((key, None, result[statistic], None, "new"))
+            continue
+        old = baseline_results[key][statistic]
+        ratio = result[statistic] / old if old > 0 else float("inf")
+        if ratio > 1 + threshold:
+            flag = "REGRESSION"
+            regressions.append(key)
+        elif ratio < 1 - threshold:
+            flag = "faster"
+        else:
+            flag = ""
+        rows.append((key, old, result[statistic], ratio, flag))
+    return rows, regressions
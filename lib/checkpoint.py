@@ -0,0 +1,261 @@
+import os
+import copy
+import json
+import hashlib
+import glob
+import random
+import threading
+import queue
+import numpy as np
+import torch
+
+
+def clone_to_cpu(obj):
+    '''
+    Deep copy of a (nested) state dict with every tensor cloned to CPU, so it can be
+    serialized while training keeps updating the originals.
+    '''
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy = True)
+    elif isinstance(obj, dict):
+        return type(obj)((k, clone_to_cpu(v)) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(clone_to_cpu(v) for v in obj)
+    else:
+        return copy.deepcopy(obj)
+
+
+def load_file(path):
+    '''
+    torch.load for checkpoints holding non-tensor objects (args namespace, RNG states).
+    '''
+    try:
+        return torch.load(path, map_location = "cpu", weights_only = False)
+    except TypeError:  # torch versions without weights_only
+        return torch.load(path, map_location = "cpu")
+
+
+def file_hash(path, chunk_size = 1 << 20):
+    '''
+    sha256 hex digest of a checkpoint file.
+    '''
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_rng_state():
+    state = {
+        "torch": torch.get_rng_state(),
+        "numpy": np.random.get_state(),
+        "python": random.getstate(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state["torch"])
+    np.random.set_state(state["numpy"])
+    random.setstate(state["python"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+class BestMetrics(object):
+    '''
+    Best validation / test metrics of a training run, stored in the "extra" of its checkpoints.
+    '''
+
+    def __init__(self):
+        self.val_MAPE = np.inf
+        self.val_RMSE = np.inf
+        self.test_MAPE = np.inf
+        self.test_RMSE = np.inf
+
+    def update_val(self, MAPE, RMSE):
+        '''
+        :return: True if MAPE is a new best validation MAPE
+        '''
+        if MAPE < self.val_MAPE:
+            self.val_MAPE, self.val_RMSE = MAPE, RMSE
+            return True
+        return False
+
+    def update_test(self, MAPE, RMSE):
+        if MAPE < self.test_MAPE:
+            self.test_MAPE, self.test_RMSE = MAPE, RMSE
+            return True
+        return False
+
+    def state_dict(self):
+        return {"best_test_MAPE": self.test_MAPE, "best_test_RMSE": self.test_RMSE,
+                "best_val_MAPE": self.val_MAPE, "best_val_RMSE": self.val_RMSE}
+
+    def load_state_dict(self, extra):
+        self.test_MAPE = extra["best_test_MAPE"]
+        self.test_RMSE = extra["best_test_RMSE"]
+        self.val_MAPE = extra["best_val_MAPE"]
+        self.val_RMSE = extra["best_val_RMSE"]
+
+
+class CheckpointManager(object):
+    '''
+    Saves the full training state (model, optimizer, scheduler, RNG streams, epoch and
+    bookkeeping) from a CPU snapshot on a background thread.
+    Checkpoints are grouped by kind ("best_val", "best_test", "last"); only the newest
+    keep_n files of each kind are kept on disk.
+    '''
+
+    def __init__(self, save_dir, keep_n = 3, async_write = True, manifest = None):
+        '''
+
+        :param keep_n: number of files kept per kind, 0 keeps everything.
+        :param async_write: False writes synchronously in the calling thread.
+        :param manifest: file name in save_dir listing the kept checkpoints of each kind, rewritten after every
+            write. An existing manifest is read, so a resumed run also prunes the files of the interrupted one.
+        '''
+        self.save_dir = save_dir
+        self.keep_n = keep_n
+        self.async_write = async_write
+        self.saved = {}  # kind -> list of paths, oldest first
+        self.error = None
+        self.manifest_path = None
+
+        if not os.path.exists(save_dir):
+            os.makedirs(save_dir)
+        if manifest is not None:
+            self.manifest_path = os.path.join(save_dir, manifest)
+            if os.path.exists(self.manifest_path):
+                with open(self.manifest_path) as f:
+                    for kind, names in json.load(f).items():
+                        self.saved[kind] = [os.path.join(save_dir, name) for name in names
+                                            if os.path.exists(os.path.join(save_dir, name))]
+
+        self.queue = queue.Queue()
+        self.thread = None
+        if async_write:
+            self.thread = threading.Thread(target = self._worker, daemon = True)
+            self.thread.start()
+
+    def snapshot(self, model, optimizer = None, scheduler = None, epoch = 0, args = None, extra = None, transform = None):
+        '''
+        Copy everything needed to resume. Must be called from the training thread.
+
+        :param transform: fitted preprocessing (a plain dict, e.g. FeatureTransform.state_dict()) used at inference.
+        '''
+        state = {
+            "args": copy.deepcopy(args),
+            "state_dict": clone_to_cpu(model.state_dict()),
+            "epoch": epoch,
+            "rng_state": get_rng_state(),
+            "extra": copy.deepcopy(extra) if extra is not None else {},
+        }
+        if optimizer is not None:
+            state["optimizer"] = clone_to_cpu(optimizer.state_dict())
+        if scheduler is not None:
+            state["scheduler"] = copy.deepcopy(scheduler.state_dict())
+        if transform is not None:
+            state["transform"] = copy.deepcopy(transform)
+        return state
+
+    def save(self, state, filename, kind = "last"):
+        '''
+        Queue a snapshot for writing. The checkpoint keeps the 'args' / 'state_dict' keys,
+        so utils.get_ckpt_model can still load it.
+        '''
+        if self.error is not None:
+            raise self.error
+        path = os.path.join(self.save_dir, filename)
+        if self.async_write:
+            self.queue.put((state, path, kind))
+        else:
+            self._write(state, path, kind)
+        return path
+
+    def wait(self):
+        '''
+        Block until every queued checkpoint is on disk.
+        '''
+        if self.async_write:
+            self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        if self.thread is not None:
+            self.wait()
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            try:
+                self._write(*item)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _write(self, state, path, kind):
+        # Write to a temporary file first: a pre-empted run never leaves a truncated checkpoint.
+        tmp_path = path + ".tmp"
+        torch.save(state, tmp_path)
+        os.replace(tmp_path, path)
+
+        paths = self.saved.setdefault(kind, [])
+        if path in paths:
+            paths.remove(path)
+        paths.append(path)
+        if self.keep_n > 0:
+            while len(paths) > self.keep_n:
+                old_path = paths.pop(0)
+                # The same file can be both the best-val and the best-test checkpoint.
+                still_used = any(old_path in other for other in self.saved.values())
+                if not still_used and os.path.exists(old_path):
+                    os.remove(old_path)
+
+        if self.manifest_path is not None:
+            manifest = {kind: [os.path.basename(p) for p in paths] for kind, paths in self.saved.items()}
+            with open(self.manifest_path + ".tmp", "w") as f:
+                json.dump(manifest, f, indent = 1)
+            os.replace(self.manifest_path + ".tmp", self.manifest_path)
+
+    @staticmethod
+    def latest(save_dir, pattern = "*_last_*.ckpt"):
+        '''
+        Most recently written checkpoint matching pattern, None if there is none.
+        '''
+        paths = glob.glob(os.path.join(save_dir, pattern))
+        if len(paths) == 0:
+            return None
+        return max(paths, key = os.path.getmtime)
+
+    @staticmethod
+    def load(path, model, optimizer = None, scheduler = None, device = torch.device("cpu"), restore_rng = True):
+        '''
+        Restore a checkpoint written by save().
+        :return: the checkpoint dict (epoch, args, extra, ...)
+        '''
+        if not os.path.exists(path):
+            raise Exception("Checkpoint " + path + " does not exist.")
+        checkpt = load_file(path)
+
+        model.load_state_dict(checkpt["state_dict"])
+        model.to(device)
+        if optimizer is not None and "optimizer" in checkpt:
+            optimizer.load_state_dict(checkpt["optimizer"])
+        if scheduler is not None and "scheduler" in checkpt:
+            scheduler.load_state_dict(checkpt["scheduler"])
+        if restore_rng and "rng_state" in checkpt:
+            set_rng_state(checkpt["rng_state"])
+
+        return checkpt
@@ -48,7 +48,8 @@ def create_CoupledODE_model(args, input_dim, z0_prior, obsrv_std, device):
 		node_ode_func_net=node_ode_func_net,
 		edge_ode_func_net=edge_ode_func_net,
 		device=device,
-		num_atom = args.num_atoms,dropout=args.dropout).to(device)
+		num_atom = args.num_atoms,dropout=args.dropout,
+		bf16 = getattr(args, "bf16", False)).to(device)
 
 
 
@@ -67,7 +68,8 @@ def create_CoupledODE_model(args, input_dim, z0_prior, obsrv_std, device):
 		diffeq_solver = diffeq_solver, 
 		z0_prior = z0_prior, 
 		device = device,
-		obsrv_std = obsrv_std
+		obsrv_std = obsrv_std,
+		bf16 = getattr(args, "bf16", False)
 		).to(device)
 
 	print_parameters(model)
@@ -1,11 +1,12 @@
 import torch
 import torch.nn as nn
 from torchdiffeq import odeint_adjoint as odeint
+from torchdiffeq import odeint as odeint_direct
 import numpy as np
 import lib.utils as utils
+import lib.instrumentation as instrumentation
+import lib.workspace_solver as workspace_solver
 import torch.nn.functional as F
-from scipy.linalg import block_diag
-from torch_scatter import scatter_add
 import scipy.sparse as sp
 
 
@@ -52,6 +53,12 @@ class DiffeqSolver(nn.Module):
         self.odeint_rtol = odeint_rtol
         self.odeint_atol = odeint_atol
 
+        # No-grad fixed-step solves reuse preallocated buffers (lib.workspace_solver)
+        self.use_workspace = True
+        # Gradients with the adjoint method; False backpropagates through the solver steps (lib.multi_seed)
+        self.adjoint = True
+        self.workspace = None
+
 
 
     def forward(self, first_point,time_steps_to_predict,w_node_to_edge_initial):
@@ -71,7 +78,8 @@ class DiffeqSolver(nn.Module):
             feature_node += self.args.augment_dim
 
         # Edge initialization: h_ij = f([u_i,u_j])
-        edge_initials = compute_edge_initials(first_point, self.num_atoms, w_node_to_edge_initial)  # [K*N*N,D_edge]
+        with instrumentation.stage("edge_init"):
+            edge_initials = compute_edge_initials(first_point, self.num_atoms, w_node_to_edge_initial)  # [K*N*N,D_edge]
         assert (not torch.isnan(edge_initials).any())
 
         node_edge_initial = torch.cat([first_point,edge_initials],0)  #[K*N + K*N*N,D+D_aug]
@@ -85,8 +93,18 @@ class DiffeqSolver(nn.Module):
 
 
         # Results
-        pred_y = odeint(self.ode_func, node_edge_initial, time_steps_to_predict,
-            rtol=self.odeint_rtol, atol=self.odeint_atol, method = self.ode_method) #[time_length, K*N + K*N*N, D]
+        with instrumentation.stage("ode_forward"):
+            if self.workspace_applicable(node_edge_initial):
+                pred_y = self.solve_in_workspace(node_edge_initial, time_steps_to_predict, node_initial)
+            else:
+                pred_y = (odeint if self.adjoint else odeint_direct)(self.ode_func, node_edge_initial, time_steps_to_predict,
+                    rtol=self.odeint_rtol, atol=self.odeint_atol, method = self.ode_method) #[time_length, K*N + K*N*N, D]
+        if instrumentation.is_enabled():
+            instrumentation.set_value("nfe_forward", self.ode_func.nfe)
+            instrumentation.set_value("K", self.ode_func.K)
+            instrumentation.set_value("N", self.num_atoms)
+            instrumentation.set_value("T2", len(time_steps_to_predict))
+            instrumentation.register_solver_hooks(node_edge_initial, pred_y, self.ode_func)
 
         pred_y = pred_y.permute(1,0,2) #[ K*N + K*N*N, time_length, d]
 
@@ -97,13 +115,33 @@ class DiffeqSolver(nn.Module):
 
         return pred_y,K_N
 
+    def workspace_applicable(self, initial_state):
+        '''
+        Workspace solves cover fixed-step methods without autograd, dropout, autocast or a compiled ODE function.
+        '''
+        ode_func = self.ode_func
+        return (self.use_workspace and self.ode_method in workspace_solver.FIXED_STEP_SOLVERS and not torch.is_grad_enabled()
+                and not ode_func.training and not ode_func.bf16 and ode_func.compiled_rhs is None
+                and initial_state.dtype == torch.float32 and workspace_solver.supports(ode_func))
+
+    def solve_in_workspace(self, initial_state, time_steps, node_initial):
+        '''
+        :return: [time_length, K*N + K*N*N, D], as odeint
+        '''
+        K, D = self.ode_func.K, initial_state.shape[1]
+        if self.workspace is None or not self.workspace.matches(K, self.num_atoms, D, self.ode_method,
+                                                                initial_state.dtype, initial_state.device):
+            self.workspace = workspace_solver.CoupledODEWorkspace(self.ode_func, K, self.num_atoms, D, self.ode_method,
+                                                                  dtype = initial_state.dtype, device = initial_state.device)
+        return self.workspace.solve(initial_state, time_steps, node_initial)
 
 
 class CoupledODEFunc(nn.Module):
-    def __init__(self, node_ode_func_net,edge_ode_func_net,num_atom, dropout,device = torch.device("cpu")):
+    def __init__(self, node_ode_func_net,edge_ode_func_net,num_atom, dropout,device = torch.device("cpu"),bf16 = False):
         """
         input_dim: dimensionality of the input
         latent_dim: dimensionality used for ODE. Analog of a continous latent state
+        bf16: run the edge and node functions under bfloat16 autocast, the returned gradient (solver state) stays float32
         """
         super(CoupledODEFunc, self).__init__()
 
@@ -113,6 +151,9 @@ class CoupledODEFunc(nn.Module):
         self.num_atom = num_atom
         self.nfe = 0
         self.dropout = nn.Dropout(dropout)
+        self.bf16 = bf16
+        self.compiled_rhs = None
+        self.compiled_with_grad = False
 
 
     def forward(self, t_local, z, backwards = False):
@@ -123,23 +164,33 @@ class CoupledODEFunc(nn.Module):
         z:  [H,E] concat by axis0. H is [K*N,D], E is[K*N*N,D], z is [K*N + K*N*N, D]
         """
         self.nfe += 1
+        if self.compiled_rhs is not None and (self.compiled_with_grad or not torch.is_grad_enabled()):
+            return self.compiled_rhs(z)
+        return self.rhs(z)
 
 
+    def rhs(self, z):
+        """
+        Right-hand side of the coupled ODE, free of host synchronization apart from the eager-mode NaN checks.
+
+        z:  [K*N + K*N*N, D]
+        """
         node_attributes = z[:self.K_N,:]
         edge_attributes = z[self.K_N:,:]
-        assert (not torch.isnan(node_attributes).any())
-        assert (not torch.isnan(edge_attributes).any())
-
-        #grad_edge, edge_value = self.edge_ode_func_net(node_attributes,self.num_atom) # [K*N*N,D],[K,N*N], edge value are non-negative by using relu.
-        grad_edge, edge_value = self.edge_ode_func_net(node_attributes,edge_attributes,self.num_atom)  # [K*N*N,D],[K,N*N], edge value are non-negative by using relu.todo:with self-evolution
-        edge_value = self.normalize_graph(edge_value,self.K_N)
-        assert (not torch.isnan(edge_value).any())
-        grad_node = self.node_ode_func_net(node_attributes,edge_value,self.node_z0) # [K*N,D]
-        assert (not torch.isnan(grad_node).any())
-        assert (not torch.isinf(grad_edge).any())
-
-        assert (not torch.isnan(grad_node).any())
-        assert (not torch.isinf(grad_edge).any())
+        if _checks_enabled():
+            assert (not torch.isnan(node_attributes).any())
+            assert (not torch.isnan(edge_attributes).any())
+
+        with utils.autocast(self.device, self.bf16):
+            #grad_edge, edge_value = self.edge_ode_func_net(node_attributes,self.num_atom) # [K*N*N,D],[K,N*N], edge value are non-negative by using relu.
+            grad_edge, edge_value = self.edge_ode_func_net(node_attributes,edge_attributes,self.num_atom)  # [K*N*N,D],[K,N*N], edge value are non-negative by using relu.todo:with self-evolution
+            edge_value = self.normalize_graph(edge_value,self.K_N)
+            grad_node = self.node_ode_func_net(node_attributes,edge_value,self.node_z0) # [K*N,D]
+        grad_node = grad_node.to(z.dtype)
+        grad_edge = grad_edge.to(z.dtype)
+        if _checks_enabled():
+            assert (not torch.isnan(grad_node).any())
+            assert (not torch.isinf(grad_edge).any())
 
         # Concat two grad
         grad = self.dropout(torch.cat([grad_node,grad_edge],0)) # [K*N + K*N*N, D]
@@ -148,6 +199,23 @@ class CoupledODEFunc(nn.Module):
         return grad
 
 
+    def compile_rhs(self, with_grad = False, **kwargs):
+        '''
+        Compile the right-hand side with torch.compile. Shapes are static: every new (K, N) is compiled once and cached.
+
+        :param with_grad: also use the compiled function when autograd is on (adjoint vector-Jacobian products). By default
+            it only replaces the no-grad evaluations: the forward solve of odeint_adjoint, validation, test and inference.
+            On CPU, inductor's dropout masks make the graphs recorded for backward slower than eager.
+        '''
+        # Up to 3 graphs per shape and train / eval mode (no-grad, grad, adjoint): room for the full and last training
+        # batch, validation and test batch sizes.
+        torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 64)
+        options = dict(dynamic = False, fullgraph = True)
+        options.update(kwargs)
+        self.compiled_rhs = torch.compile(self.rhs, **options)
+        self.compiled_with_grad = with_grad
+
+
     def set_index_and_graph(self,K_N,K):
         '''
 
@@ -159,11 +227,8 @@ class CoupledODEFunc(nn.Module):
         self.K_N_N = self.K_N*self.num_atom
         self.nfe = 0
 
-        # Step1: Concat into big graph: which is set by default.diagonal matrix
-        edge_each = np.ones((self.num_atom, self.num_atom))
-        edge_whole= block_diag(*([edge_each] * self.K))
-        edge_index,_ = utils.convert_sparse(edge_whole)
-        self.edge_index = torch.LongTensor(edge_index).to(self.device)
+        # The big graph is block diagonal with K fully connected N x N blocks: edge k*N*N + i*N + j goes from
+        # node k*N + i to node k*N + j, so degrees are row sums of the [K*N,N] edge weights (see normalize_graph).
 
     def set_initial_z0(self,node_z0):
         self.node_z0 = node_z0
@@ -171,43 +236,33 @@ class CoupledODEFunc(nn.Module):
     def normalize_graph(self,edge_weight,num_nodes):
       '''
       For asymmetric graph
-      :param edge_index: [num_edges,2], torch.LongTensor
       :param edge_weight: [K,N*N] ->[num_edges]
-      :param num_nodes:
+      :param num_nodes: K*N
       :return:
       '''
-      assert (not torch.isnan(edge_weight).any())
-      assert (torch.sum(edge_weight<0)==0)
-      edge_weight_flatten = edge_weight.view(-1)  #[K*N*N]
-
-      row, col = self.edge_index[0], self.edge_index[1]
-      deg = scatter_add(edge_weight_flatten, row, dim=0, dim_size=num_nodes) #[K*N]
-      deg_inv_sqrt = deg.pow_(-1)
-      deg_inv_sqrt.masked_fill_(deg_inv_sqrt == float("inf"), 0)
-      if torch.isnan(deg_inv_sqrt).any():
-          assert (torch.sum(deg == 0) == 0)
-          assert (torch.sum(deg < 0) == 0)
+      if _checks_enabled():
+          assert (not torch.isnan(edge_weight).any())
+          assert (torch.sum(edge_weight<0)==0)
+      edge_weight_rows = edge_weight.reshape(num_nodes, self.num_atom).float()  #[K*N,N], degrees are accumulated in float32 under bf16 autocast
 
-      #assert (not torch.isnan(deg_inv_sqrt).any())
+      deg = edge_weight_rows.sum(dim=1, keepdim=True) #[K*N,1]
+      deg_inv_sqrt = deg.pow(-1)
+      deg_inv_sqrt = deg_inv_sqrt.masked_fill(deg_inv_sqrt == float("inf"), 0)
 
-
-      edge_weight_normalized = deg_inv_sqrt[row] * edge_weight_flatten   #[k*N*N]
-      assert (torch.sum(edge_weight_normalized < 0) == 0) and (torch.sum(edge_weight_normalized > 1) == 0)
+      edge_weight_normalized = deg_inv_sqrt * edge_weight_rows   #[K*N,N]
+      if _checks_enabled():
+          assert (not torch.isnan(edge_weight_normalized).any())
+          assert (torch.sum(edge_weight_normalized < 0) == 0) and (torch.sum(edge_weight_normalized > 1) == 0)
 
       # Reshape back
 
       edge_weight_normalized = torch.reshape(edge_weight_normalized,(self.K,-1)) #[K,N*N]
-      assert (not torch.isnan(edge_weight_normalized).any())
 
       return edge_weight_normalized
 
 
-
-
-
-
-
-
-
-
-
+def _checks_enabled():
+    '''
+    Data-dependent assertions sync with the host and break graph capture: they only run eagerly.
+    '''
+    return not torch.compiler.is_compiling()
@@ -0,0 +1,132 @@
+import os
+import sys
+import subprocess
+from datetime import timedelta
+import numpy as np
+import torch
+import torch.distributed as dist
+
+
+def is_worker():
+    '''
+    True inside a process started by launch_workers (or any torchrun-style launcher).
+    '''
+    return "RANK" in os.environ and "WORLD_SIZE" in os.environ
+
+
+def launch_workers(nprocs, master_port, master_addr = "127.0.0.1"):
+    '''
+    Re-run the current script as nprocs local worker processes.
+    :return: exit code, non-zero if any worker failed.
+    '''
+    procs = []
+    for rank in range(nprocs):
+        env = dict(os.environ)
+        env["RANK"] = str(rank)
+        env["LOCAL_RANK"] = str(rank)
+        env["WORLD_SIZE"] = str(nprocs)
+        env["MASTER_ADDR"] = master_addr
+        env["MASTER_PORT"] = str(master_port)
+        procs.append(subprocess.Popen([sys.executable] + sys.argv, env = env))
+
+    exit_code = 0
+    try:
+        for p in procs:
+            p.wait()
+            if p.returncode != 0 and exit_code == 0:
+                exit_code = p.returncode
+                # One worker failed: the others would block in collectives forever.
+                for other in procs:
+                    if other.poll() is None:
+                        other.terminate()
+    except KeyboardInterrupt:
+        for p in procs:
+            p.terminate()
+        raise
+
+    return exit_code
+
+
+def init_distributed(args):
+    '''
+    Set args.rank / args.world_size, and join the gloo process group when running as a worker.
+    Each worker gets an equal share of the CPU threads.
+    '''
+    if not is_worker():
+        args.rank = 0
+        args.world_size = 1
+        return
+
+    args.rank = int(os.environ["RANK"])
+    args.world_size = int(os.environ["WORLD_SIZE"])
+    # Rank 0 runs validation and testing while the other ranks wait in the next all-reduce.
+    dist.init_process_group(backend = "gloo", rank = args.rank, world_size = args.world_size,
+                            timeout = timedelta(hours = 5))
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // args.world_size))
+
+
+def is_main_process(args):
+    return getattr(args, "rank", 0) == 0
+
+
+def get_world_size(args):
+    return getattr(args, "world_size", 1)
+
+
+def shard_indices(num_windows, rank, world_size):
+    '''
+    Interleaved shard of the training windows for one rank.
+    Shards are padded by wrapping around, so every rank runs the same number of batches.
+    :return: indices into [0, num_windows)
+    '''
+    per_rank = int(np.ceil(num_windows / world_size))
+    index = np.arange(rank, per_rank * world_size, world_size)
+    return index % num_windows
+
+
+def broadcast_parameters(model, src = 0):
+    if not dist.is_initialized():
+        return
+    for tensor in list(model.parameters()) + list(model.buffers()):
+        dist.broadcast(tensor.data, src = src)
+
+
+def all_reduce_gradients(model):
+    '''
+    Average gradients over all ranks with a single flattened all-reduce.
+    '''
+    if not dist.is_initialized():
+        return
+    params = [p for p in model.parameters() if p.requires_grad]
+    grads = []
+    for p in params:
+        if p.grad is None:
+            p.grad = torch.zeros_like(p)
+        grads.append(p.grad.view(-1))
+    flat = torch.cat(grads)
+    dist.all_reduce(flat, op = dist.ReduceOp.SUM)
+    flat /= dist.get_world_size()
+
+    offset = 0
+    for p in params:
+        numel = p.grad.numel()
+        p.grad.copy_(flat[offset:offset + numel].view_as(p.grad))
+        offset += numel
+
+
+def assert_parameters_synced(model, atol = 1e-5):
+    '''
+    Check that all ranks hold the same parameters (one scalar all-reduce).
+    '''
+    if not dist.is_initialized():
+        return
+    checksum = torch.stack([p.detach().double().sum() for p in model.parameters()]).sum().view(1)
+    lowest, highest = checksum.clone(), checksum.clone()
+    dist.all_reduce(lowest, op = dist.ReduceOp.MIN)
+    dist.all_reduce(highest, op = dist.ReduceOp.MAX)
+    assert (highest - lowest).abs().item() <= atol * max(1., checksum.abs().item()), "Parameters diverged across ranks"
+
+
+def cleanup():
+    if dist.is_initialized():
+        dist.destroy_process_group()
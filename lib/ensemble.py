@@ -0,0 +1,208 @@
+'''
+Ensemble forecasts of several covid checkpoints (seeds, best-val / best-test epochs).
+
+The members must share the preprocessing (states, condition_length, features, FeatureTransform),
+so the conditioning windows are read, preprocessed and batched into one encoder graph once and
+every member runs on the same batch. Members run in this process one after the other, or on a
+pool of worker processes that each load their share of the checkpoints once and receive the
+shared batch through shared memory. Each member draws z0 with its own seed (seed + member index),
+so both modes give the same forecasts.
+'''
+import glob
+import queue
+import traceback
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from lib.forecast import Forecaster
+from lib.feature_transform import FeatureTransform
+import lib.checkpoint as checkpoint
+import lib.utils as utils
+
+
+def expand_checkpoints(patterns):
+    '''
+    :param patterns: checkpoint paths or glob patterns.
+    :return: sorted paths, in the order of the patterns.
+    '''
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        if len(matches) == 0:
+            raise ValueError("No checkpoint matches " + pattern)
+        paths += [p for p in matches if p not in paths]
+    return paths
+
+
+def checkpoint_preprocessing(ckpt_path, datapath = None):
+    '''
+    :return: args and FeatureTransform state of a checkpoint, without building its model.
+    '''
+    checkpt = checkpoint.load_file(ckpt_path)
+    args = checkpt['args']
+    transform_state = checkpt.get('transform')
+    if transform_state is None:  # checkpoints saved before the transform was stored, as Forecaster
+        if datapath is not None:
+            args.datapath = datapath
+        transform_state = FeatureTransform.fit(args).state_dict()
+    return args, transform_state
+
+
+def check_compatible(reference, ckpt_path, args, transform_state):
+    '''
+    Raise if a checkpoint (its args and transform state) does not share the window preprocessing of the reference Forecaster.
+    '''
+    a = reference.args
+    for name in ["num_atoms", "condition_length", "features", "feature_out_index"]:
+        if getattr(a, name) != getattr(args, name):
+            raise ValueError("%s has %s=%s, %s has %s" % (ckpt_path, name, getattr(args, name), reference.ckpt_path, getattr(a, name)))
+    state_a = reference.transform.state_dict()
+    if any(not np.array_equal(np.asarray(state_a[key]), np.asarray(transform_state[key])) for key in state_a):
+        raise ValueError("%s was fitted with a different feature transform than %s" % (ckpt_path, reference.ckpt_path))
+
+
+def member_increments(forecaster, batch_en, batch_de, pred_length, num_samples, seed):
+    torch.manual_seed(seed)
+    return forecaster.run_model(batch_en, batch_de, pred_length, num_samples)
+
+
+def ensemble_worker(ckpt_paths, members, datapath, dataset, num_threads, jobs, results):
+    '''
+    Ensemble worker process: loads its members once, then answers (job_id, batch_en, batch_de, pred_length,
+    num_samples, seed) jobs with the normalized increments of each member until it gets None.
+    '''
+    try:
+        torch.set_num_threads(num_threads)
+        forecasters = {i: Forecaster(ckpt_paths[i], torch.device("cpu"), datapath = datapath, dataset = dataset) for i in members}
+        results.put(("ready", None, None))
+    except Exception:
+        results.put(("error", None, traceback.format_exc()))
+        return
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        job_id, batch_en, batch_de, pred_length, num_samples, seed = job
+        try:
+            increments = {i: member_increments(f, batch_en, batch_de, pred_length, num_samples, seed + i) for i, f in forecasters.items()}
+            results.put(("result", job_id, increments))
+        except Exception:
+            results.put(("error", job_id, traceback.format_exc()))
+
+
+class EnsembleForecaster(object):
+    '''
+    Averaged and per-member forecasts of checkpoints sharing the same preprocessing.
+    '''
+
+    def __init__(self, ckpt_paths, device = torch.device("cpu"), datapath = None, dataset = None, seed = 0, workers = 0, threads = 1):
+        '''
+
+        :param seed: z0 seed of member 0, member i uses seed + i.
+        :param workers: worker processes (CPU), 0 runs the members in this process.
+        :param threads: torch CPU threads per worker process.
+        '''
+        if len(ckpt_paths) == 0:
+            raise ValueError("No checkpoints")
+        self.ckpt_paths = list(ckpt_paths)
+        self.seed = seed
+        self.reference = Forecaster(self.ckpt_paths[0], device, datapath = datapath, dataset = dataset)
+        self.members = [self.reference]
+
+        self.workers = []
+        self.job_id = 0
+        if workers == 0:
+            for path in self.ckpt_paths[1:]:
+                member = Forecaster(path, device, datapath = datapath, dataset = dataset)
+                check_compatible(self.reference, path, member.args, member.transform.state_dict())
+                self.members.append(member)
+        else:
+            if device.type != "cpu":
+                raise ValueError("Ensemble worker processes run on CPU")
+            # The models are only built in the workers, the parent keeps the reference for preprocessing.
+            for path in self.ckpt_paths[1:]:
+                check_compatible(self.reference, path, *checkpoint_preprocessing(path, self.reference.args.datapath))
+            ctx = mp.get_context("spawn")
+            self.results = ctx.Queue()
+            workers = min(workers, len(self.ckpt_paths))
+            for w in range(workers):
+                jobs = ctx.Queue()
+                members = list(range(w, len(self.ckpt_paths), workers))
+                process = ctx.Process(target = ensemble_worker, daemon = True,
+                                      args = (self.ckpt_paths, members, self.reference.args.datapath, self.reference.args.dataset,
+                                              threads, jobs, self.results))
+                process.start()
+                self.workers.append((process, jobs))
+            for _ in self.workers:
+                self._get()
+
+    def _get(self):
+        while True:
+            try:
+                kind, job_id, value = self.results.get(timeout = 5)
+            except queue.Empty:
+                if any(not process.is_alive() for process, _ in self.workers):
+                    raise Exception("Ensemble worker process died.")
+                continue
+            if kind == "error":
+                raise Exception("Ensemble worker failed:\n" + value)
+            return kind, job_id, value
+
+    def member_increments(self, batch_en, batch_de, pred_length, num_samples = 1):
+        '''
+        :return: normalized increments of every member, [M,K,N,T2,D_out] ([M,S,K,N,T2,D_out])
+        '''
+        if len(self.workers) == 0:
+            increments = [member_increments(f, batch_en, batch_de, pred_length, num_samples, self.seed + i)
+                          for i, f in enumerate(self.members)]
+            return np.stack(increments)
+
+        self.job_id += 1
+        for _, jobs in self.workers:
+            jobs.put((self.job_id, batch_en, batch_de, pred_length, num_samples, self.seed))
+        increments = {}
+        for _ in self.workers:
+            _, job_id, value = self._get()
+            if job_id != self.job_id:
+                raise Exception("Ensemble worker answered job %s while waiting for %s" % (job_id, self.job_id))
+            increments.update(value)
+        return np.stack([increments[i] for i in range(len(self.ckpt_paths))])
+
+    def predict_windows(self, windows, pred_length = None, num_samples = 1):
+        '''
+        :param windows: list of preprocess_window outputs, batched once for all members.
+        :return: ensemble mean [K,N,pred_length,D_out], member predictions [M,K,N,pred_length,D_out]
+            (cumulative; [S,K,...] and [M,S,K,...] for num_samples > 1, the mean is over members)
+        '''
+        if pred_length is None:
+            pred_length = self.reference.args.pred_length
+        batch_en, batch_de, last_observed = self.reference.batch_windows(windows, pred_length)
+        members = self.reference.transform.denormalize(self.member_increments(batch_en, batch_de, pred_length, num_samples), last_observed)
+        return members.mean(axis = 0), members
+
+    def predict(self, start_dates, pred_length = None, num_samples = 1):
+        '''
+        :param start_dates: list of "YYYY-MM-DD", first forecast day of each window.
+        '''
+        windows = [self.reference.conditioning_window(utils.transfer_index(d)) for d in start_dates]
+        return self.predict_windows(windows, pred_length, num_samples)
+
+    def forecast(self, start_dates, pred_length = None):
+        '''
+        :return: DataFrame with Forecaster COLUMNS (prediction = ensemble mean), one member_<i> column per checkpoint
+            and the ensemble spread "member_std".
+        '''
+        mean, members = self.predict(start_dates, pred_length)
+        df = self.reference.to_frame(start_dates, mean)
+        for i in range(len(self.ckpt_paths)):
+            df["member_%d" % i] = members[i].ravel()
+        df["member_std"] = members.std(axis = 0).ravel()
+        return df
+
+    def close(self):
+        for process, jobs in self.workers:
+            if process.is_alive():
+                jobs.put(None)
+                process.join()
+        self.workers = []
@@ -0,0 +1,415 @@
+'''
+TorchScript export of a trained CoupledODE for inference.
+
+ScriptCoupledODE re-implements the inference path with plain torch ops around the trained
+submodules: the encoder graph construction of ParseData.transfer_one_graph, the GTrans encoder
+(without torch_geometric), the coupled node / edge ODE function (without numpy / scipy), a
+fixed-step solver (euler, midpoint and rk4 as in torchdiffeq's fixed grid) and the node decoder.
+The saved file only needs torch.jit.load; ExportedForecaster adds the raw-data preprocessing and
+denormalization from the stored transform.json with numpy (this module does not import torch_geometric,
+scipy or pandas).
+'''
+import json
+import copy
+from typing import List, Optional
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.distributions.normal import Normal
+from lib.feature_transform import FeatureTransform
+
+
+FIXED_STEP_SOLVERS = ["euler", "midpoint", "rk4"]
+
+
+def segment_softmax(src, index, num_nodes: int):
+    '''
+    torch_geometric.utils.softmax: softmax of src [E,d] over the edges sharing the same index.
+    '''
+    index_expanded = index.view(-1, 1).expand_as(src)
+    src_max = torch.full((num_nodes, src.shape[1]), float("-inf"), dtype = src.dtype, device = src.device)
+    src_max = src_max.scatter_reduce(0, index_expanded, src, reduce = "amax", include_self = True)
+    out = (src - src_max.index_select(0, index)).exp()
+    out_sum = torch.zeros((num_nodes, src.shape[1]), dtype = src.dtype, device = src.device).index_add(0, index, out) + 1e-16
+    return out / out_sum.index_select(0, index)
+
+
+def mean_pool(x, group, num_groups: int):
+    '''
+    torch_geometric.nn.global_mean_pool
+    '''
+    total = torch.zeros((num_groups, x.shape[1]), dtype = x.dtype, device = x.device).index_add(0, group, x)
+    count = torch.zeros(num_groups, dtype = x.dtype, device = x.device).index_add(0, group, torch.ones_like(group, dtype = x.dtype))
+    return total / count.clamp(min = 1).view(-1, 1)
+
+
+class ScriptTemporalEncoding(nn.Module):
+
+    def __init__(self, temporal_net):
+        super(ScriptTemporalEncoding, self).__init__()
+        self.register_buffer("div_term", temporal_net.div_term.detach().clone())
+        self.register_buffer("even", torch.arange(self.div_term.shape[1]).view(1, -1) % 2 == 0)
+
+    def forward(self, t):
+        position_term = torch.matmul(t.view(-1, 1) * 200, self.div_term)
+        return torch.where(self.even, torch.sin(position_term), torch.cos(position_term))
+
+
+class ScriptAttentionHead(nn.Module):
+
+    def __init__(self, w_k, w_q, w_v):
+        super(ScriptAttentionHead, self).__init__()
+        self.w_k = w_k
+        self.w_q = w_q
+        self.w_v = w_v
+
+
+class ScriptGTrans(nn.Module):
+    '''
+    GTrans message passing (flow source -> target, sum aggregation) in plain torch.
+    '''
+
+    def __init__(self, gtrans):
+        super(ScriptGTrans, self).__init__()
+        self.heads = nn.ModuleList([ScriptAttentionHead(gtrans.w_k_list[i], gtrans.w_q_list[i], gtrans.w_v_list[i])
+                                    for i in range(gtrans.n_heads)])
+        self.temporal_net = ScriptTemporalEncoding(gtrans.temporal_net)
+        self.layer_norm = gtrans.layer_norm
+        self.dropout = gtrans.dropout
+        self.d_sqrt = float(gtrans.d_sqrt)
+
+    def forward(self, x, edge_index, edge_weight, edge_time):
+        residual = x
+        x = self.layer_norm(x)
+        num_nodes = x.shape[0]
+        row, col = edge_index[0], edge_index[1]
+
+        # normalize_graph_asymmetric
+        deg = torch.zeros(num_nodes, dtype = edge_weight.dtype, device = edge_weight.device).index_add(0, row, edge_weight)
+        deg_inv = deg.pow(-1)
+        deg_inv = deg_inv.masked_fill(torch.isinf(deg_inv), 0.)
+        edges_weight = (deg_inv.index_select(0, row) * edge_weight).view(-1, 1)
+
+        x_j = x.index_select(0, row)
+        x_i = x.index_select(0, col)
+        x_j_transfer = x_j + self.temporal_net(edge_time)
+        messages: List[torch.Tensor] = []
+        for head in self.heads:
+            attention = torch.squeeze(torch.bmm(torch.unsqueeze(head.w_k(x_j_transfer), 1),
+                                                torch.unsqueeze(head.w_q(x_i), 2)), 1)  # [E,1]
+            attention = torch.div(attention, self.d_sqrt) * edges_weight
+            attention_norm = segment_softmax(attention, col, num_nodes)
+            messages.append(attention_norm * head.w_v(x_j_transfer))
+        message = torch.cat(messages, 1)
+
+        aggr_out = torch.zeros((num_nodes, message.shape[1]), dtype = message.dtype, device = message.device).index_add(0, col, message)
+        return self.dropout(residual + F.gelu(aggr_out))
+
+
+class ScriptEncoder(nn.Module):
+    '''
+    GNN(is_encoder = True) with GTrans layers, dropout as in GNN / GTrans (identity in eval mode).
+    '''
+
+    def __init__(self, gnn):
+        super(ScriptEncoder, self).__init__()
+        for gc in gnn.gcs:
+            if gc.conv_name != "GTrans":
+                raise ValueError("Only GTrans encoders can be exported, got " + gc.conv_name)
+        self.adapt_w = gnn.adapt_w
+        self.drop = gnn.drop
+        self.gcs = nn.ModuleList([ScriptGTrans(gc.base_conv) for gc in gnn.gcs])
+        self.temporal_net = ScriptTemporalEncoding(gnn.temporal_net)
+        self.sequence_w = gnn.sequence_w
+        self.hidden_to_z0 = gnn.hidden_to_z0
+
+    def forward(self, x, edge_index, edge_weight, x_time, edge_time, group, num_groups: int):
+        h_t = self.drop(F.gelu(self.adapt_w(x)))
+        for gc in self.gcs:
+            h_t = gc(h_t, edge_index, edge_weight, edge_time)
+        h_t = h_t + self.temporal_net(x_time)
+
+        attention_vector = F.gelu(self.sequence_w(mean_pool(h_t, group, num_groups)))  # [num_ball,d]
+        attention_nodes = torch.sigmoid(torch.sum(attention_vector.index_select(0, group) * h_t, dim = 1)).view(-1, 1)
+        h_ball = mean_pool(attention_nodes * h_t, group, num_groups)
+        h_out = self.hidden_to_z0(h_ball)  # [num_ball,2*z_dim]
+        last_dim = h_out.shape[1] // 2
+        return h_out[:, :last_dim], h_out[:, last_dim:].abs()
+
+
+class ScriptODEFunc(nn.Module):
+    '''
+    CoupledODEFunc with Edge_NRI and Node_GCN, dropout included. The one-hot rel_send / rel_rec products are index gathers,
+    the block-diagonal degree normalization a row sum.
+    '''
+
+    def __init__(self, ode_func, num_atoms):
+        super(ScriptODEFunc, self).__init__()
+        edge_net = ode_func.edge_ode_func_net
+        node_net = ode_func.node_ode_func_net
+        self.num_atoms = num_atoms
+        self.w_node2edge = edge_net.w_node2edge
+        self.edge_self_evolve = edge_net.edge_self_evolve
+        self.w_edge2value = edge_net.w_edge2value
+        self.edge_layer_norm = edge_net.layer_norm
+        self.w_node = node_net.w_node
+        self.node_layer_norm = node_net.layer_norm
+        self.edge_dropout = edge_net.dropout
+        self.node_dropout = node_net.dropout
+        self.dropout = ode_func.dropout
+        pairs = torch.arange(num_atoms * num_atoms)
+        self.register_buffer("send_index", pairs // num_atoms)
+        self.register_buffer("recv_index", pairs % num_atoms)
+
+    def edge_inputs(self, node_inputs):
+        '''
+        [h_i||h_j] for every ordered pair, [K,N*N,2D]
+        '''
+        nodes = node_inputs.view(-1, self.num_atoms, node_inputs.shape[1])  # [K,N,D]
+        return torch.cat([nodes.index_select(1, self.send_index), nodes.index_select(1, self.recv_index)], dim = -1)
+
+    def forward(self, z, K_N: int, node_z0):
+        num_atoms = self.num_atoms
+        node_attributes = z[:K_N]
+        edge_attributes = z[K_N:]
+        num_feature = node_attributes.shape[1]
+
+        # Edge_NRI
+        edges_from_node = F.gelu(self.w_node2edge(self.edge_inputs(node_attributes)))
+        edges_self = self.edge_self_evolve(self.edge_layer_norm(edge_attributes)).view(-1, num_atoms * num_atoms, edge_attributes.shape[1])
+        edges_z = self.edge_dropout(edges_from_node + edges_self)  # [K,N*N,D]
+        edge_value = torch.squeeze(F.relu(self.w_edge2value(edges_z)), dim = -1)  # [K,N*N]
+        grad_edge = edges_z.view(-1, num_feature)
+
+        # normalize_graph: out-degree of every node of the block-diagonal graph
+        edge_value = edge_value.view(-1, num_atoms)  # [K*N,N]
+        deg_inv = torch.sum(edge_value, dim = 1, keepdim = True).pow(-1)
+        deg_inv = deg_inv.masked_fill(torch.isinf(deg_inv), 0.)
+        edges = (edge_value * deg_inv).view(-1, num_atoms, num_atoms)  # [K,N,N]
+
+        # Node_GCN
+        inputs = self.node_layer_norm(node_attributes)
+        inputs_transform = torch.matmul(inputs, self.w_node).view(-1, num_atoms, num_feature)
+        x_hidden = torch.bmm(edges, inputs_transform).view(-1, num_feature)
+        grad_node = self.node_dropout(F.gelu(x_hidden) - inputs + node_z0)
+
+        return self.dropout(torch.cat([grad_node, grad_edge], 0))
+
+
+class ScriptCoupledODE(nn.Module):
+    '''
+    Preprocessed conditioning windows -> normalized predicted increments, as
+    ParseData.transfer_one_graph + CoupledODE.get_reconstruction(decode_edge = False) on the test time grid.
+    '''
+
+    def __init__(self, model, args, copy_model = True):
+        '''
+
+        :param copy_model: False wraps the submodules of model itself (lib.multi_seed), instead of an eval copy on CPU.
+        '''
+        super(ScriptCoupledODE, self).__init__()
+        if args.solver not in FIXED_STEP_SOLVERS:
+            raise ValueError("Only fixed-step solvers %s can be exported, the model uses %s" % (FIXED_STEP_SOLVERS, args.solver))
+        if copy_model:
+            model = copy.deepcopy(model).cpu().eval()
+        self.num_atoms = args.num_atoms
+        self.condition_length = args.condition_length
+        self.augment_dim = args.augment_dim
+        self.method = args.solver
+        self.encoder = ScriptEncoder(model.encoder_z0)
+        self.ode_func = ScriptODEFunc(model.diffeq_solver.ode_func, args.num_atoms)
+        self.w_node_to_edge_initial = model.w_node_to_edge_initial
+        self.decoder_node = model.decoder_node.decoder
+
+    def encoder_graph(self, features, graphs, times_observed, gap: float):
+        '''
+        ParseData.transfer_one_graph for a batch of windows.
+
+        :param features: [K,N,T1,D]
+        :param graphs: [K,T1,N,N]
+        :param times_observed: [T1] float64
+        :return: x, edge_index, edge_weight, x_time, edge_time of the batched graph
+        '''
+        K, N, T1 = features.shape[0], features.shape[1], features.shape[2]
+        M = N * T1
+        time_diff = times_observed.view(-1, 1) - times_observed.view(1, -1)  # [T1,T1] receiver-major as edge_time_matrix
+        time_ok = (time_diff <= 0) & (time_diff.abs() <= gap)
+        state_eye = torch.eye(N, dtype = torch.bool, device = features.device)
+        time_eye = torch.eye(T1, dtype = torch.bool, device = features.device)
+        # same state: all time pairs; different states: same time only
+        pair_mask = state_eye.view(N, 1, N, 1) | time_eye.view(1, T1, 1, T1)  # [N,T1,N,T1]
+        node_time = torch.arange(M, device = features.device) % T1
+
+        edge_index_list: List[torch.Tensor] = []
+        edge_weight_list: List[torch.Tensor] = []
+        edge_time_list: List[torch.Tensor] = []
+        for k in range(K):
+            weight = graphs[k].permute(1, 0, 2).reshape(N, T1, N, 1) * pair_mask  # [N,T1,N,T1]: graph[t_a,n_a,n_b]
+            weight = weight.reshape(M, M)
+            exist = (weight != 0) & time_ok.index_select(0, node_time).index_select(1, node_time)
+            index = torch.nonzero(exist).t()  # row-major as scipy coo
+            edge_index_list.append(index + k * M)
+            edge_weight_list.append(weight[index[0], index[1]])
+            diff = time_diff[node_time.index_select(0, index[0]), node_time.index_select(0, index[1])]
+            edge_time_list.append((diff + 3).float() - 3)
+
+        x = features.reshape(K * M, features.shape[3])
+        x_time = times_observed.float().repeat(K * N)
+        return x, torch.cat(edge_index_list, 1), torch.cat(edge_weight_list, 0), x_time, torch.cat(edge_time_list, 0)
+
+    def solve(self, y0, time_steps, K_N: int, node_z0):
+        '''
+        torchdiffeq fixed grid: one step per interval of time_steps.
+
+        :return: [T,K*N + K*N*N,D]
+        '''
+        solution: List[torch.Tensor] = [y0]
+        y = y0
+        one_third = 1. / 3
+        for i in range(time_steps.shape[0] - 1):
+            dt = time_steps[i + 1] - time_steps[i]
+            k1 = self.ode_func(y, K_N, node_z0)
+            if self.method == "euler":
+                dy = dt * k1
+            elif self.method == "midpoint":
+                dy = dt * self.ode_func(y + k1 * (0.5 * dt), K_N, node_z0)
+            else:  # rk4 (3/8 rule, torchdiffeq's rk4_alt_step_func)
+                k2 = self.ode_func(y + dt * k1 * one_third, K_N, node_z0)
+                k3 = self.ode_func(y + dt * (k2 - k1 * one_third), K_N, node_z0)
+                k4 = self.ode_func(y + dt * (k1 - k2 + k3), K_N, node_z0)
+                dy = (k1 + 3 * (k2 + k3) + k4) * dt * 0.125
+            y = y + dy
+            solution.append(y)
+        return torch.stack(solution, 0)
+
+    def forward(self, features, graphs, pred_length: int, z0_noise: Optional[torch.Tensor] = None):
+        '''
+
+        :param features: preprocessed encoder features [K,N,T1,D]
+        :param graphs: preprocessed graphs [K,T1,N,N]
+        :param z0_noise: standard normal draws [K*N,D] for z0, None uses the posterior mean.
+        :return: normalized increments [K,N,pred_length,D_out]
+        '''
+        K, N, T1 = features.shape[0], features.shape[1], features.shape[2]
+        features = features.float()
+        graphs = graphs.float()
+        total = pred_length + T1
+        times = torch.arange(total, dtype = torch.float64, device = features.device) / total  # as load_test_data
+        times_observed = times[:T1]
+        time_steps = (times[T1:] - times[T1]).float()
+
+        x, edge_index, edge_weight, x_time, edge_time = self.encoder_graph(features, graphs, times_observed, 1. / T1)
+        group = torch.arange(K * N, device = features.device).repeat_interleave(T1)
+        mu, std = self.encoder(x, edge_index, edge_weight, x_time, edge_time, group, K * N)
+        if z0_noise is None:
+            first_point = mu
+        else:
+            first_point = z0_noise * std + mu
+
+        if self.augment_dim > 0:
+            first_point = torch.cat([first_point, torch.zeros((first_point.shape[0], self.augment_dim), dtype = first_point.dtype, device = first_point.device)], 1)
+        edge_initials = F.gelu(self.w_node_to_edge_initial(self.ode_func.edge_inputs(first_point)))
+        edge_initials = edge_initials.view(-1, edge_initials.shape[2])
+        K_N = K * N
+
+        sol = self.solve(torch.cat([first_point, edge_initials], 0), time_steps, K_N, first_point)  # [T,K*N+K*N*N,D]
+        sol_node = sol[:, :K_N, :].permute(1, 0, 2)  # [K*N,T,D]
+        if self.augment_dim > 0:
+            sol_node = sol_node[:, :, :-self.augment_dim]
+        pred_node = self.decoder_node(sol_node)
+        return pred_node.view(K, N, pred_length, -1)
+
+
+def export_model(model, args, path, transform_state = None):
+    '''
+    Script the model and save it with its configuration and fitted preprocessing as extra files.
+
+    :return: the scripted module
+    '''
+    scripted = torch.jit.script(ScriptCoupledODE(model, args))
+    config = {"num_atoms": args.num_atoms, "condition_length": args.condition_length, "pred_length": args.pred_length,
+              "features": args.features, "feature_out_index": list(args.feature_out_index), "solver": args.solver}
+    extra_files = {"config.json": json.dumps(config), "transform.json": json.dumps(transform_state)}
+    torch.jit.save(scripted, path, _extra_files = extra_files)
+    return scripted
+
+
+def load_exported(path, device = torch.device("cpu")):
+    '''
+    :return: scripted module, config dict, transform state dict (None if it was not stored)
+    '''
+    extra_files = {"config.json": "", "transform.json": ""}
+    module = torch.jit.load(path, map_location = device, _extra_files = extra_files)
+    return module, json.loads(extra_files["config.json"]), json.loads(extra_files["transform.json"])
+
+
+class ExportedForecaster(object):
+    '''
+    Raw conditioning windows -> cumulative forecasts with an exported module, as Forecaster.predict_windows
+    with z0 at the posterior mean (or given draws).
+    '''
+
+    def __init__(self, path, device = torch.device("cpu")):
+        self.device = device
+        self.module, self.config, transform_state = load_exported(path, device)
+        if transform_state is None:
+            raise ValueError(path + " was exported without its feature transform")
+        self.transform = FeatureTransform.from_state_dict(transform_state)
+
+    def predict(self, features, graphs, pred_length = None, z0_noise = None):
+        '''
+
+        :param features: raw [K,N,1+T1,D] (train.npy columns), the first day is the predecessor of the first increment
+        :param graphs: raw [K,1+T1,N,N]
+        :param z0_noise: standard normal draws [K*N,D_ode] for z0, None uses the posterior mean.
+        :return: cumulative predictions [K,N,pred_length,D_out]
+        '''
+        if pred_length is None:
+            pred_length = self.config["pred_length"]
+        windows = [self.transform.window(f, g) for f, g in zip(features, graphs)]
+        features_enc = torch.FloatTensor(np.stack([w[0] for w in windows])).to(self.device)
+        graphs_enc = torch.FloatTensor(np.stack([w[1] for w in windows])).to(self.device)
+        last_observed = np.stack([w[2] for w in windows])  # [K,N,D_out]
+        with torch.inference_mode():
+            increments = self.module(features_enc, graphs_enc, pred_length, z0_noise)
+        return self.transform.denormalize(increments.cpu().numpy(), last_observed)
+
+
+def parity_check(forecaster, scripted, start_dates, pred_length = None, seed = 0):
+    '''
+    Compare the scripted module with the eager Forecaster model on the same windows and z0 draws.
+
+    :return: dict with the max absolute / relative difference of the normalized increments
+    '''
+    from torch_geometric.data import Batch
+    import lib.utils as utils
+
+    if pred_length is None:
+        pred_length = forecaster.args.pred_length
+    T1 = forecaster.condition_length
+    windows = [forecaster.conditioning_window(utils.transfer_index(d)) for d in start_dates]
+    times = np.asarray([i / (pred_length + T1) for i in range(pred_length + T1)])
+    times_extrap = times[T1:] - times[T1]
+    data_list = [forecaster.dataloader.transfer_one_graph(features, graphs, times[:T1])[0] for features, graphs, _ in windows]
+    batch_en = Batch.from_data_list(data_list).to(forecaster.device)
+    batch_de = {"time_steps": torch.FloatTensor(times_extrap).to(forecaster.device)}
+
+    torch.manual_seed(seed)
+    with torch.inference_mode():
+        eager, _, _, _ = forecaster.model.get_reconstruction(batch_en, batch_de, forecaster.num_atoms,
+                                                             time_index = torch.arange(pred_length), decode_edge = False)
+    # Same draws as utils.sample_standard_gaussian (nothing else consumes random numbers in eval mode)
+    torch.manual_seed(seed)
+    noise = Normal(torch.Tensor([0.]), torch.Tensor([1.])).sample(eager.shape[:1] + (forecaster.args.ode_dims,)).squeeze(-1)
+
+    features = torch.FloatTensor(np.stack([w[0] for w in windows]))
+    graphs = torch.FloatTensor(np.stack([w[1] for w in windows]))
+    with torch.inference_mode():
+        scripted_out = scripted(features, graphs, pred_length, noise)
+
+    eager = eager.cpu().view(scripted_out.shape)
+    abs_diff = (eager - scripted_out).abs()
+    return {"max_abs_diff": float(abs_diff.max()), "max_rel_diff": float((abs_diff / eager.abs().clamp(min = 1e-6)).max()),
+            "max_abs_value": float(eager.abs().max())}
+
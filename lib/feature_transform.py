@@ -0,0 +1,139 @@
+'''
+Fitted covid feature / graph preprocessing, numpy only so that inference hosts can use it without
+the training dependencies (torch_geometric, scipy, pandas).
+'''
+import numpy as np
+
+
+weights = [10, 1, 10, 1, 1000, 1000000, 100000]
+CUMULATIVE_FEATURES = ["Confirmed", "Deaths", "Recovered", "Active"]
+
+
+class FeatureTransform(object):
+    '''
+    Fitted feature / graph preprocessing of a dataset: feature selection, null values and normalization.
+    state_dict() is a plain dict stored in checkpoints, so inference can transform raw windows and
+    denormalize outputs without feature_dict.txt, state_info.npy or the training arrays.
+    '''
+
+    def __init__(self, feature_names, feature_indices, scales, modes, population, graph_scale, feature_out_index):
+        '''
+
+        :param feature_indices: column of each selected feature in the raw features extended by Population / Mobility.
+        :param scales: normalization constant of each selected feature.
+        :param modes: "cumulative" (increments when is_inc), "const" (scaled as is) or "none" per selected feature.
+        :param population: [N] population per state, or None.
+        :param graph_scale: normalization constant of the mobility graphs.
+        '''
+        self.feature_names = list(feature_names)
+        self.feature_indices = list(feature_indices)
+        self.scales = list(scales)
+        self.modes = list(modes)
+        self.population = None if population is None else np.asarray(population)
+        self.graph_scale = graph_scale
+        self.feature_out_index = list(feature_out_index)
+
+    @classmethod
+    def fit(cls, args):
+        '''
+        Read feature_dict.txt (and state_info.npy when Population is selected) for the selected --features.
+        '''
+        feature_names = args.features.split(",")
+        assert len(weights) == len(feature_names)
+        f = open(args.datapath + "feature_dict.txt", 'r')
+        feature_dict = eval(f.read())
+        f.close()
+        modes = []
+        for each_feature in feature_names:
+            if each_feature in CUMULATIVE_FEATURES:
+                modes.append("cumulative")
+            elif each_feature != "Mortality_Rate":  # Mortality keep original
+                modes.append("const")
+            else:
+                modes.append("none")
+        population = None
+        if "Population" in feature_names:
+            population = np.reshape(np.load(args.datapath + "state_info.npy").astype("int"), (-1,))  # [N]
+        return cls(feature_names, [feature_dict[each_feature] for each_feature in feature_names], weights[:len(feature_names)],
+                   modes, population, weights[-1], args.feature_out_index)
+
+    def state_dict(self):
+        return {"feature_names": self.feature_names, "feature_indices": self.feature_indices, "scales": self.scales,
+                "modes": self.modes, "population": None if self.population is None else self.population.tolist(),
+                "graph_scale": self.graph_scale, "feature_out_index": self.feature_out_index}
+
+    @classmethod
+    def from_state_dict(cls, state):
+        return cls(**state)
+
+    def transform(self, feature_input, graph_input, method = 'norm_const', is_inc = True):
+        '''
+
+        :param feature_input: raw [N,T,D] (train.npy columns)
+        :param graph_input: raw [T,N,N]
+        :param method: log, norm_const or None
+        :param is_inc: daily increments of the cumulative features, the first day is 1.
+        :return: [N,T,D'] normalized selected features
+        '''
+        # Step1: Feature adding and selection.
+        if "Population" in self.feature_names:
+            population = np.zeros((feature_input.shape[0], feature_input.shape[1], 1))
+            population += np.reshape(self.population, (-1, 1, 1))  # [N,T,1]
+            feature_input = np.concatenate([feature_input, population], axis = 2)
+        if "Mobility" in self.feature_names:
+            mobility = np.transpose(np.diagonal(graph_input, axis1 = 1, axis2 = 2))[:, :, None]  # self-loop flows [N,T,1]
+            feature_input = np.concatenate([feature_input, mobility], axis = 2)
+        feature_input = feature_input[:, :, self.feature_indices]
+
+        # Step2: Null value preprocess
+        feature_input = np.where(feature_input <= -1, 0, feature_input)
+
+        # Step3: Feature Normalization
+        for i, mode in enumerate(self.modes):
+            if mode == "none":
+                continue
+            if mode == "cumulative" and is_inc:
+                one_feature = np.ones_like(feature_input[:, :, i])  # [N,T]
+                one_feature[:, 1:] = feature_input[:, 1:, i] - feature_input[:, :-1, i]
+            else:
+                one_feature = feature_input[:, :, i]
+            if method == "log":
+                one_feature = np.log(one_feature + 1)
+            elif method == 'norm_const':
+                one_feature = one_feature / self.scales[i]
+            feature_input[:, :, i] = one_feature
+
+        return feature_input
+
+    def transform_graphs(self, graph_input):
+        '''
+        Same as ParseData.graph_preprocessing(method = 'norm_const', is_self_loop = True).
+        '''
+        return graph_input / self.graph_scale
+
+    def window(self, features, graphs, skip = 1):
+        '''
+        Encoder inputs of raw days. The first `skip` days only serve as the predecessor of the first
+        increment and are dropped.
+
+        :param features: raw [N,skip+T1,D] (train.npy columns)
+        :param graphs: raw [skip+T1,N,N]
+        :return: encoder features [N,T1,D'], graphs [T1,N,N], last observed cumulative outputs [N,D_out] (normalized)
+        '''
+        features = np.asarray(features, dtype = np.float64)
+        graphs = np.asarray(graphs, dtype = np.float64)
+        features_inc = self.transform(features, graphs, is_inc = True)
+        features_cum = self.transform(features[:, -1:], graphs[-1:], is_inc = False)
+        return features_inc[:, skip:, :], self.transform_graphs(graphs)[skip:], features_cum[:, 0, self.feature_out_index]
+
+    def denormalize(self, pred_inc, last_observed):
+        '''
+        Cumulative counts from predicted normalized increments.
+
+        :param pred_inc: [...,T2,D_out] normalized increments of the feature_out_index features
+        :param last_observed: [...,D_out] normalized cumulative values (transform(..., is_inc = False)) of the last observed day
+        :return: [...,T2,D_out]
+        '''
+        scale = np.asarray([self.scales[i] for i in self.feature_out_index])
+        pred_cum = np.cumsum(np.asarray(pred_inc, dtype = np.float64), axis = -2) + np.expand_dims(last_observed, -2)
+        return pred_cum * scale
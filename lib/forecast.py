@@ -0,0 +1,332 @@
+'''
+Batch forecasting from a trained covid checkpoint, independent of the training script.
+
+Only the conditioning windows of the requested start dates are read (train.npy / test.npy are
+memory-mapped) and preprocessed with the FeatureTransform stored in the checkpoint. All start dates
+are encoded and integrated in one batch, and the predicted increments are turned back into
+cumulative counts per state and date.
+'''
+import os
+import numpy as np
+import pandas as pd
+import torch
+from torch.distributions.normal import Normal
+from torch_geometric.data import Batch
+import lib.utils as utils
+import lib.checkpoint as checkpoint
+from lib.load_data_covid import ParseData
+from lib.feature_transform import FeatureTransform
+from lib.create_coupled_ode_model import create_CoupledODE_model
+from lib.quantization import quantize_model
+from lib.forecast_cache import window_key
+
+
+COLUMNS = ["start_date", "date", "horizon", "state", "feature", "prediction"]
+DEFAULT_QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+
+
+def quantile_column(q):
+    return "q%g" % q
+
+
+def summarize_samples(samples, quantiles = DEFAULT_QUANTILES):
+    '''
+    Mean and quantiles over Monte-Carlo forecasts.
+
+    :param samples: [S,...] cumulative predictions of S z0 draws
+    :return: mean [...], quantiles [Q,...]
+    '''
+    return samples.mean(axis = 0), np.quantile(samples, quantiles, axis = 0)
+
+
+def stack_windows(predictions, num_samples = 1):
+    '''
+    Batch per-window predictions [N,T2,D_out] ([S,N,T2,D_out]) into [K,N,T2,D_out] ([S,K,N,T2,D_out]).
+    '''
+    return np.stack(predictions, axis = 0 if num_samples == 1 else 1)
+
+
+def load_checkpoint_model(ckpt_path, device, input_dim = None):
+    '''
+    Rebuild the model from the args stored in a checkpoint.
+
+    :return: model in eval mode, checkpoint args, FeatureTransform state (None for older checkpoints)
+    '''
+    if not os.path.exists(ckpt_path):
+        raise Exception("Checkpoint " + ckpt_path + " does not exist.")
+    checkpt = checkpoint.load_file(ckpt_path)
+    args = checkpt['args']
+    if input_dim is None:
+        input_dim = len(args.features.split(","))
+    obsrv_std = torch.Tensor([0.01]).to(device)
+    z0_prior = Normal(torch.Tensor([0.0]).to(device), torch.Tensor([1.]).to(device))
+    model = create_CoupledODE_model(args, input_dim, z0_prior, obsrv_std, device)
+    model.load_state_dict(checkpt['state_dict'])
+    model.to(device)
+    model.eval()
+    return model, args, checkpt.get('transform')
+
+
+def write_table(df, path):
+    '''
+    Write a forecast table, as Parquet for a .parquet path and CSV otherwise.
+    '''
+    if path.endswith(".parquet"):
+        df.to_parquet(path, index = False)  # needs pyarrow or fastparquet
+    else:
+        df.to_csv(path, index = False)
+
+
+class Forecaster(object):
+    '''
+    Keeps a checkpoint's model and the memory-mapped raw dataset to answer forecast requests.
+    Raw conditioning windows (preprocess_window) only need the checkpoint.
+    '''
+
+    def __init__(self, ckpt_path, device = torch.device("cpu"), datapath = None, dataset = None, seed = None, quantize = False,
+                 cache = None):
+        '''
+
+        :param quantize: dynamic int8 quantization of the linear layers (lib.quantization), CPU only.
+        :param cache: lib.forecast_cache.ForecastCache of per-window predictions, None disables caching.
+        '''
+        self.device = device
+        self.ckpt_path = ckpt_path
+        self.quantize = quantize
+        self.cache = cache
+        self.ckpt_hash = None
+        self.model, self.args, transform_state = load_checkpoint_model(ckpt_path, device)
+        if quantize:
+            if device.type != "cpu":
+                raise ValueError("Dynamic int8 quantization runs on CPU only")
+            self.model = quantize_model(self.model)
+        args = self.args
+        if datapath is not None:
+            args.datapath = datapath
+        if dataset is not None:
+            args.dataset = dataset
+        if seed is not None:
+            args.random_seed = seed
+        self.condition_length = args.condition_length
+        self.num_atoms = args.num_atoms
+        self.feature_names = args.features.split(",")
+        self.feature_out = [self.feature_names[i] for i in args.feature_out_index]
+
+        # transfer_one_graph only, no data is loaded by the constructor.
+        self.dataloader = ParseData(args = args)
+        if transform_state is not None:
+            self.transform = FeatureTransform.from_state_dict(transform_state)
+        else:  # checkpoints saved before the transform was stored
+            self.transform = FeatureTransform.fit(args)
+
+        self.num_states = self.num_atoms
+        self.features, self.graphs = None, None
+        self.num_days = 0
+        path = args.datapath + args.dataset
+        if os.path.exists(path + '/train.npy'):
+            self.features = [np.load(path + '/train.npy', mmap_mode = 'r'), np.load(path + '/test.npy', mmap_mode = 'r')]  # [N,T,D]
+            self.graphs = [np.load(path + '/graph_train.npy', mmap_mode = 'r'), np.load(path + '/graph_test.npy', mmap_mode = 'r')]  # [T,N,N]
+            self.num_days = sum(f.shape[1] for f in self.features)
+            if self.features[0].shape[0] != self.num_atoms:
+                raise ValueError("Checkpoint was trained on %d states, dataset has %d" % (self.num_atoms, self.features[0].shape[0]))
+        self.state_names = self.load_state_names(args.datapath)
+
+    def load_state_names(self, datapath):
+        state_dict_path = datapath + "state_dict.txt"
+        if os.path.exists(state_dict_path):
+            with open(state_dict_path, 'r') as f:
+                state_dict = eval(f.read())
+            if len(state_dict) == self.num_states:
+                names = [None] * self.num_states
+                for name, index in state_dict.items():
+                    names[index] = name
+                return names
+        return [str(i) for i in range(self.num_states)]
+
+    def raw_days(self, start, end):
+        '''
+        Raw features [N,end-start,D] and graphs [end-start,N,N] of days [start, end) across train/test.
+        '''
+        features, graphs = [], []
+        offset = 0
+        for feature_part, graph_part in zip(self.features, self.graphs):
+            length = feature_part.shape[1]
+            lo, hi = max(start - offset, 0), min(end - offset, length)
+            if lo < hi:
+                features.append(np.asarray(feature_part[:, lo:hi, :], dtype = np.float64))
+                graphs.append(np.asarray(graph_part[lo:hi, :, :], dtype = np.float64))
+            offset += length
+        return np.concatenate(features, axis = 1), np.concatenate(graphs, axis = 0)
+
+    def preprocess_window(self, features, graphs, skip = 1):
+        '''
+        Preprocess raw days of the dataset layout. The first `skip` days only serve as the predecessor
+        of the first increment and are dropped.
+
+        :param features: raw [N,skip+T1,D] (train.npy columns)
+        :param graphs: raw [skip+T1,N,N]
+        :return: encoder features [N,T1,D], graphs [T1,N,N], last observed cumulative outputs [N,D_out] (normalized)
+        '''
+        features = np.asarray(features, dtype = np.float64)
+        graphs = np.asarray(graphs, dtype = np.float64)
+        T1 = self.condition_length
+        if features.shape[0] != self.num_states or features.shape[1] != skip + T1 or graphs.shape != (skip + T1, self.num_states, self.num_states):
+            raise ValueError("Expected features [%d,%d,D] and graphs [%d,%d,%d], got %s and %s" % (
+                self.num_states, skip + T1, skip + T1, self.num_states, self.num_states, list(features.shape), list(graphs.shape)))
+        return self.transform.window(features, graphs, skip)
+
+    def conditioning_window(self, start_index):
+        '''
+        Preprocess the T1 days before start_index exactly as load_test_data does on the whole series.
+
+        :param start_index: day index of the first forecast day
+        :return: see preprocess_window
+        '''
+        if self.features is None:
+            raise ValueError("No dataset at %s, send raw conditioning windows instead of start dates" % (self.args.datapath + self.args.dataset))
+        T1 = self.condition_length
+        first = start_index - T1
+        if first < 0 or start_index > self.num_days:
+            raise ValueError("Forecast start %s needs days %s to %s, the dataset covers %s to %s" % (
+                utils.transfer_date(start_index), utils.transfer_date(first), utils.transfer_date(start_index - 1),
+                utils.transfer_date(0), utils.transfer_date(self.num_days - 1)))
+
+        # One extra day for the first increment (the first day of the series has no predecessor).
+        lo = max(first - 1, 0)
+        features, graphs = self.raw_days(lo, start_index)
+        return self.preprocess_window(features, graphs, skip = first - lo)
+
+    def batch_windows(self, windows, pred_length):
+        '''
+        Encoder graph batch and decoder time steps of preprocessed windows.
+
+        :param windows: list of preprocess_window outputs.
+        :return: batch_en, batch_de, last observed cumulative values [K,N,D_out]
+        '''
+        T1 = self.condition_length
+        times = np.asarray([i / (pred_length + T1) for i in range(pred_length + T1)])  # as in load_test_data
+        times_observed = times[:T1]
+        times_extrap = times[T1:] - times[T1]
+
+        data_list = [self.dataloader.transfer_one_graph(features, graphs, times_observed)[0] for features, graphs, _ in windows]
+        last_observed = np.stack([last for _, _, last in windows])  # [K,N,D_out]
+
+        batch_en = Batch.from_data_list(data_list).to(self.device)
+        batch_de = {"time_steps": torch.FloatTensor(times_extrap).to(self.device)}
+        return batch_en, batch_de, last_observed
+
+    def run_model(self, batch_en, batch_de, pred_length, num_samples = 1):
+        '''
+        :param num_samples: z0 draws per state, solved together in one batch of S*K windows.
+        :return: normalized increments [K,N,pred_length,D_out], [S,K,N,pred_length,D_out] for num_samples > 1
+        '''
+        time_index = torch.arange(pred_length, device = self.device)
+        with torch.inference_mode():
+            pred_node, _, _, _ = self.model.get_reconstruction(batch_en, batch_de, self.num_atoms, time_index = time_index,
+                                                               decode_edge = False, num_samples = num_samples)  # [(S,)K*N,T2,D_out]
+            pred_node = pred_node.cpu().numpy()
+        shape = (self.num_atoms, pred_length, pred_node.shape[-1])
+        if num_samples > 1:
+            return pred_node.reshape((num_samples, -1) + shape)  # [S,K,N,T2,D_out]
+        return pred_node.reshape((-1,) + shape)  # [K,N,T2,D_out]
+
+    def model_key(self):
+        '''
+        Identity of the model answering forecasts: checkpoint file hash, inference variant and z0 sampling seed.
+        '''
+        if self.ckpt_hash is None:
+            self.ckpt_hash = checkpoint.file_hash(self.ckpt_path)
+        return "%s|int8=%d|bf16=%d|seed=%d" % (self.ckpt_hash, self.quantize, getattr(self.model, "bf16", False), self.args.random_seed)
+
+    def lookup(self, windows, pred_length, num_samples = 1):
+        '''
+        :return: cache keys of the windows, cached predictions of each window (None for misses)
+        '''
+        model_key = self.model_key()
+        keys = [window_key(model_key, window, pred_length, num_samples) for window in windows]
+        return keys, [self.cache.get(key) for key in keys]
+
+    def store(self, keys, predictions, num_samples = 1):
+        '''
+        :param predictions: [K,N,T2,D_out] ([S,K,N,T2,D_out]) of the windows of keys.
+        '''
+        for i, key in enumerate(keys):
+            self.cache.put(key, predictions[i] if num_samples == 1 else predictions[:, i])
+
+    def predict_windows(self, windows, pred_length = None, num_samples = 1, use_cache = True):
+        '''
+        Run preprocessed windows through the encoder and ODE in one batch.
+        With a cache, only the windows without a cached forecast are run.
+
+        :param windows: list of preprocess_window outputs.
+        :param pred_length: forecast days, defaults to the training pred_length.
+        :param num_samples: z0 draws per state (one encoder pass, one ODE solve of S*K windows).
+        :return: cumulative predictions [K,N,pred_length,D_out], [S,K,N,pred_length,D_out] for num_samples > 1
+        '''
+        if pred_length is None:
+            pred_length = self.args.pred_length
+        if self.cache is None or not use_cache:
+            batch_en, batch_de, last_observed = self.batch_windows(windows, pred_length)
+            pred_node = self.run_model(batch_en, batch_de, pred_length, num_samples)
+            return self.transform.denormalize(pred_node, last_observed)
+
+        keys, predictions = self.lookup(windows, pred_length, num_samples)
+        missing = [i for i, prediction in enumerate(predictions) if prediction is None]
+        if len(missing) > 0:
+            computed = self.predict_windows([windows[i] for i in missing], pred_length, num_samples, use_cache = False)
+            self.store([keys[i] for i in missing], computed, num_samples)
+            for j, i in enumerate(missing):
+                predictions[i] = computed[j] if num_samples == 1 else computed[:, j]
+        return stack_windows(predictions, num_samples)
+
+    def predict(self, start_dates, pred_length = None, num_samples = 1):
+        '''
+        Forecast every start date in one encoder + ODE call.
+
+        :param start_dates: list of "YYYY-MM-DD", first forecast day of each window.
+        :return: cumulative predictions [K,N,pred_length,D_out], [S,K,N,pred_length,D_out] for num_samples > 1
+        '''
+        windows = [self.conditioning_window(utils.transfer_index(d)) for d in start_dates]
+        return self.predict_windows(windows, pred_length, num_samples)
+
+    def to_frame(self, start_dates, predictions, quantiles = DEFAULT_QUANTILES):
+        '''
+        Long table with one row per start date, state, forecast date and output feature.
+
+        :param predictions: [K,N,T2,D_out], or samples [S,K,N,T2,D_out]: the prediction is then the sample mean,
+            with one column per quantile (q0.05, ...).
+        '''
+        columns = list(COLUMNS)
+        quantile_values = None
+        if predictions.ndim == 5:
+            predictions, quantile_values = summarize_samples(predictions, quantiles)
+            columns += [quantile_column(q) for q in quantiles]
+        K, N, T2, D = predictions.shape
+        start_indexes = np.asarray([utils.transfer_index(d) for d in start_dates])
+        k, n, t, d = [a.ravel() for a in np.meshgrid(np.arange(K), np.arange(N), np.arange(T2), np.arange(D), indexing = 'ij')]
+        data = {
+            "start_date": np.asarray(start_dates)[k],
+            "date": [utils.transfer_date(i) for i in start_indexes[k] + t],
+            "horizon": t + 1,
+            "state": np.asarray(self.state_names)[n],
+            "feature": np.asarray(self.feature_out)[d],
+            "prediction": predictions.ravel(),
+        }
+        if quantile_values is not None:
+            for q, values in zip(quantiles, quantile_values):
+                data[quantile_column(q)] = values.ravel()
+        return pd.DataFrame(data, columns = columns)
+
+    def forecast(self, start_dates, pred_length = None, batch_size = None, num_samples = 1, quantiles = DEFAULT_QUANTILES):
+        '''
+        :param batch_size: start dates per model call, all of them by default.
+        :param num_samples: z0 draws per state; above 1 the table has the sample mean and quantile columns.
+        :return: DataFrame with COLUMNS (and the quantile columns)
+        '''
+        if batch_size is None:
+            batch_size = max(len(start_dates), 1)
+        frames = []
+        for i in range(0, len(start_dates), batch_size):
+            chunk = list(start_dates[i:i + batch_size])
+            frames.append(self.to_frame(chunk, self.predict(chunk, pred_length, num_samples), quantiles))
+        return pd.concat(frames, ignore_index = True)
@@ -0,0 +1,126 @@
+'''
+Cache of forecasts in front of Forecaster.predict_windows.
+
+Entries hold the cumulative predictions of one conditioning window, keyed by the checkpoint
+(file hash, model variant and z0 seed), a hash of the preprocessed window tensors (encoder features,
+graphs, last observed values), the horizon and the number of z0 draws. The memory tier is an LRU
+bounded in bytes. The optional disk tier keeps every entry as a .npy file (written through on
+insert), so forecasts survive restarts and are shared between processes on the same directory.
+
+A hit returns the stored z0 draw(s): repeated queries get identical answers instead of new samples.
+'''
+import os
+import hashlib
+import tempfile
+import threading
+import collections
+import numpy as np
+
+
+def window_key(model_key, window, pred_length, num_samples = 1):
+    '''
+    :param model_key: checkpoint identity, Forecaster.model_key()
+    :param window: preprocess_window output (features [N,T1,D], graphs [T1,N,N], last observed [N,D_out])
+    :return: hex digest
+    '''
+    digest = hashlib.sha256()
+    digest.update(("%s|%d|%d" % (model_key, pred_length, num_samples)).encode())
+    for array in window:
+        array = np.ascontiguousarray(array, dtype = np.float64)
+        digest.update(str(array.shape).encode())
+        digest.update(array.data)
+    return digest.hexdigest()
+
+
+class ForecastCache(object):
+    '''
+    LRU of forecast arrays with a byte budget and an optional write-through directory. Thread-safe.
+    '''
+
+    def __init__(self, max_bytes = 256 * 1024 * 1024, directory = None):
+        '''
+
+        :param max_bytes: budget of the memory tier (array bytes), 0 keeps nothing in memory.
+        :param directory: disk tier, None disables it.
+        '''
+        self.max_bytes = max_bytes
+        self.directory = directory
+        if directory is not None:
+            os.makedirs(directory, exist_ok = True)
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()  # key -> array, least recently used first
+        self.bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".npy")
+
+    def _insert(self, key, value):
+        # Caller holds the lock.
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return
+        if value.nbytes > self.max_bytes:
+            return
+        self.entries[key] = value
+        self.bytes += value.nbytes
+        while self.bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last = False)
+            self.bytes -= evicted.nbytes
+            self.evictions += 1
+
+    def get(self, key):
+        '''
+        :return: cached array (read-only) or None
+        '''
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+        if self.directory is not None and os.path.exists(self._path(key)):
+            try:
+                value = np.load(self._path(key))
+            except (OSError, ValueError):  # partially written by another process
+                value = None
+            if value is not None:
+                value.setflags(write = False)
+                with self.lock:
+                    self._insert(key, value)
+                    self.disk_hits += 1
+                return value
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, value):
+        value = np.array(value, copy = True)
+        value.setflags(write = False)
+        with self.lock:
+            self._insert(key, value)
+        if self.directory is not None and not os.path.exists(self._path(key)):
+            # Write to a temporary file and rename, readers never see partial files.
+            fd, tmp_path = tempfile.mkstemp(dir = self.directory, suffix = ".tmp")
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, value)
+            os.replace(tmp_path, self._path(key))
+
+    def clear(self):
+        '''
+        Empty the memory tier, the disk tier is kept.
+        '''
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def snapshot(self):
+        with self.lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {"entries": len(self.entries), "bytes": self.bytes, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses, "evictions": self.evictions,
+                    "hit_rate": (self.hits + self.disk_hits) / lookups if lookups > 0 else None,
+                    "directory": self.directory}
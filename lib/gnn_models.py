@@ -279,38 +279,49 @@ class GNN(nn.Module):
 
     def forward(self, x, edge_weight=None, edge_index=None, x_time=None, edge_time=None,batch= None, batch_y = None):  #aggregation part
 
-        if not self.is_encoder: #Encoder initial input node feature
-            h_t = self.drop(x)
-        else:
-            h_t = self.drop(F.gelu(self.adapt_w(x)))  #initial input for encoder
-
+        h_t = self.input_layer(x)
 
         for gc in self.gcs:
             h_t = gc(h_t, edge_index, edge_weight, x_time,edge_time)  #[num_nodes,d]
 
         ### Output
         if batch!= None:  ## for encoder
-            batch_new = self.rewrite_batch(batch,batch_y) #group by balls
-
-            h_t += self.temporal_net(x_time)
-            attention_vector = F.gelu(
-                self.sequence_w(global_mean_pool(h_t, batch_new)))  # [num_ball,d] ,graph vector with activation Relu
-            attention_vector_expanded = self.attention_expand(attention_vector, batch, batch_y)  # [num_nodes,d]
-            attention_nodes = torch.sigmoid(
-                torch.squeeze(torch.bmm(torch.unsqueeze(attention_vector_expanded, 1), torch.unsqueeze(h_t, 2)))).view(
-                -1, 1)  # [num_nodes]
-            nodes_attention = attention_nodes * h_t  # [num_nodes,d]
-            h_ball = global_mean_pool(nodes_attention, batch_new)  # [num_ball,d] without activation
-
-            h_out = self.hidden_to_z0(h_ball) #[num_ball,2*z_dim] Must ganrantee NO 0 ENTRIES!
-            mean,mu = self.split_mean_mu(h_out)
-            mu = mu.abs()
-            return mean,mu
+            return self.readout(h_t, x_time, batch, batch_y)
 
         else:  # for ODE
             h_out = h_t
             return h_out
 
+    def input_layer(self, x):
+        if not self.is_encoder: #Encoder initial input node feature
+            return self.drop(x)
+        else:
+            return self.drop(F.gelu(self.adapt_w(x)))  #initial input for encoder
+
+    def readout(self, h_t, x_time, batch, batch_y):
+        '''
+        Encoder output: temporal self-attention pooling of the node states of each state (ball).
+
+        :param h_t: [num_nodes,d] output of the last layer, not modified.
+        :return: mean, std of z0 [num_ball,out_dim]
+        '''
+        batch_new = self.rewrite_batch(batch,batch_y) #group by balls
+
+        h_t = h_t + self.temporal_net(x_time)
+        attention_vector = F.gelu(
+            self.sequence_w(global_mean_pool(h_t, batch_new)))  # [num_ball,d] ,graph vector with activation Relu
+        attention_vector_expanded = self.attention_expand(attention_vector, batch, batch_y)  # [num_nodes,d]
+        attention_nodes = torch.sigmoid(
+            torch.squeeze(torch.bmm(torch.unsqueeze(attention_vector_expanded, 1), torch.unsqueeze(h_t, 2)))).view(
+            -1, 1)  # [num_nodes]
+        nodes_attention = attention_nodes * h_t  # [num_nodes,d]
+        h_ball = global_mean_pool(nodes_attention, batch_new)  # [num_ball,d] without activation
+
+        h_out = self.hidden_to_z0(h_ball) #[num_ball,2*z_dim] Must ganrantee NO 0 ENTRIES!
+        mean,mu = self.split_mean_mu(h_out)
+        mu = mu.abs()
+        return mean,mu
+
     def rewrite_batch(self,batch, batch_y):
         assert (torch.sum(batch_y).item() == list(batch.size())[0])
         batch_new = torch.zeros_like(batch)
@@ -0,0 +1,200 @@
+'''
+Opt-in per-batch instrumentation of the CG-ODE pipeline.
+
+Stages: encoder, edge_init, ode_forward, ode_backward (adjoint solve), decoder, loss, backward (everything
+of loss.backward(), ode_backward included) and optimizer. Together with forward/backward NFE and the
+batch dimensions (K, N, T1, T2) they are summarized per epoch as one JSON line.
+When disabled, stage() returns a shared no-op context manager and nothing else is recorded.
+Listeners (see add_listener, used by lib.memory) are notified around every stage, inside or outside batches.
+'''
+import json
+import time
+import torch
+
+
+class _NoOp(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOOP = _NoOp()
+
+
+class Recorder(object):
+
+    def __init__(self, path, sync_cuda = True):
+        self.path = path
+        self.sync_cuda = sync_cuda and torch.cuda.is_available()
+        self.batch = None
+        self.batches = []
+
+    def now(self):
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def add(self, stage, seconds):
+        if self.batch is not None:
+            self.batch["stages"][stage] = self.batch["stages"].get(stage, 0.) + seconds
+
+    def set(self, key, value):
+        if self.batch is not None:
+            self.batch[key] = value
+
+
+class _Stage(object):
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = start(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        stop(self.name, self.start)
+        return False
+
+
+_recorder = None
+_listeners = []
+
+
+def enable(path, sync_cuda = True):
+    '''
+    :param path: JSON-lines file, one summary per epoch is appended.
+    '''
+    global _recorder
+    _recorder = Recorder(path, sync_cuda)
+
+
+def disable():
+    global _recorder
+    _recorder = None
+
+
+def is_enabled():
+    return _recorder is not None
+
+
+def add_listener(listener):
+    '''
+    :param listener: object with enter(name) and exit(name), called around every stage.
+    '''
+    if listener not in _listeners:
+        _listeners.append(listener)
+
+
+def remove_listener(listener):
+    if listener in _listeners:
+        _listeners.remove(listener)
+
+
+def stage(name):
+    '''
+    Context manager timing one stage of the current batch.
+    '''
+    if _recorder is None and len(_listeners) == 0:
+        return _NOOP
+    return _Stage(name)
+
+
+def start(name):
+    '''
+    For regions too long for a with-block: t = start(name) ... stop(name, t).
+    '''
+    if _recorder is None and len(_listeners) == 0:
+        return None
+    for listener in _listeners:
+        listener.enter(name)
+    return _recorder.now() if _recorder is not None else 0.
+
+
+def stop(name, start_time):
+    if start_time is None:
+        return
+    if _recorder is not None:
+        _recorder.add(name, _recorder.now() - start_time)
+    for listener in reversed(_listeners):
+        listener.exit(name)
+
+
+def set_value(key, value):
+    if _recorder is not None:
+        _recorder.set(key, value)
+
+
+def begin_batch():
+    '''
+    Only stages between begin_batch() and end_batch() are recorded (training batches).
+    '''
+    if _recorder is not None:
+        _recorder.batch = {"stages": {}}
+
+
+def end_batch():
+    if _recorder is not None and _recorder.batch is not None:
+        _recorder.batches.append(_recorder.batch)
+        _recorder.batch = None
+
+
+def register_solver_hooks(initial_state, solution, ode_func):
+    '''
+    Time the adjoint solve and count its function evaluations.
+    The gradient reaching the odeint output starts the adjoint solve; the gradient of the initial
+    state is computed when it ends (its hook can fire once per adjoint step, the last one counts).
+    :param initial_state: y0 passed to odeint
+    :param solution: raw odeint output
+    '''
+    if _recorder is None or _recorder.batch is None or not solution.requires_grad:
+        return
+    recorder = _recorder
+    marks = {}
+
+    def adjoint_start(grad):
+        marks["last"] = recorder.now()
+        marks["nfe"] = ode_func.nfe
+
+    def adjoint_end(grad):
+        if "last" in marks:
+            now = recorder.now()
+            recorder.add("ode_backward", now - marks["last"])
+            marks["last"] = now
+            recorder.set("nfe_backward", ode_func.nfe - marks["nfe"])
+
+    solution.register_hook(adjoint_start)
+    if initial_state.requires_grad:
+        initial_state.register_hook(adjoint_end)
+
+
+def write_epoch(epoch):
+    '''
+    Append the summary of the batches recorded since the last call.
+    :return: the summary dict, None when disabled.
+    '''
+    if _recorder is None:
+        return None
+    batches = _recorder.batches
+    _recorder.batches = []
+
+    summary = {"epoch": epoch, "num_batches": len(batches), "stages": {}}
+    names = sorted(set(name for b in batches for name in b["stages"]))
+    for name in names:
+        values = [b["stages"].get(name, 0.) for b in batches]
+        summary["stages"][name] = {"total_s": sum(values), "mean_s": sum(values) / len(values), "max_s": max(values)}
+    # ode_backward is part of backward
+    summary["batch_total_s"] = sum(sum(v for name, v in b["stages"].items() if name != "ode_backward") for b in batches)
+
+    for key in ["nfe_forward", "nfe_backward", "K", "N", "T1", "T2"]:
+        values = [b[key] for b in batches if key in b]
+        if len(values) > 0:
+            summary[key + "_mean"] = sum(values) / len(values)
+            summary[key + "_max"] = max(values)
+
+    with open(_recorder.path, "a") as f:
+        f.write(json.dumps(summary) + "\n")
+
+    return summary
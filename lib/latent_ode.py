@@ -2,11 +2,12 @@ from lib.base_models import VAE_Baseline
 import torch
 import numpy as np
 import lib.utils as utils
+import lib.instrumentation as instrumentation
 import torch.nn.functional as F
 
 class CoupledODE(VAE_Baseline):
 	def __init__(self, w_node_to_edge_initial,ode_hidden_dim, encoder_z0, decoder_node,decoder_edge, diffeq_solver,
-				 z0_prior, device, obsrv_std=None):
+				 z0_prior, device, obsrv_std=None, bf16=False):
 
 		super(CoupledODE, self).__init__(z0_prior = z0_prior, device = device, obsrv_std = obsrv_std)
 
@@ -15,6 +16,7 @@ class CoupledODE(VAE_Baseline):
 		self.decoder_node = decoder_node
 		self.decoder_edge = decoder_edge
 		self.ode_hidden_dim =ode_hidden_dim
+		self.bf16 = bf16 # decoders under bfloat16 autocast, outputs (and losses) in float32
 
 
 		# Shared with edge ODE
@@ -22,20 +24,50 @@ class CoupledODE(VAE_Baseline):
 
 
 
-	def get_reconstruction(self, batch_en,batch_de,num_atoms):
+	def set_bf16(self, enabled):
+		'''
+		Switch bfloat16 autocast of the ODE function and decoders on or off.
+		'''
+		self.bf16 = enabled
+		self.diffeq_solver.ode_func.bf16 = enabled
+
+
+	def get_reconstruction(self, batch_en,batch_de,num_atoms,time_index=None,decode_edge=True,num_samples=1,first_point=None):
+		'''
+
+		:param time_index: [T'] LongTensor, timestamps to decode. None decodes every timestamp of batch_de["time_steps"].
+		:param decode_edge: False skips the edge decoder, pred_edge is then None.
+		:param num_samples: S z0 draws per state from one encoder pass. The draws are stacked along the batch
+			(sample s of graph k is graph s*K + k) and integrated in one ODE solve of S*K graphs.
+		:param first_point: (mu, std) [K*N,D] of an earlier encoder pass (lib.rolling); the encoder is skipped and batch_en is unused.
+		:return: pred_node [K*N,T',D], pred_edge [K*N*N,T',1]; [S,K*N,T',D] and [S,K*N*N,T',1] for num_samples > 1
+		'''
 
         #Encoder:
-		first_point_mu, first_point_std = self.encoder_z0(batch_en.x, batch_en.edge_weight,
-														  batch_en.edge_index, batch_en.pos, batch_en.edge_time,
-														  batch_en.batch, batch_en.y)  # [K*N,D]
+		with instrumentation.stage("encoder"):
+			if first_point is None:
+				first_point_mu, first_point_std = self.encoder_z0(batch_en.x, batch_en.edge_weight,
+																  batch_en.edge_index, batch_en.pos, batch_en.edge_time,
+																  batch_en.batch, batch_en.y)  # [K*N,D]
+			else:
+				first_point_mu, first_point_std = first_point
 
-		first_point_enc = utils.sample_standard_gaussian(first_point_mu, first_point_std) #[K*N,D]
+			if num_samples > 1:
+				first_point_enc = utils.sample_standard_gaussian(first_point_mu.repeat(num_samples, 1),
+																 first_point_std.repeat(num_samples, 1)) #[S*K*N,D]
+			else:
+				first_point_enc = utils.sample_standard_gaussian(first_point_mu, first_point_std) #[K*N,D]
+		if instrumentation.is_enabled() and first_point is None:
+			instrumentation.set_value("T1", int(batch_en.y[0].item()))
 
 
 
 		first_point_std = first_point_std.abs()
 
 		time_steps_to_predict = batch_de["time_steps"]
+		if time_index is not None:
+			# Only integrate up to the last requested timestamp. Truncation keeps the time grid (and fixed-step solutions) unchanged.
+			time_steps_to_predict = time_steps_to_predict[:int(torch.max(time_index).item()) + 1]
 
 
 		assert (torch.sum(first_point_std < 0) == 0.)
@@ -53,9 +85,28 @@ class CoupledODE(VAE_Baseline):
 
 		assert(not torch.isnan(sol_y).any())
 
-        # Decoder:
-		pred_node = self.decoder_node(sol_y[:K_N,:,:])
-		pred_edge = self.decoder_edge(sol_y[K_N:, :, :])
+        # Decoder: only at requested timestamps
+		decoder_start = instrumentation.start("decoder")
+		if time_index is not None:
+			sol_node = sol_y[:K_N,time_index,:]
+		else:
+			sol_node = sol_y[:K_N,:,:]
+		with utils.autocast(sol_y.device, self.bf16):
+			pred_node = self.decoder_node(sol_node).to(sol_y.dtype)
+
+			pred_edge = None
+			if decode_edge:
+				if time_index is not None:
+					pred_edge = self.decoder_edge(sol_y[K_N:, time_index, :]).to(sol_y.dtype)
+				else:
+					pred_edge = self.decoder_edge(sol_y[K_N:, :, :]).to(sol_y.dtype)
+		instrumentation.stop("decoder", decoder_start)
+
+		if num_samples > 1:
+			pred_node = pred_node.view((num_samples, -1) + pred_node.shape[1:]) #[S,K*N,T',D]
+			if pred_edge is not None:
+				pred_edge = pred_edge.view((num_samples, -1) + pred_edge.shape[1:]) #[S,K*N*N,T',1]
+			first_point_enc = first_point_enc.view(num_samples, -1, first_point_enc.shape[-1]) #[S,K*N,D]
 
 
 		all_extra_info = {
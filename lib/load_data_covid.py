@@ -6,11 +6,11 @@ from tqdm import tqdm
 import math
 from scipy.linalg import block_diag
 import lib.utils as utils
+from lib.distributed import shard_indices, get_world_size
 import pandas as pd
+from lib.feature_transform import FeatureTransform, weights
 
 
-weights = [10, 1, 10, 1, 1000, 1000000, 100000]
-
 class ParseData(object):
 
     def __init__(self,args):
@@ -21,6 +21,7 @@ class ParseData(object):
         self.pred_length = args.pred_length
         self.condition_length = args.condition_length
         self.batch_size = args.batch_size
+        self.transform = None
 
         torch.manual_seed(self.random_seed)
         np.random.seed(self.random_seed)
@@ -46,22 +47,28 @@ class ParseData(object):
         # Split Training Samples
         features, graphs = self.generateTrainSamples(features, graphs) #[K,N,T,D], [K,T,N,N]
 
+        window_index = None
         if is_train:
             features = features[:-5, :, :, :]
             graphs = graphs[:-5, :, :, :]
+            # Data-parallel training: each rank only keeps its shard of the training windows.
+            if get_world_size(self.args) > 1:
+                window_index = shard_indices(features.shape[0], self.args.rank, get_world_size(self.args))
+                features = features[window_index]
+                graphs = graphs[window_index]
         else:
             features = features[-5:, :, :, :]
             graphs = graphs[-5:, :, :, :]
 
 
 
-        encoder_data_loader, decoder_data_loader, decoder_graph_loader, num_batch, self.num_states = self.generate_train_val_dataloader(features, graphs, is_train)
+        encoder_data_loader, decoder_data_loader, decoder_graph_loader, num_batch, self.num_states = self.generate_train_val_dataloader(features, graphs, is_train, window_index)
 
 
         return encoder_data_loader, decoder_data_loader, decoder_graph_loader, num_batch, self.num_states
 
 
-    def generate_train_val_dataloader(self, features, graphs, is_train = True):
+    def generate_train_val_dataloader(self, features, graphs, is_train = True, window_index = None):
         # Split data for encoder and decoder dataloader
         feature_observed, times_observed, series_decoder, times_extrap = self.split_data(features)  # series_decoder[K*N,T2,D]
         self.times_extrap = times_extrap
@@ -72,6 +79,9 @@ class ParseData(object):
         # Generate Decoder Data and Graph
         if is_train:
             series_decoder_gt = self.decoder_gt_train()  # [K*N,T2,D]
+            if window_index is not None:
+                series_decoder_gt = np.reshape(series_decoder_gt, (-1, self.num_states) + series_decoder_gt.shape[1:])[window_index]  # [K',N,T2,D]
+                series_decoder_gt = np.reshape(series_decoder_gt, (-1,) + series_decoder_gt.shape[2:])  # [K'*N,T2,D]
         else:
             series_decoder_gt = self.decoder_gt_train()  # [K*N,T2,D]
             series_decoder_gt = series_decoder_gt[-5*self.num_states:,:,:]
@@ -98,25 +108,36 @@ class ParseData(object):
 
 
 
-    def load_test_data(self, pred_length, condition_length):
+    def load_test_arrays(self):
+        '''
+        Preprocessed train + test days.
 
-        # Loading Data. N is state number, T is number of days. D is feature number.
-        print("predicting data at: %s" % self.args.dataset)
+        :return: features [N,T,D] (increments), graphs [T,N,N], features_origin [N,T,D] (cumulative, for the MAPE denominator)
+        '''
         features_1 = np.load(self.args.datapath + self.args.dataset + '/train.npy')  # [N,T,D]
         graphs_1 = np.load(self.args.datapath + self.args.dataset + '/graph_train.npy')  # [T,N,N]
         features_2 = np.load(self.args.datapath + self.args.dataset + '/test.npy')  # [N,T,D]
         graphs_2 = np.load(self.args.datapath + self.args.dataset + '/graph_test.npy')  # [T,N,N]
 
-        features = np.concatenate([features_1, features_2], axis=1)
-        graphs = np.concatenate([graphs_1, graphs_2], axis=0)
-        self.num_states = features.shape[0]
+        features_origin = np.concatenate([features_1, features_2], axis=1)
+        graphs_origin = np.concatenate([graphs_1, graphs_2], axis=0)
+        self.num_states = features_origin.shape[0]
 
         # Feature Preprocessing: Selection + Null Value + Normalization (take log and use cummulative number)
-        features = self.feature_preprocessing(features, graphs, method='norm_const',is_inc = True)  # [N,T,D]
+        features = self.feature_preprocessing(features_origin, graphs_origin, method='norm_const',is_inc = True)  # [N,T,D]
         self.num_features = features.shape[2]
 
         # Graph Preprocessing: remain self-loop and take log
-        graphs = self.graph_preprocessing(graphs, method='norm_const', is_self_loop=True)  # [T,N,N]
+        graphs = self.graph_preprocessing(graphs_origin, method='norm_const', is_self_loop=True)  # [T,N,N]
+
+        features_origin = self.feature_preprocessing(features_origin, graphs_origin, method='norm_const', is_inc = False)  # [N,T,D]
+        return features, graphs, features_origin
+
+    def load_test_data(self, pred_length, condition_length):
+
+        # Loading Data. N is state number, T is number of days. D is feature number.
+        print("predicting data at: %s" % self.args.dataset)
+        features, graphs, features_origin = self.load_test_arrays()
 
         # Generate Encoding data (which is aligned)
         df = self.loading_test_points(pred_length,condition_length)
@@ -149,16 +170,6 @@ class ParseData(object):
         features_masks_dec = []  # K*[1,T,D]
         graphs_dec = []  # k*[1,T,N,N]
 
-        # Reloading data for gt
-        features_1 = np.load(self.args.datapath + self.args.dataset + '/train.npy')  # [N,T,D]
-        graphs_1 = np.load(self.args.datapath + self.args.dataset + '/graph_train.npy')  # [T,N,N]
-        features_2 = np.load(self.args.datapath + self.args.dataset + '/test.npy')  # [N,T,D]
-        graphs_2 = np.load(self.args.datapath + self.args.dataset + '/graph_test.npy')  # [T,N,N]
-
-        features_origin = np.concatenate([features_1, features_2], axis=1)
-        graphs_origin = np.concatenate([graphs_1, graphs_2], axis=0)
-        features_origin = self.feature_preprocessing(features_origin, graphs_origin, method='norm_const', is_inc = False)  # [N,T,D]
-
         for i, start_index in enumerate(start_indexes):
             # decoder data
             test_start_index = start_index + condition_length
@@ -186,49 +197,69 @@ class ParseData(object):
 
         return encoder_data_loader, decoder_data_loader, decoder_graph_loader,num_batch
 
-    def feature_preprocessing(self, feature_input, graph_input, method = 'norm_const', is_inc = True):
+    def load_multi_horizon_test_data(self, horizons, condition_length, start_dates = None):
         '''
-        Step1: Feature adding and selection.
-        Step2: Null value preprocess
-        Step3: Feature Normalization
+        One test point per start date, with decoder data up to the largest horizon: shorter horizons are read
+        from the same trajectory (utils.evaluate_horizons). The time grid is the one of a max(horizons) test
+        pass, times = i / (max(horizons) + T1).
+
+        :param horizons: forecast days to evaluate, e.g. [7,14,21].
+        :param start_dates: first forecast days "YYYY-MM-DD", defaults to the distinct Start_date of test_point.csv.
+            Each start date is decoded up to max(horizons) days or the last available day.
+        :return: encoder loader, decoder loader (data / data_gt [N,T2,D], T2 <= max(horizons)), start_dates, num_batch
         '''
-        #Step1: Feature adding and selection.
-        feature_names = self.args.features.split(",")
-        self.feature_names = feature_names
-        assert len(weights) == len(feature_names)
-        #print("Selected features are: " + self.args.features)
-        if "Population" in feature_names:
-            feature_input = self.add_population(feature_input)
-        if "Mobility" in feature_names:
-            feature_input = self.add_mobility(graph_input, self.num_states, feature_input)
-
-        # load feature dict to do feature selection
-        f = open(self.args.datapath + "feature_dict.txt", 'r')
-        tmp = f.read()
-        feature_dict = eval(tmp)
-        f.close()
-
-        feature_indices = []
-        for each_feature in feature_names:
-            feature_indices.append(feature_dict[each_feature])
+        print("predicting data at: %s" % self.args.dataset)
+        features, graphs, features_origin = self.load_test_arrays()
+        num_days = features.shape[1]
+        max_horizon = max(horizons)
+
+        if start_dates is None:
+            df = pd.read_csv(self.args.datapath + self.args.dataset + "/test_point.csv", header=0, sep="\t")
+            start_dates = sorted(set(df["Start_date"].tolist()), key = utils.transfer_index)
+        start_indexes = [utils.transfer_index(d) - condition_length for d in start_dates]
+        for d, start_index in zip(start_dates, start_indexes):
+            if start_index < 0 or start_index + condition_length >= num_days:
+                raise ValueError("No conditioning window or forecast day for start date %s" % d)
+
+        features_enc = np.stack([features[:, i:i + condition_length, :] for i in start_indexes], axis=0)  # [K,N,T1,D]
+        graphs_enc = np.stack([graphs[i:i + condition_length, :, :] for i in start_indexes], axis=0)  # [K,T1,N,N]
+
+        times = np.asarray([i / (max_horizon + condition_length) for i in
+                            range(max_horizon + condition_length)])  # normalized in [0,1] T
+        times_observed = times[:condition_length]  # [T1]
+        self.times_extrap = times[condition_length:] - times[condition_length]  # [T2]
 
-        feature_input = feature_input[:, :, feature_indices]
+        encoder_data_loader = self.transfer_data(features_enc, graphs_enc, times_observed, 1)
 
-        #Step2: Null value preprocess
-        feature_input = np.where(feature_input <= -1, 0, feature_input)
+        features_masks_dec = []
+        for start_index in start_indexes:
+            test_start_index = start_index + condition_length
+            end_index = min(test_start_index + max_horizon, num_days)
+            features_each = features[:, test_start_index:end_index, self.args.feature_out_index]  # [N,T2,D]
+            features_each_origin = features_origin[:, test_start_index:end_index, self.args.feature_out_index]  # [N,T2,D]
+            masks_each = np.arange(end_index - test_start_index)
+            features_masks_dec.append((features_each, features_each_origin, masks_each))
 
-        #Step3: Feature Normalization
-        feature_input = np.where(feature_input <= -1, 0, feature_input)
+        decoder_data_loader = Loader(features_masks_dec, batch_size=1, shuffle=False,
+                                     collate_fn=lambda batch: self.variable_test(batch))
 
-        for i,each_feature in enumerate(feature_names):
-            if each_feature in ["Confirmed", "Deaths", "Recovered", "Active"]:
-                feature_input[:, :, i] = self.feature_normalization(feature_input, i, method = method, is_inc = is_inc)
-            elif each_feature != "Mortality_Rate": #Mortality keep original
-                feature_input[:, :, i] = self.feature_normalization(feature_input, i, method = method, is_inc = False)
+        encoder_data_loader = utils.inf_generator(encoder_data_loader)
+        decoder_data_loader = utils.inf_generator(decoder_data_loader)
 
+        return encoder_data_loader, decoder_data_loader, list(start_dates), len(start_indexes)
 
+    def feature_preprocessing(self, feature_input, graph_input, method = 'norm_const', is_inc = True):
+        '''
+        Step1: Feature adding and selection.
+        Step2: Null value preprocess
+        Step3: Feature Normalization
+        The transform is fitted (feature_dict.txt, state_info.npy) on the first call and kept in self.transform.
+        '''
+        self.feature_names = self.args.features.split(",")
+        if self.transform is None:
+            self.transform = FeatureTransform.fit(self.args)
 
-        return feature_input
+        return self.transform.transform(feature_input, graph_input, method = method, is_inc = is_inc)
 
     def graph_preprocessing(self, graph_input, method = 'norm_const', is_self_loop = True):
         '''
@@ -322,61 +353,6 @@ class ParseData(object):
 
         return data_loader
 
-    def add_mobility(self,graph_input, num_states,feature_input):
-        '''
-        Adding self-loop mobility data from graph to features [N,T,D]
-        :param graph_input: [T,N,N]
-        :param num_states: [N,T,D]
-        :param feature_input: [N,T,D]
-        :return: feature_output: [N,T,D+1]
-        '''
-        num_days = graph_input.shape[0]
-        mobility_matrix = np.zeros((num_states, num_days, 1))
-        for i in range(num_days):
-            for j in range(num_states):
-                mobility_matrix[j, i, 0] = graph_input[i, j, j]
-        feature_output = np.concatenate([feature_input, mobility_matrix], axis=2)
-        return feature_output
-
-    def add_population(self, feature_input):
-        '''
-        Adding population data to features [N,T,D]
-        :param feature_input: [N,T,D]
-        :return: feature_output: [N,T,D+1]
-        '''
-        population = np.reshape(np.load(self.args.datapath + "state_info.npy").astype("int"),(-1,1))  # [N,1]
-        population = np.expand_dims(population, axis=2)
-        population_tensor = np.zeros((feature_input.shape[0], feature_input.shape[1], 1))
-        population_tensor += population  # [N,T,1]
-        feature_output = np.concatenate([feature_input, population_tensor], axis=2)
-
-        return feature_output
-
-    def feature_normalization(self, features, feature_ID, method = 'None', is_inc = False):
-        '''
-        normalize one single feature.
-        :param features: [N,T,D]
-        :param feature_ID:
-        :param method:
-        :param is_inc:
-        :return: [N,T]
-        '''
-        # method: log, norm, log_norm, None, norm is to normalize within [1,2]
-        if is_inc:
-            one_feature = np.ones_like(features[:, :, feature_ID])  # [N,T]
-            one_feature[:, 1:] = features[:, 1:, feature_ID] - features[:, :-1, feature_ID]
-        else:
-            one_feature = features[:, :, feature_ID]
-
-        if method == "log":
-            one_feature = np.log(one_feature + 1)
-            return one_feature
-        elif method == 'norm_const':
-            one_feature = one_feature / weights[feature_ID]
-            return one_feature
-        elif method == "None":
-            return one_feature
-
     def transfer_one_graph(self, feature, edge, time):
         '''f
 
@@ -6,6 +6,7 @@ from tqdm import tqdm
 import math
 from scipy.linalg import block_diag
 import lib.utils as utils
+from lib.distributed import shard_indices, get_world_size
 import copy
 import pandas as pd
 import argparse
@@ -63,6 +64,12 @@ class ParseData(object):
             features = features[:-5, :, :, :]
             graphs = graphs[:-5, :, :, :]
             features_original = features_original[:-5,:,:,:]
+            # Data-parallel training: each rank only keeps its shard of the training windows.
+            if get_world_size(self.args) > 1:
+                window_index = shard_indices(features.shape[0], self.args.rank, get_world_size(self.args))
+                features = features[window_index]
+                graphs = graphs[window_index]
+                features_original = features_original[window_index]
         else:
             features = features[-5:, :, :, :]
             graphs = graphs[-5:, :, :, :]
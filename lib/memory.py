@@ -0,0 +1,280 @@
+'''
+Opt-in peak-memory accounting per preprocessing step and model stage.
+
+Every stage records the peak resident set size (RSS) reached while it runs, and how far above the
+RSS at its entry that peak is. On GPU it also records the high-water mark of the CUDA caching
+allocator. CPU tensors are served by the system allocator, so on CPU the RSS increase is the
+allocator high-water mark. RSS is sampled by a background thread while a stage is open.
+
+Model stages come from lib.instrumentation (encoder, edge_init, ode_forward, decoder, loss,
+backward, optimizer), preprocessing steps from track_methods() on a ParseData object.
+'''
+import os
+import json
+import time
+import resource
+import functools
+import threading
+import torch
+from torch.utils._pytree import tree_flatten
+from torch.utils._python_dispatch import TorchDispatchMode
+import lib.instrumentation as instrumentation
+
+
+# ParseData methods tracked by track_methods(); missing ones are skipped.
+PREPROCESSING_STEPS = ["load_train_data", "load_test_data", "feature_preprocessing", "graph_preprocessing",
+                       "generateTrainSamples", "split_data", "transfer_data", "transfer_one_graph",
+                       "generate_train_val_dataloader"]
+
+MB = 1024. * 1024.
+
+
+def current_rss():
+    '''
+    Resident set size of this process in bytes.
+    '''
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError):
+        # No procfs: fall back to the peak RSS of the process.
+        return process_peak_rss()
+
+
+def process_peak_rss():
+    '''
+    Peak RSS of this process since it started, in bytes.
+    '''
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if os.uname()[0] == "Darwin" else maxrss * 1024
+
+
+class MemoryTracker(object):
+    '''
+    Stage listener collecting per-stage memory peaks. Stages can be nested; the peak of an inner
+    stage also counts for the stages enclosing it.
+    '''
+
+    def __init__(self, path, interval = 0.002):
+        '''
+
+        :param path: JSON file the report is written to.
+        :param interval: RSS sampling interval in seconds.
+        '''
+        self.path = path
+        self.interval = interval
+        self.cuda = torch.cuda.is_available()
+        self.stages = {}
+        self.open = []  # stack of open stages
+        self.lock = threading.Lock()
+        self.running = threading.Event()
+        self.stopped = False
+        self.thread = threading.Thread(target = self._sample, daemon = True)
+        self.thread.start()
+
+    def enter(self, name):
+        rss = current_rss()
+        frame = {"name": name, "start_rss": rss, "peak_rss": rss}
+        if self.cuda:
+            self._fold_cuda_peak()
+            frame["start_allocated"] = torch.cuda.memory_allocated()
+            frame["peak_allocated"] = frame["start_allocated"]
+            frame["peak_reserved"] = torch.cuda.memory_reserved()
+        with self.lock:
+            self.open.append(frame)
+        self.running.set()
+
+    def exit(self, name):
+        rss = current_rss()
+        if self.cuda:
+            self._fold_cuda_peak()
+        with self.lock:
+            # Stages are closed in order; tolerate a stage left open by an exception.
+            while len(self.open) > 0:
+                frame = self.open.pop()
+                if frame["name"] == name:
+                    break
+            else:
+                return
+            for f in self.open + [frame]:
+                f["peak_rss"] = max(f["peak_rss"], rss)
+            if len(self.open) == 0:
+                self.running.clear()
+        self._record(frame)
+
+    def _record(self, frame):
+        stats = self.stages.setdefault(frame["name"], {"calls": 0, "peak_rss_mb": 0., "rss_increase_mb": 0.})
+        stats["calls"] += 1
+        stats["peak_rss_mb"] = max(stats["peak_rss_mb"], frame["peak_rss"] / MB)
+        stats["rss_increase_mb"] = max(stats["rss_increase_mb"], (frame["peak_rss"] - frame["start_rss"]) / MB)
+        if self.cuda:
+            stats["cuda_peak_allocated_mb"] = max(stats.get("cuda_peak_allocated_mb", 0.), frame["peak_allocated"] / MB)
+            stats["cuda_increase_mb"] = max(stats.get("cuda_increase_mb", 0.),
+                                            (frame["peak_allocated"] - frame["start_allocated"]) / MB)
+            stats["cuda_peak_reserved_mb"] = max(stats.get("cuda_peak_reserved_mb", 0.), frame["peak_reserved"] / MB)
+
+    def _fold_cuda_peak(self):
+        # One allocator peak counter is shared by all stages: fold it into the open ones before resetting.
+        peak = torch.cuda.max_memory_allocated()
+        reserved = torch.cuda.max_memory_reserved()
+        with self.lock:
+            for f in self.open:
+                f["peak_allocated"] = max(f["peak_allocated"], peak)
+                f["peak_reserved"] = max(f["peak_reserved"], reserved)
+        torch.cuda.reset_peak_memory_stats()
+
+    def _sample(self):
+        while not self.stopped:
+            self.running.wait(0.1)
+            if not self.running.is_set():
+                continue
+            rss = current_rss()
+            with self.lock:
+                for f in self.open:
+                    f["peak_rss"] = max(f["peak_rss"], rss)
+            time.sleep(self.interval)
+
+    def report(self, info = None):
+        '''
+        :param info: run information stored with the report (dataset, N, batch size, ...).
+        '''
+        key = "cuda_increase_mb" if self.cuda else "rss_increase_mb"
+        ranked = sorted(self.stages.items(), key = lambda item: -item[1][key])
+        model_stages = [name for name, _ in ranked if not name.startswith("data.")]
+        data_stages = [name for name, _ in ranked if name.startswith("data.")]
+        return {
+            "info": info if info is not None else {},
+            "process_peak_rss_mb": process_peak_rss() / MB,
+            "ranked_by": key,
+            # The stage growing most above its entry footprint is the one to shrink first to fit a larger N / batch.
+            "limiting_model_stage": model_stages[0] if len(model_stages) > 0 else None,
+            "limiting_preprocessing_step": data_stages[0] if len(data_stages) > 0 else None,
+            "stages": dict(ranked),
+        }
+
+    def write(self, info = None):
+        report = self.report(info)
+        with open(self.path, "w") as f:
+            json.dump(report, f, indent = 2)
+        return report
+
+    def close(self):
+        self.stopped = True
+        self.running.set()
+        self.thread.join()
+
+
+_tracker = None
+
+
+def enable(path, interval = 0.002):
+    '''
+    Start tracking; the instrumentation stages are tracked from now on.
+    :param path: JSON file written by write_report().
+    '''
+    global _tracker
+    disable()
+    _tracker = MemoryTracker(path, interval)
+    instrumentation.add_listener(_tracker)
+
+
+def disable():
+    global _tracker
+    if _tracker is not None:
+        instrumentation.remove_listener(_tracker)
+        _tracker.close()
+        _tracker = None
+
+
+def is_enabled():
+    return _tracker is not None
+
+
+def stage(name):
+    '''
+    Context manager tracking one stage, recorded even when lib.instrumentation timing is off.
+    '''
+    if _tracker is None:
+        return instrumentation._NOOP
+    return _TrackedStage(_tracker, name)
+
+
+class _TrackedStage(object):
+
+    def __init__(self, tracker, name):
+        self.tracker = tracker
+        self.name = name
+
+    def __enter__(self):
+        self.tracker.enter(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        self.tracker.exit(self.name)
+        return False
+
+
+def track_methods(obj, method_names = PREPROCESSING_STEPS, prefix = "data."):
+    '''
+    Track the given methods of obj (e.g. a ParseData instance) as stages named prefix + method name.
+    Only this instance is changed. No-op when tracking is disabled.
+    '''
+    if _tracker is None:
+        return obj
+    for method_name in method_names:
+        method = getattr(obj, method_name, None)
+        if method is not None:
+            setattr(obj, method_name, _tracked(prefix + method_name, method))
+    return obj
+
+
+def _tracked(name, fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with stage(name):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+class AllocationCounter(TorchDispatchMode):
+    '''
+    Count the tensors allocated by the ATen ops run inside the context: outputs whose storage is not
+    one of the inputs' (views, in-place and out= results are no allocations). Scratch memory inside
+    a kernel is not seen.
+    '''
+
+    def __init__(self):
+        super(AllocationCounter, self).__init__()
+        self.count = 0
+        self.bytes = 0
+        self.by_op = {}
+
+    def __torch_dispatch__(self, func, types, args = (), kwargs = None):
+        kwargs = kwargs or {}
+        out = func(*args, **kwargs)
+        inputs = set(t.untyped_storage().data_ptr() for t in tree_flatten((args, kwargs))[0] if isinstance(t, torch.Tensor))
+        for t in tree_flatten(out)[0]:
+            if isinstance(t, torch.Tensor) and t.untyped_storage().data_ptr() not in inputs:
+                nbytes = t.untyped_storage().nbytes()
+                self.count += 1
+                self.bytes += nbytes
+                name = str(func.overloadpacket)
+                count, total = self.by_op.get(name, (0, 0))
+                self.by_op[name] = (count + 1, total + nbytes)
+        return out
+
+    def summary(self, top = 5):
+        ops = sorted(self.by_op.items(), key = lambda item: -item[1][1])[:top]
+        return {"allocations": self.count, "allocated_MB": self.bytes / MB,
+                "top_ops": [{"op": name, "allocations": count, "allocated_MB": total / MB} for name, (count, total) in ops]}
+
+
+def write_report(info = None):
+    '''
+    Write the per-stage report (overwriting the file). Stages are ranked by their increase over the
+    entry footprint; limiting_model_stage / limiting_preprocessing_step name the largest of each.
+    :return: the report dict, None when disabled.
+    '''
+    if _tracker is None:
+        return None
+    return _tracker.write(info)
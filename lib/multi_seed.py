@@ -0,0 +1,274 @@
+'''
+Training of several random seeds of one configuration in a single process (run_models_*.py --seeds).
+
+The data is loaded and preprocessed once and every replica trains on the same batches. A replica has its
+own initial weights (torch.manual_seed(seed) before create_CoupledODE_model), optimizer, scheduler, best
+metrics and checkpoints; validation, testing and checkpointing are the runner's, called per replica.
+
+With a fixed-step solver and a GTrans encoder, one training step of all replicas is a single vmapped call:
+the parameters of the replicas are stacked along a new first dimension and TrainingCoupledODE (the plain
+torch encoder / ODE function of lib.export with dropout, plus the training loss of CoupledODE.compute_all_losses)
+runs under torch.func.vmap over torch.func.functional_call. Dropout and z0 draws then come from the shared
+RNG stream (-r), different for every replica. Adaptive solvers, other encoders, --bf16 and --compile fall back
+to stepping the replicas one after another, each on its own RNG stream, so a seed then gives the same result
+alone or with others.
+
+Both paths differentiate the solver directly (torchdiffeq.odeint, DiffeqSolver.adjoint = False), not with the
+adjoint method of single runs: the gradients of a seed do not depend on which path trains it.
+'''
+import copy
+import contextlib
+import torch
+import torch.nn.functional as F
+import torch.optim as optim
+from tqdm import tqdm
+import lib.utils as utils
+from lib.checkpoint import BestMetrics
+from lib.export import ScriptCoupledODE, FIXED_STEP_SOLVERS
+from lib.create_coupled_ode_model import create_CoupledODE_model
+
+
+def get_torch_rng_state():
+    state = {"torch": torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_torch_rng_state(state):
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+class SeedReplica(object):
+    '''
+    One seed: model, optimizer, scheduler, RNG stream and best metrics.
+    '''
+
+    def __init__(self, seed, args, input_dim, z0_prior, obsrv_std, device):
+        self.seed = seed
+        self.args = copy.copy(args)
+        self.args.random_seed = seed
+        self.args.alias = args.alias + "_seed_" + str(seed)
+        self.label = "Seed %d " % seed  # log prefix
+        self.kind_suffix = "_" + str(seed)  # checkpoint kinds, --keep_ckpts applies to each seed
+
+        outer = get_torch_rng_state()
+        torch.manual_seed(seed)
+        self.model = create_CoupledODE_model(self.args, input_dim, z0_prior, obsrv_std, device)
+        self.rng_state = get_torch_rng_state()
+        set_torch_rng_state(outer)
+        if args.compile:
+            self.model.diffeq_solver.ode_func.compile_rhs()
+        self.model.diffeq_solver.adjoint = False  # as the vmap path
+        self.parameters = dict(self.model.named_parameters())
+
+        if args.optimizer == "AdamW":
+            self.optimizer = optim.AdamW(self.model.parameters(), lr = args.lr, weight_decay = args.l2)
+        elif args.optimizer == "Adam":
+            self.optimizer = optim.Adam(self.model.parameters(), lr = args.lr, weight_decay = args.l2)
+        self.scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(self.optimizer, 1000, eta_min = 1e-9)
+        self.best = BestMetrics()
+
+    @contextlib.contextmanager
+    def rng(self):
+        '''
+        Run the enclosed code on this replica's torch RNG stream, the outer stream is restored afterwards.
+        '''
+        outer = get_torch_rng_state()
+        set_torch_rng_state(self.rng_state)
+        try:
+            yield
+        finally:
+            self.rng_state = get_torch_rng_state()
+            set_torch_rng_state(outer)
+
+    def train_batch(self, batch_dict_encoder, batch_dict_decoder, batch_dict_graph, kl_coef):
+        with self.rng():
+            self.optimizer.zero_grad()
+            train_res = self.model.compute_all_losses(batch_dict_encoder, batch_dict_decoder, batch_dict_graph, self.args.num_atoms,
+                                                      edge_lamda = self.args.edge_lamda, kl_coef = kl_coef, istest = False)
+            loss = train_res["loss"]
+            loss.backward()
+            torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.args.clip)
+            self.optimizer.step()
+        train_res["loss"] = loss.detach()
+        return train_res
+
+
+def create_replicas(seeds, args, input_dim, z0_prior, obsrv_std, device):
+    if len(set(seeds)) != len(seeds):
+        raise ValueError("Duplicate seeds: " + ",".join(str(s) for s in seeds))
+    return [SeedReplica(seed, args, input_dim, z0_prior, obsrv_std, device) for seed in seeds]
+
+
+class TrainingCoupledODE(ScriptCoupledODE):
+    '''
+    CoupledODE.compute_all_losses(istest = False) of one replica with plain torch ops, so it can run under
+    torch.func.vmap: reparameterized z0, fixed-step solve of nodes and edges, node / edge Gaussian likelihood,
+    closed-form KL to N(0,1) and the cumulative MAPE / MSE.
+    '''
+
+    def __init__(self, model, args):
+        super(TrainingCoupledODE, self).__init__(model, args, copy_model = False)
+        self.decoder_edge = model.decoder_edge.decoder
+        self.obsrv_std = float(model.obsrv_std)
+        self.edge_lamda = args.edge_lamda
+
+    def gaussian_likelihood(self, pred, truth):
+        '''
+        masked_gaussian_log_density without mask, averaged over trajectories: all weights are equal.
+        '''
+        return torch.mean(-(pred - truth) ** 2 / (2 * self.obsrv_std * self.obsrv_std))
+
+    def forward(self, x, edge_index, edge_weight, x_time, edge_time, group, num_groups: int, time_steps, data, data_gt, truth_graph, kl_coef: float):
+        '''
+
+        :param group: [num_nodes] LongTensor, the trajectory (state of a window) of every encoder node
+        :param data: [K*N,T2,D] normalized increments, data_gt [K*N,T2,D] the MAPE denominators
+        :param truth_graph: [K*N*N,T2,1], None if edge_lamda is 0
+        :return: loss, likelihood, MAPE, MSE, kl_first_p, std_first_p (0-dim tensors)
+        '''
+        mu, std = self.encoder(x, edge_index, edge_weight, x_time, edge_time, group, num_groups)
+        first_point = torch.randn_like(mu) * std + mu
+
+        if self.augment_dim > 0:
+            first_point = torch.cat([first_point, torch.zeros((first_point.shape[0], self.augment_dim), dtype = first_point.dtype, device = first_point.device)], 1)
+        edge_initials = F.gelu(self.w_node_to_edge_initial(self.ode_func.edge_inputs(first_point)))
+        edge_initials = edge_initials.view(-1, edge_initials.shape[2])
+        K_N = first_point.shape[0]
+
+        sol = self.solve(torch.cat([first_point, edge_initials], 0), time_steps, K_N, first_point).permute(1, 0, 2)  # [K*N+K*N*N,T,D]
+        if self.augment_dim > 0:
+            sol = sol[:, :, :-self.augment_dim]
+        pred_node = self.decoder_node(sol[:K_N])
+
+        likelihood = self.gaussian_likelihood(pred_node, data)
+        if truth_graph is not None:
+            pred_edge = self.decoder_edge(sol[K_N:])
+            likelihood = (1 - self.edge_lamda) * likelihood + self.edge_lamda * self.gaussian_likelihood(pred_edge, truth_graph)
+
+        kl_first_p = torch.mean(0.5 * (std ** 2 + mu ** 2 - 1) - torch.log(std))  # KL(N(mu,std) || N(0,1))
+        loss = -(likelihood - kl_coef * kl_first_p)
+
+        error = torch.cumsum(pred_node, dim = 1) - torch.cumsum(data, dim = 1)
+        MAPE = torch.abs(error) / torch.abs(data_gt)
+        MAPE = torch.where(MAPE == float("inf"), torch.zeros_like(MAPE), MAPE)
+        return loss, likelihood.detach(), torch.mean(MAPE).detach(), torch.mean(error ** 2).detach(), kl_first_p.detach(), torch.mean(std).detach()
+
+
+def vmap_unsupported(args):
+    '''
+    :return: why the replicas cannot be trained with vmap, None if they can
+    '''
+    if not hasattr(torch, "func"):
+        return "torch.func needs torch >= 2.0"
+    if args.solver not in FIXED_STEP_SOLVERS:
+        return "adaptive solver " + args.solver
+    if args.bf16:
+        return "--bf16"
+    if args.compile:
+        return "--compile"
+    return None
+
+
+class SeedTrainer(object):
+    '''
+    Replicas of the seeds and their training epochs, vmapped over stacked parameters when possible.
+    '''
+
+    def __init__(self, seeds, args, input_dim, z0_prior, obsrv_std, device):
+        self.args = args
+        self.device = device
+        self.replicas = create_replicas(seeds, args, input_dim, z0_prior, obsrv_std, device)
+        self.fallback_reason = vmap_unsupported(args)
+        self.module = None
+        if self.fallback_reason is None:
+            # Runs every replica through functional_call, so it wraps a copy of one of them.
+            template = copy.deepcopy(self.replicas[0].model)
+            try:
+                self.module = TrainingCoupledODE(template, args)
+            except ValueError as e:  # non-GTrans encoder
+                self.fallback_reason = str(e)
+        if self.module is not None:
+            template_names = {id(p): name for name, p in template.named_parameters()}
+            self.parameter_names = [(name, template_names[id(p)]) for name, p in self.module.named_parameters()]
+            loss = lambda parameters, inputs: torch.func.functional_call(self.module, parameters, inputs)
+            self.batched_loss = torch.func.vmap(loss, in_dims = (0, None), randomness = "different")
+
+    def describe(self):
+        seeds = ",".join(str(r.seed) for r in self.replicas)
+        gradients = "gradients by direct backpropagation through the solver, no adjoint"
+        if self.module is not None:
+            return "Training %d seeds together (%s): vmap over stacked parameters, %s" % (len(self.replicas), seeds, gradients)
+        return "Training %d seeds together (%s): one after another, no vmap (%s), %s" % (len(self.replicas), seeds, self.fallback_reason, gradients)
+
+    def vmap_step(self, batch_dict_encoder, batch_dict_decoder, batch_dict_graph, kl_coef):
+        '''
+        One optimizer step of every replica from a single vmapped forward / backward pass.
+        :return: list of per-replica results as compute_all_losses
+        '''
+        for replica in self.replicas:
+            replica.optimizer.zero_grad()
+        # torch.stack keeps the graph to every replica's parameters, so backward fills their own .grad.
+        parameters = {name: torch.stack([replica.parameters[model_name] for replica in self.replicas])
+                      for name, model_name in self.parameter_names}
+
+        batch_y = batch_dict_encoder.y
+        group = torch.repeat_interleave(torch.arange(len(batch_y), device = batch_y.device), batch_y)  # utils.rewrite_batch
+        truth_graph = None
+        if self.args.edge_lamda != 0:
+            K, T2 = batch_dict_graph.shape[0], batch_dict_graph.shape[1]
+            truth_graph = batch_dict_graph.reshape(K, T2, -1).permute(0, 2, 1).reshape(-1, T2, 1)  # [K*N*N,T,1]
+        inputs = (batch_dict_encoder.x, batch_dict_encoder.edge_index, batch_dict_encoder.edge_weight, batch_dict_encoder.pos,
+                  batch_dict_encoder.edge_time, group, len(batch_y), batch_dict_decoder["time_steps"], batch_dict_decoder["data"],
+                  batch_dict_decoder["data_gt"], truth_graph, float(kl_coef))
+
+        loss, likelihood, MAPE, MSE, kl_first_p, std_first_p = self.batched_loss(parameters, inputs)
+        loss.sum().backward()
+
+        results = []
+        for i, replica in enumerate(self.replicas):
+            torch.nn.utils.clip_grad_norm_(replica.model.parameters(), self.args.clip)
+            replica.optimizer.step()
+            results.append({"loss": loss[i].detach(), "likelihood": likelihood[i], "MAPE": MAPE[i], "MSE": MSE[i],
+                            "kl_first_p": kl_first_p[i], "std_first_p": std_first_p[i]})
+        return results
+
+    def train_epoch(self, encoder, decoder, graph, num_batch):
+        '''
+        One pass over the training batches, every batch is assembled once and used by all replicas.
+        :return: list of per-replica mean metrics, kl_coef of the last batch
+        '''
+        keys = ["loss", "MAPE", "MSE", "likelihood", "kl_first_p", "std_first_p"]
+        metrics = [utils.MetricsAccumulator(self.device, keys) for _ in self.replicas]
+        for replica in self.replicas:
+            replica.model.train()
+        if self.module is not None:
+            self.module.train()
+
+        wait_until_kl_inc = 1000
+        for itr in tqdm(range(num_batch)):
+            if itr < wait_until_kl_inc:
+                kl_coef = 1
+            else:
+                kl_coef = 1 * (1 - 0.99 ** (itr - wait_until_kl_inc))
+
+            batch_dict_encoder = utils.get_next_batch_new(encoder, self.device)
+            batch_dict_graph = utils.get_next_batch_new(graph, self.device)
+            batch_dict_decoder = utils.get_next_batch(decoder, self.device)
+
+            if self.module is not None:
+                results = self.vmap_step(batch_dict_encoder, batch_dict_decoder, batch_dict_graph, kl_coef)
+            else:
+                results = [replica.train_batch(batch_dict_encoder, batch_dict_decoder, batch_dict_graph, kl_coef)
+                           for replica in self.replicas]
+            for replica_metrics, train_res in zip(metrics, results):
+                replica_metrics.update(train_res)
+
+            del batch_dict_encoder, batch_dict_graph, batch_dict_decoder
+
+        for replica in self.replicas:
+            replica.scheduler.step()
+        return [m.summary()[0] for m in metrics], kl_coef
@@ -0,0 +1,336 @@
+'''
+Pre-launch cost model: memory and time of a training configuration before running it.
+
+Analytic estimates come from the dataset shapes and the model arguments: size of the coupled ODE
+state (K*N + K*N*N)*D, encoder graph size, activation memory for the gradient mode
+(adjoint: odeint_adjoint as used by DiffeqSolver, direct: backpropagation through the solver
+steps) and FLOPs per training step. A short probe runs a few real training steps at small batch
+sizes, each in a fresh process, and calibrates the per-window memory and time; both are linear in
+the batch size K for a given dataset.
+'''
+import math
+import time
+import queue
+import importlib
+import traceback
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from torch.distributions.normal import Normal
+import lib.utils as utils
+import lib.memory as memory
+
+
+BYTES = 4  # float32 model tensors
+
+# ODE function evaluations per solver step (fixed-grid solvers step between the output times)
+SOLVER_STAGES = {"euler": 1, "midpoint": 2, "rk4": 4, "explicit_adams": 1, "implicit_adams": 1}
+ADAPTIVE_STAGES = 6  # dopri5 stages; the number of steps is data dependent, the probe measures it
+
+
+def dataset_shapes(args, loader_module = "lib.load_data_covid"):
+    '''
+    Shapes of the training data, read from the array headers (no full load).
+    :return: dict with N, T (days / steps available for training windows), num_features, num_windows
+        (training windows, without the 5 validation windows) and encoder_edges (edges of one encoder graph)
+    '''
+    path = args.datapath + args.dataset + "/"
+    T1 = args.condition_length
+    if loader_module == "lib.load_data_covid":
+        features = np.load(path + "train.npy", mmap_mode = "r")  # [N,T,D]
+        graphs = np.load(path + "graph_train.npy", mmap_mode = "r")  # [T,N,N]
+        N, T = features.shape[0], features.shape[1]
+        num_features = len(args.features.split(","))
+        window_graphs = graphs[:T1]
+    else:
+        locations = np.load(path + "locations.npy", mmap_mode = "r")  # [T,N,2]
+        graphs = np.load(path + "graphs.npy", mmap_mode = "r")  # [T-1,N,N]
+        N = locations.shape[1]
+        T = min(args.training_end_time, locations.shape[0] - 1) - 1  # first differences
+        num_features = locations.shape[2] + (1 if getattr(args, "add_popularity", False) else 0)
+        window_graphs = graphs[:T1]
+
+    each_length = args.condition_length + args.pred_length
+    num_windows = max(0, int(math.floor((T - each_length) / args.split_interval)) + 1 - 5)
+    # Encoder graph: mobility edges within each day plus one temporal edge per node and day
+    encoder_edges = int(np.count_nonzero(np.asarray(window_graphs))) + N * (T1 - 1)
+
+    return {"N": int(N), "T": int(T), "num_features": int(num_features), "num_windows": num_windows,
+            "encoder_edges": encoder_edges}
+
+
+def estimate(args, shapes, batch_size = None, grad_mode = "adjoint", nfe = None):
+    '''
+    Analytic estimates for one training step with batch_size windows.
+
+    :param grad_mode: "adjoint" or "direct"
+    :param nfe: forward ODE function evaluations, derived from the solver when None.
+    :return: dict of element counts, bytes and FLOPs
+    '''
+    K = batch_size if batch_size is not None else args.batch_size
+    N = shapes["N"]
+    D = args.ode_dims + args.augment_dim
+    H = args.rec_dims
+    F = shapes["num_features"]
+    T1, T2 = args.condition_length, args.pred_length
+    KN, KNN = K * N, K * N * N
+
+    state_elems = (KN + KNN) * D
+    state_bytes = state_elems * BYTES
+    steps = T2 - 1
+    if nfe is None:
+        nfe = SOLVER_STAGES.get(args.solver, ADAPTIVE_STAGES) * steps
+
+    # One ODE function evaluation (Edge_NRI + normalization + Node_GCN)
+    func_flops = (4 * KNN * N * D            # one-hot sender / receiver matmuls
+                  + 4 * KNN * D * D          # w_node2edge on [h_i||h_j]
+                  + 2 * KNN * D * D          # edge self evolution
+                  + KNN * D * D + KNN * D    # edge -> value
+                  + 12 * KNN * D             # norms, activations, sums
+                  + 2 * KN * D * D + 2 * KNN * D + 10 * KN * D)  # Node_GCN
+    func_activation_elems = 12 * KNN * D + 6 * KN * D  # tensors kept for the backward of one evaluation
+
+    edge_init_flops = 4 * KNN * N * D + 4 * KNN * D * D + KNN * D
+    V = K * N * T1
+    E = K * shapes["encoder_edges"]
+    encoder_flops = 2 * V * F * H + args.rec_layers * (6 * E * H * H + 10 * E * H + 10 * V * H) + 3 * KN * H * H + 2 * KN * H * D
+    encoder_activation_elems = args.rec_layers * 10 * E * H + 8 * V * H
+    decoder_flops = T2 * (KN + KNN) * D * D
+
+    ode_forward_flops = nfe * func_flops
+    if grad_mode == "adjoint":
+        # Backward solves the augmented system: one evaluation plus its vector-Jacobian product per stage
+        ode_backward_flops = 3 * nfe * func_flops
+        # Solution at T2 outputs, augmented state of the adjoint steps, graph of one evaluation
+        ode_activation_bytes = T2 * state_bytes + 10 * state_bytes + func_activation_elems * BYTES
+    elif grad_mode == "direct":
+        ode_backward_flops = 2 * nfe * func_flops
+        # Every evaluation of every step stays in the autograd graph
+        ode_activation_bytes = T2 * state_bytes + nfe * (func_activation_elems * BYTES + state_bytes)
+    else:
+        raise ValueError("Unknown gradient mode " + grad_mode)
+
+    activation_bytes = (ode_activation_bytes + encoder_activation_elems * BYTES
+                        + 3 * KNN * D * BYTES        # edge initials
+                        + 2 * T2 * (KN + KNN) * D * BYTES)  # decoder
+    flops = 3 * (encoder_flops + edge_init_flops + decoder_flops) + ode_forward_flops + ode_backward_flops
+
+    # Loaded training + validation windows: encoder graphs (int64 edge index, float32 attributes) and decoder series
+    num_windows_all = shapes["num_windows"] + 5
+    data_bytes = num_windows_all * (shapes["encoder_edges"] * (2 * 8 + 2 * 4) + N * T1 * (F + 1) * 4 + 8 * N
+                                    + 2 * N * T2 * args.output_dim * 8 + T2 * N * N * 4)
+    # Preprocessing (float64 numpy): the window copies of generateTrainSamples, and the dense
+    # [N*T1, N*T1] matrices of transfer_one_graph (about 8 alive at once)
+    preprocessing_bytes = num_windows_all * (T1 + T2) * N * N * 8 + 8 * 8 * (N * T1) ** 2
+
+    return {
+        "K": K, "N": N, "D": D, "T1": T1, "T2": T2,
+        "state_elems": state_elems,
+        "state_bytes": state_bytes,
+        "encoder_nodes": V,
+        "encoder_edges": E,
+        "nfe_forward": nfe,
+        "activation_bytes": activation_bytes,
+        "data_bytes": data_bytes,
+        "preprocessing_bytes": preprocessing_bytes,
+        "flops": {"encoder": 3 * encoder_flops, "edge_init": 3 * edge_init_flops, "decoder": 3 * decoder_flops,
+                  "ode_forward": ode_forward_flops, "ode_backward": ode_backward_flops, "total": flops},
+    }
+
+
+def _probe_loaders(args, loader_module, batch_size):
+    '''
+    Training loaders holding only the first batch_size windows.
+    '''
+    dataloader = importlib.import_module(loader_module).ParseData(args = args)
+    if loader_module != "lib.load_data_covid":
+        encoder, decoder, graph, _, num_atoms = dataloader.load_train_data(is_train = True)
+        return dataloader, encoder, decoder, graph, num_atoms
+
+    path = args.datapath + args.dataset + "/"
+    features = np.load(path + "train.npy")
+    graphs = np.load(path + "graph_train.npy")
+    dataloader.num_states = features.shape[0]
+    features = dataloader.feature_preprocessing(features, graphs, method = "norm_const", is_inc = True)
+    dataloader.num_features = features.shape[2]
+    graphs = dataloader.graph_preprocessing(graphs, method = "norm_const", is_self_loop = True)
+    features, graphs = dataloader.generateTrainSamples(features, graphs)
+    window_index = np.arange(batch_size)
+    encoder, decoder, graph, _, num_atoms = dataloader.generate_train_val_dataloader(
+        features[window_index], graphs[window_index], True, window_index)
+    return dataloader, encoder, decoder, graph, num_atoms
+
+
+def probe_worker(args, loader_module, batch_size, steps, num_threads, results):
+    '''
+    Run steps training steps with batch_size windows; put (peak step bytes, seconds per step, nfe, num params).
+    '''
+    try:
+        from lib.create_coupled_ode_model import create_CoupledODE_model
+        torch.set_num_threads(num_threads)
+        torch.manual_seed(args.random_seed)
+        np.random.seed(args.random_seed)
+        device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+        args.batch_size = batch_size
+        args.rank, args.world_size = 0, 1
+
+        dataloader, encoder, decoder, graph, num_atoms = _probe_loaders(args, loader_module, batch_size)
+        args.num_atoms = num_atoms
+        input_dim = dataloader.num_features if loader_module == "lib.load_data_covid" else 3
+        z0_prior = Normal(torch.Tensor([0.0]).to(device), torch.Tensor([1.]).to(device))
+        model = create_CoupledODE_model(args, input_dim, z0_prior, torch.Tensor([0.01]).to(device), device)
+        optimizer = torch.optim.AdamW(model.parameters(), lr = 5e-3, weight_decay = 1e-5)
+        model.train()
+
+        batch_encoder = utils.get_next_batch_new(encoder, device)
+        batch_graph = utils.get_next_batch_new(graph, device)
+        batch_decoder = utils.get_next_batch(decoder, device)
+
+        tracker = memory.MemoryTracker(None)
+        tracker.enter("step")
+        times = []
+        nfe = []
+        for _ in range(steps + 1):
+            start = time.perf_counter()
+            optimizer.zero_grad()
+            res = model.compute_all_losses(batch_encoder, batch_decoder, batch_graph, num_atoms,
+                                           edge_lamda = args.edge_lamda, kl_coef = 1, istest = False)
+            nfe.append(model.diffeq_solver.ode_func.nfe)
+            res["loss"].backward()
+            optimizer.step()
+            if tracker.cuda:
+                torch.cuda.synchronize()
+            times.append(time.perf_counter() - start)
+        tracker.exit("step")
+        tracker.close()
+        stats = tracker.stages["step"]
+        peak_bytes = (stats["cuda_increase_mb"] if tracker.cuda else stats["rss_increase_mb"]) * memory.MB
+        num_params = sum(p.numel() for p in model.parameters())
+        # The first step includes one-off allocations: memory counts it, time does not.
+        results.put(("result", (peak_bytes, float(np.median(times[1:])), float(np.mean(nfe)), num_params)))
+    except Exception:
+        results.put(("error", traceback.format_exc()))
+
+
+def probe(args, loader_module, batch_size, steps = 3, num_threads = None):
+    '''
+    Measure a few training steps in a fresh process, so that memory freed by earlier probes is not reused.
+    :return: dict with peak_bytes, step_s, nfe_forward, num_params
+    '''
+    ctx = mp.get_context("spawn")
+    results = ctx.Queue()
+    process = ctx.Process(target = probe_worker, args = (args, loader_module, batch_size, steps,
+                                                         num_threads or torch.get_num_threads(), results))
+    process.start()
+    while True:
+        try:
+            kind, value = results.get(timeout = 5)
+            break
+        except queue.Empty:
+            # A probe that runs out of memory is usually killed without reporting back.
+            if not process.is_alive():
+                raise Exception("Probe process for K=%d died with exit code %s." % (batch_size, process.exitcode))
+    process.join()
+    if kind == "error":
+        raise Exception("Probe failed:\n" + value)
+    peak_bytes, step_s, nfe, num_params = value
+    return {"K": batch_size, "peak_bytes": peak_bytes, "step_s": step_s, "nfe_forward": nfe, "num_params": num_params}
+
+
+def _linear_fit(xs, ys):
+    '''
+    y = a + b*x through the probe points, through the origin for a single point.
+    A slope <= 0 (noisy or inconsistent probes) falls back to the line through the origin and the
+    largest probe; a negative intercept is clamped to 0, which keeps the line above the probes.
+    :return: a, b, None or what was changed
+    '''
+    largest = int(np.argmax(xs))
+    if len(xs) == 1:
+        return 0., max(0., float(ys[largest]) / xs[largest]), None
+    b, a = np.polyfit(np.asarray(xs, dtype = float), np.asarray(ys, dtype = float), 1)
+    points = ", ".join("K=%d: %.4g" % (x, y) for x, y in zip(xs, ys))
+    if b <= 0:
+        return 0., max(0., float(ys[largest]) / xs[largest]), \
+            "probe points %s give slope %.4g, using the line through the origin and K=%d" % (points, b, xs[largest])
+    if a < 0:
+        return 0., float(b), "probe points %s give intercept %.4g, clamped to 0" % (points, a)
+    return float(a), float(b), None
+
+
+def plan(args, loader_module = "lib.load_data_covid", grad_mode = "adjoint", budget_bytes = None,
+         probe_batch_sizes = (1, 4), probe_steps = 5, num_threads = None, log = print):
+    '''
+    :param budget_bytes: memory budget for suggest_batch_size, None skips the suggestion.
+    :param probe_batch_sizes: batch sizes measured by the probe, empty for analytic estimates only.
+    :return: report dict
+    '''
+    shapes = dataset_shapes(args, loader_module)
+    K = args.batch_size
+    report = {"dataset": shapes, "grad_mode": grad_mode, "estimate": estimate(args, shapes, K, grad_mode)}
+
+    probes = []
+    for batch_size in probe_batch_sizes:
+        log("Probing K=%d ..." % batch_size)
+        probes.append(probe(args, loader_module, batch_size, probe_steps, num_threads))
+    report["probes"] = probes
+    if len(probes) == 0:
+        return report
+
+    # Probed nfe (adaptive solvers) replaces the solver default
+    nfe = max(p["nfe_forward"] for p in probes)
+    analytic = estimate(args, shapes, K, grad_mode, nfe = nfe)
+    report["estimate"] = analytic
+    per_window = estimate(args, shapes, 1, grad_mode, nfe = nfe)
+    mem_a, mem_b, mem_warning = _linear_fit([p["K"] for p in probes], [p["peak_bytes"] for p in probes])
+    time_a, time_b, time_warning = _linear_fit([p["K"] for p in probes], [p["step_s"] for p in probes])
+    largest = max(probes, key = lambda p: p["K"])
+    warnings = []
+    if mem_warning is not None:
+        warnings.append("Memory fit: " + mem_warning)
+    if mem_b <= 0:
+        # No measurable growth at all: the analytic activations are the only per-window cost left.
+        mem_a, mem_b = 0., float(per_window["activation_bytes"])
+        warnings.append("Memory probes show no growth with K, using the analytic activation memory per window")
+    if time_warning is not None:
+        warnings.append("Time fit: " + time_warning + "; more --probe_steps or a larger second probe batch size help")
+    report["fit_warnings"] = warnings
+
+    # Parameters exist before the probed steps; gradients and AdamW moments are part of the probed peak.
+    model_bytes = probes[0]["num_params"] * BYTES
+    data_bytes = analytic["data_bytes"]
+
+    def step_bytes(batch_size):
+        return mem_a + mem_b * batch_size
+
+    def total_bytes(batch_size):
+        return model_bytes + data_bytes + step_bytes(batch_size)
+
+    calibrated = {
+        "memory_factor": mem_b / per_window["activation_bytes"] if per_window["activation_bytes"] > 0 else None,
+        "flops_per_second": estimate(args, shapes, largest["K"], grad_mode, nfe = nfe)["flops"]["total"] / largest["step_s"],
+        "step_bytes": step_bytes(K),
+        "model_bytes": model_bytes,
+        "data_bytes": data_bytes,
+        "train_bytes": total_bytes(K),
+        "step_s": time_a + time_b * K,
+        "epoch_s": math.ceil(shapes["num_windows"] / float(K)) * (time_a + time_b * K) if shapes["num_windows"] > 0 else None,
+    }
+    report["calibrated"] = calibrated
+
+    if budget_bytes is not None:
+        report["budget_bytes"] = budget_bytes
+        report["suggested_batch_size"] = suggest_batch_size(total_bytes, budget_bytes, max(1, shapes["num_windows"]))
+    return report
+
+
+def suggest_batch_size(total_bytes, budget_bytes, max_batch_size):
+    '''
+    Largest K <= max_batch_size with total_bytes(K) <= budget_bytes, 0 if even K=1 does not fit.
+    '''
+    best = 0
+    for batch_size in range(1, max_batch_size + 1):
+        if total_bytes(batch_size) <= budget_bytes:
+            best = batch_size
+        else:
+            break
+    return best
@@ -0,0 +1,66 @@
+import os
+import functools
+import torch
+from torch.autograd.profiler import record_function
+
+
+# Modules whose forward gets its own range in the trace (matched by class name).
+PROFILED_MODULES = ["GNN", "DiffeqSolver", "Edge_NRI", "Node_GCN"]
+
+
+def _ranged(name, fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with record_function(name):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+def annotate_model(model, module_names = PROFILED_MODULES):
+    '''
+    Wrap the forward of the profiled submodules, and model.compute_all_losses, in record_function
+    ranges. Only the given instance is changed. Edge_NRI / Node_GCN ranges also show up inside
+    the adjoint solve of the backward pass.
+    '''
+    for module in model.modules():
+        name = type(module).__name__
+        if name in module_names:
+            module.forward = _ranged(name, module.forward)
+    model.compute_all_losses = _ranged("compute_all_losses", model.compute_all_losses)
+    return model
+
+
+def profile_steps(step, num_warmup, num_active, out_dir, prefix, sort_by = None, row_limit = 50):
+    '''
+    Run step(i) num_warmup + num_active times under torch.profiler; only the active steps are recorded.
+    Writes <out_dir>/<prefix>_trace.json (chrome://tracing, Perfetto) and <out_dir>/<prefix>_ops.txt.
+
+    :param step: callable running one training step.
+    :return: (trace path, operator table path)
+    '''
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    trace_path = os.path.join(out_dir, prefix + "_trace.json")
+    table_path = os.path.join(out_dir, prefix + "_ops.txt")
+
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    if sort_by is None:
+        sort_by = "self_cuda_time_total" if torch.cuda.is_available() else "self_cpu_time_total"
+
+    def on_trace_ready(prof):
+        prof.export_chrome_trace(trace_path)
+        with open(table_path, "w") as f:
+            f.write(prof.key_averages().table(sort_by = sort_by, row_limit = row_limit))
+            f.write("\n\n")
+            f.write(prof.key_averages(group_by_input_shape = True).table(sort_by = sort_by, row_limit = row_limit))
+
+    schedule = torch.profiler.schedule(wait = 0, warmup = num_warmup, active = num_active, repeat = 1)
+    with torch.profiler.profile(activities = activities, schedule = schedule, on_trace_ready = on_trace_ready,
+                                record_shapes = True) as prof:
+        for i in range(num_warmup + num_active):
+            step(i)
+            prof.step()
+
+    return trace_path, table_path
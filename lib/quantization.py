@@ -0,0 +1,100 @@
+'''
+Dynamic int8 quantization of the CoupledODE linear layers for CPU inference.
+
+Weights are stored in int8 and activations are quantized on the fly per call, so no calibration
+data is needed. Only the layers applied to many rows are quantized: the edge MLPs evaluated on
+K*N*N rows at every ODE evaluation, the edge initialization, the decoders and the GTrans projections.
+The small z0 head keeps float weights.
+'''
+import copy
+import time
+import torch
+import torch.nn as nn
+import lib.utils as utils
+import lib.workspace_solver as workspace_solver
+
+
+QUANTIZED_MODULES = [
+    "w_node_to_edge_initial",
+    "diffeq_solver.ode_func.edge_ode_func_net.w_node2edge",  # same module as w_node_to_edge_initial
+    "diffeq_solver.ode_func.edge_ode_func_net.w_edge2value",
+    "diffeq_solver.ode_func.edge_ode_func_net.edge_self_evolve",
+    "decoder_node",
+    "decoder_edge",
+    "encoder_z0.gcs.*.base_conv.w_k_list",
+    "encoder_z0.gcs.*.base_conv.w_q_list",
+    "encoder_z0.gcs.*.base_conv.w_v_list",
+]
+
+
+def _matches(name, pattern):
+    parts, pattern_parts = name.split("."), pattern.split(".")
+    if len(parts) < len(pattern_parts):
+        return False
+    return all(p == "*" or p == n for p, n in zip(pattern_parts, parts))
+
+
+def quantized_module_names(model, patterns = QUANTIZED_MODULES):
+    '''
+    nn.Linear submodules under the given name patterns ("*" matches one level), shared modules under each of their names.
+    '''
+    return [name for name, module in model.named_modules(remove_duplicate = False)
+            if isinstance(module, nn.Linear) and any(_matches(name, p) for p in patterns)]
+
+
+def quantize_model(model, patterns = QUANTIZED_MODULES, dtype = torch.qint8):
+    '''
+    :return: a quantized copy of the model on CPU in eval mode (inference only, no backward).
+    '''
+    model = copy.deepcopy(model).cpu().eval()
+    names = quantized_module_names(model, patterns)
+    return torch.ao.quantization.quantize_dynamic(model, qconfig_spec = set(names), dtype = dtype)
+
+
+def solver_path(model):
+    '''
+    "workspace" if no-grad solves of the model use the preallocated fixed-step solver, else "odeint".
+    '''
+    solver = model.diffeq_solver
+    if solver.use_workspace and solver.ode_method in workspace_solver.FIXED_STEP_SOLVERS and workspace_solver.supports(solver.ode_func):
+        return "workspace"
+    return "odeint"
+
+
+def model_size(model):
+    '''
+    Bytes of the serialized state dict.
+    '''
+    total = 0
+    for value in model.state_dict().values():
+        if isinstance(value, torch.Tensor):
+            total += value.numel() * value.element_size()
+        elif isinstance(value, tuple):  # packed params of quantized linears
+            total += sum(v.numel() * v.element_size() for v in value if isinstance(v, torch.Tensor))
+    return total
+
+
+def evaluate(model, loaders, args, seed):
+    '''
+    Test metrics of evaluate_test_batches with a fixed z0 sampling seed.
+
+    :param loaders: output of ParseData.load_test_data, reused between calls.
+    '''
+    encoder, decoder, graph, num_batch = loaders
+    torch.manual_seed(seed)
+    start = time.perf_counter()
+    total, MAPE_each, RMSE_each = utils.evaluate_test_batches(model, encoder, decoder, graph, num_batch, torch.device("cpu"),
+                                                              args, kl_coef = 1., metrics_only = True)
+    return {"MAPE": float(total["MAPE"]), "RMSE": float(total["RMSE"]), "seconds": time.perf_counter() - start,
+            "MAPE_each": [float(v) for v in MAPE_each], "RMSE_each": [float(v) for v in RMSE_each]}
+
+
+def accuracy_report(model, quantized, loaders, args, seed = 0):
+    '''
+    MAPE / RMSE of the float and quantized models on the same test points and z0 draws.
+    '''
+    reference = evaluate(model, loaders, args, seed)
+    result = evaluate(quantized, loaders, args, seed)
+    return {"float32": reference, "int8": result,
+            "MAPE_delta": result["MAPE"] - reference["MAPE"], "RMSE_delta": result["RMSE"] - reference["RMSE"],
+            "max_abs_MAPE_delta_per_point": max(abs(a - b) for a, b in zip(result["MAPE_each"], reference["MAPE_each"]))}
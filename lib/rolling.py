@@ -0,0 +1,304 @@
+'''
+Rolling forecasts: the conditioning window moves forward by a day (or a few) between runs.
+
+RollingForecaster keeps from the previous run the preprocessed days, the sparse edges of each
+day's mobility graph and the node states of every GTrans encoder layer. GTrans messages only see
+relative edge times, so after a shift a node keeps its state from the previous window unless its
+receptive field changed. Only the nodes reached from the appended or revised days, and the in-edge
+changes at both ends of the window, are recomputed, layer by layer, from the in-edges of those
+nodes. The encoder graph is assembled from the cached per-day edges, without the dense
+[N*T1,N*T1] matrices of ParseData.transfer_one_graph. The readout, z0 and the ODE solve depend on
+the whole window and are recomputed every run; an unchanged window returns the cached forecast.
+
+check_rolling compares every step with a full recompute (Forecaster.predict_windows).
+'''
+import time
+import numpy as np
+import torch
+from torch_geometric.data import Data
+from lib.gnn_models import normalize_graph_asymmetric
+
+
+def window_times(condition_length, pred_length):
+    '''
+    Encoder / decoder time grids of Forecaster.batch_windows (as load_test_data).
+
+    :return: times_observed [T1], times_extrap [T2]
+    '''
+    times = np.asarray([i / (pred_length + condition_length) for i in range(pred_length + condition_length)])
+    return times[:condition_length], times[condition_length:] - times[condition_length]
+
+
+def day_edges(graph):
+    '''
+    Non-zero flows of one preprocessed graph [N,N] in row-major order, and the self-loops that also link a state to its later days.
+
+    :return: rows, cols, weights, loop states, loop weights
+    '''
+    rows, cols = np.nonzero(graph)
+    loops = np.nonzero(np.diagonal(graph))[0]
+    return rows, cols, graph[rows, cols], loops, np.diagonal(graph)[loops]
+
+
+def window_graph(features, edges, times_observed):
+    '''
+    Same encoder graph as ParseData.transfer_one_graph(features, graphs, times_observed), from day_edges of each day.
+    Node (state n, day t) is n*T1 + t. Day t links (n,t) -> (m,t) with weight graphs[t,n,m], and (n,t) -> (n,s)
+    with weight graphs[t,n,n] for the later days s within one graph day (1 / T1).
+
+    :param features: [N,T1,D]
+    :param edges: T1 day_edges outputs.
+    '''
+    num_states, T1 = features.shape[0], features.shape[1]
+    num_nodes = num_states * T1
+    time = np.reshape(times_observed, (-1, 1))
+    edge_time = time - time.T  # [T1,T1], node time difference of transfer_one_graph
+    lag = (edge_time <= 0) & (abs(edge_time) <= 1 / T1)
+    np.fill_diagonal(lag, False)  # same-day edges, self-loops included, come from the day's flows
+
+    senders, receivers, weights, times = [], [], [], []
+    for t, (rows, cols, flows, loops, loop_weights) in enumerate(edges):
+        senders.append(rows * T1 + t)
+        receivers.append(cols * T1 + t)
+        weights.append(flows)
+        times.append(np.full(len(rows), edge_time[t, t]))
+        for s in np.nonzero(lag[t])[0]:
+            senders.append(loops * T1 + t)
+            receivers.append(loops * T1 + s)
+            weights.append(loop_weights)
+            times.append(np.full(len(loops), edge_time[t, s]))
+    senders, receivers = np.concatenate(senders), np.concatenate(receivers)
+    order = np.argsort(senders * num_nodes + receivers)  # row-major, as scipy.sparse.coo_matrix of the dense matrix
+
+    x_pos = np.concatenate([time for _ in range(num_states)], axis = 0)
+    y = T1 * np.ones(num_states)
+    return Data(x = torch.FloatTensor(np.reshape(features, (-1, features.shape[2]))),
+                edge_index = torch.LongTensor(np.stack([senders[order], receivers[order]])),
+                edge_weight = torch.FloatTensor(np.concatenate(weights)[order]),
+                y = torch.LongTensor(y), pos = torch.FloatTensor(x_pos),
+                edge_time = torch.FloatTensor(np.concatenate(times)[order] + 3 - 3))  # same rounding as the +3 padding
+
+
+class RollingForecaster(object):
+    '''
+    Successive single-window forecasts of a Forecaster with encoder state carried over between runs.
+    '''
+
+    def __init__(self, forecaster, pred_length = None):
+        '''
+
+        :param pred_length: forecast days, defaults to the training pred_length.
+        '''
+        for gc in forecaster.model.encoder_z0.gcs:
+            if gc.conv_name != "GTrans":
+                raise ValueError("Rolling forecasts need a GTrans encoder, got " + gc.conv_name)
+        self.forecaster = forecaster
+        self.model = forecaster.model
+        self.encoder = forecaster.model.encoder_z0
+        self.device = forecaster.device
+        self.pred_length = pred_length if pred_length is not None else forecaster.args.pred_length
+        self.condition_length = forecaster.condition_length
+        self.times_observed, times_extrap = window_times(self.condition_length, self.pred_length)
+        self.batch_de = {"time_steps": torch.FloatTensor(times_extrap).to(self.device)}
+        self.reset()
+
+    def reset(self):
+        '''
+        Drop the cached state, the next forecast is a full recompute.
+        '''
+        self.start_index = None
+        self.window = None  # preprocess_window output
+        self.edges = None  # day_edges of each day of the window
+        self.graph = None
+        self.edge_keys = None  # sender * num_nodes + receiver, sorted
+        self.edge_weight = None  # normalize_graph_asymmetric weights
+        self.hidden = None  # node states of the input layer and of each GTrans layer [N*T1,d]
+        self.first_point = None
+        self.prediction = None
+        self.stats = {"full": 0, "incremental": 0, "cached": 0, "recomputed_nodes": 0, "nodes": 0}
+
+    def forecast(self, start_index):
+        '''
+        :param start_index: day index of the first forecast day, usually one day after the previous call.
+        :return: cumulative predictions [N,pred_length,D_out]
+        '''
+        window = self.forecaster.conditioning_window(start_index)
+        shift = start_index - self.start_index if self.start_index is not None else None
+        prediction = self.forecast_window(window, shift)
+        self.start_index = start_index
+        return prediction
+
+    def forecast_window(self, window, shift = 1):
+        '''
+        :param window: preprocess_window output.
+        :param shift: days between the first day of the previous window and of this one, None for an unrelated window.
+        :return: cumulative predictions [N,pred_length,D_out]
+        '''
+        features, graphs, last_observed = window
+        T1 = self.condition_length
+        if self.window is None or shift is None or shift < 0 or shift >= T1:
+            return self._run(window, [day_edges(g) for g in graphs], None)
+
+        previous_features, previous_graphs, previous_last = self.window
+        same_features = [t + shift < T1 and np.array_equal(features[:, t], previous_features[:, t + shift]) for t in range(T1)]
+        same_graph = [t + shift < T1 and np.array_equal(graphs[t], previous_graphs[t + shift]) for t in range(T1)]
+        if shift == 0 and all(same_features) and all(same_graph) and np.array_equal(last_observed, previous_last):
+            self.stats["cached"] += 1
+            return self.prediction
+        edges = [self.edges[t + shift] if same_graph[t] else day_edges(graphs[t]) for t in range(T1)]
+        return self._run(window, edges, (shift, same_features))
+
+    def _run(self, window, edges, update):
+        features, _, last_observed = window
+        graph = window_graph(features, edges, self.times_observed).to(self.device)
+        num_nodes = graph.x.shape[0]
+        with torch.inference_mode():
+            edge_weight = normalize_graph_asymmetric(graph.edge_index, graph.edge_weight, num_nodes)
+            if update is None:
+                hidden = self._encode_full(graph)
+                self.stats["full"] += 1
+            else:
+                hidden = self._encode_update(graph, edge_weight, *update)
+                self.stats["incremental"] += 1
+            batch = torch.zeros(num_nodes, dtype = torch.long, device = self.device)
+            first_point = self.encoder.readout(hidden[-1], graph.pos, batch, graph.y)
+
+            time_index = torch.arange(self.pred_length, device = self.device)
+            pred_node, _, _, _ = self.model.get_reconstruction(None, self.batch_de, self.forecaster.num_atoms, time_index = time_index,
+                                                               decode_edge = False, first_point = first_point)  # [N,T2,D_out]
+            pred_node = pred_node.cpu().numpy()
+
+        self.window, self.edges, self.graph = window, edges, graph
+        self.edge_keys = graph.edge_index[0] * num_nodes + graph.edge_index[1]
+        self.edge_weight = edge_weight
+        self.hidden = hidden
+        self.first_point = first_point
+        self.prediction = self.forecaster.transform.denormalize(pred_node, last_observed)
+        return self.prediction
+
+    def _encode_full(self, graph):
+        hidden = [self.encoder.input_layer(graph.x)]
+        for gc in self.encoder.gcs:
+            hidden.append(gc(hidden[-1], graph.edge_index, graph.edge_weight, graph.pos, graph.edge_time))
+        self.stats["recomputed_nodes"] += graph.x.shape[0]
+        self.stats["nodes"] += graph.x.shape[0]
+        return hidden
+
+    def _changed_receivers(self, graph, edge_weight, shift):
+        '''
+        Nodes whose in-edges (sender, normalized weight, edge time) differ from the previous window moved by shift days.
+        '''
+        T1 = self.condition_length
+        num_nodes = graph.x.shape[0]
+        sender, receiver = graph.edge_index
+        changed = torch.zeros(num_nodes, dtype = torch.bool, device = self.device)
+
+        # Previous edges in the new numbering: node n*T1 + t becomes n*T1 + t - shift.
+        previous_sender, previous_receiver = self.graph.edge_index
+        kept = (previous_sender % T1 >= shift) & (previous_receiver % T1 >= shift)
+        lost = ~kept & (previous_receiver % T1 >= shift)  # in-edges from the dropped days
+        changed[previous_receiver[lost] - shift] = True
+        previous_keys = self.edge_keys[kept] - shift * (num_nodes + 1)
+        previous_weight = self.edge_weight[kept]
+        previous_time = self.graph.edge_time[kept]
+
+        keys = sender * num_nodes + receiver
+        if len(previous_keys) == 0:
+            changed[receiver] = True
+            return changed
+        index = torch.searchsorted(previous_keys, keys).clamp(max = len(previous_keys) - 1)
+        same = (previous_keys[index] == keys) & (previous_weight[index] == edge_weight) & (previous_time[index] == graph.edge_time)
+        changed[receiver[~same]] = True
+        removed = ~torch.isin(previous_keys, keys)
+        changed[previous_receiver[kept][removed] - shift] = True
+        return changed
+
+    def _encode_update(self, graph, edge_weight, shift, same_features):
+        T1 = self.condition_length
+        num_nodes = graph.x.shape[0]
+        sender, receiver = graph.edge_index
+        changed_receivers = self._changed_receivers(graph, edge_weight, shift)
+
+        def shifted(h):
+            h = h.view(-1, T1, h.shape[-1])
+            out = torch.empty_like(h)
+            out[:, :T1 - shift] = h[:, shift:]
+            return out.view(-1, h.shape[-1])
+
+        # Input layer: days with new or revised features.
+        dirty = torch.tensor(same_features, device = self.device).logical_not().repeat(num_nodes // T1)  # node n*T1 + t
+        h = shifted(self.hidden[0])
+        h[dirty] = self.encoder.input_layer(graph.x[dirty])
+        hidden = [h]
+
+        for l, gc in enumerate(self.encoder.gcs):
+            conv = gc.base_conv
+            dirty_out = dirty | changed_receivers
+            dirty_out[receiver[dirty[sender]]] = True
+            subset = dirty_out[receiver]
+            out = conv.propagate(graph.edge_index[:, subset], x = conv.layer_norm(h), edges_weight = edge_weight[subset],
+                                 edge_time = graph.edge_time[subset], residual = h)
+            h = shifted(self.hidden[l + 1])
+            h[dirty_out] = out[dirty_out]
+            hidden.append(h)
+            dirty = dirty_out
+
+        self.stats["recomputed_nodes"] += int(dirty.sum().item())
+        self.stats["nodes"] += num_nodes
+        return hidden
+
+
+def graphs_equal(a, b):
+    return all(torch.equal(getattr(a, key).cpu(), getattr(b, key).cpu()) for key in ["x", "edge_index", "edge_weight", "y", "pos", "edge_time"])
+
+
+def check_rolling(forecaster, start_index, num_days, pred_length = None, seed = 0, rtol = 1e-4):
+    '''
+    Rolling forecasts of num_days consecutive start days against full recomputes with the same z0 draws.
+    The encoder graph must match ParseData.transfer_one_graph exactly, z0 and predictions within rtol.
+
+    :return: report dict, "passed" and per day results and timings
+    '''
+    rolling = RollingForecaster(forecaster, pred_length)
+    pred_length = rolling.pred_length
+    model = forecaster.model
+    days = []
+    for i in range(num_days):
+        index = start_index + i
+        mode_before = dict(rolling.stats)
+        torch.manual_seed(seed + i)
+        start = time.perf_counter()
+        prediction = rolling.forecast(index)
+        rolling_seconds = time.perf_counter() - start
+
+        torch.manual_seed(seed + i)
+        start = time.perf_counter()
+        reference = forecaster.predict_windows([forecaster.conditioning_window(index)], pred_length)[0]
+        full_seconds = time.perf_counter() - start
+
+        features, graphs, _ = rolling.window
+        reference_graph = forecaster.dataloader.transfer_one_graph(features, graphs, rolling.times_observed)[0]
+        batch_en, _, _ = forecaster.batch_windows([rolling.window], pred_length)
+        with torch.inference_mode():
+            mu, std = model.encoder_z0(batch_en.x, batch_en.edge_weight, batch_en.edge_index, batch_en.pos, batch_en.edge_time,
+                                       batch_en.batch, batch_en.y)
+        mu_error = float((rolling.first_point[0] - mu).abs().max() / mu.abs().max().clamp(min = 1e-12))
+        std_error = float((rolling.first_point[1] - std).abs().max() / std.abs().max().clamp(min = 1e-12))
+        prediction_error = float(np.max(np.abs(prediction - reference) / np.maximum(np.abs(reference), 1e-12)))
+        recomputed = rolling.stats["recomputed_nodes"] - mode_before["recomputed_nodes"]
+        nodes = rolling.stats["nodes"] - mode_before["nodes"]
+        days.append({"start_index": index, "mode": "full" if rolling.stats["full"] > mode_before["full"] else "incremental",
+                     "graph_equal": graphs_equal(rolling.graph, reference_graph),
+                     "recomputed_node_fraction": recomputed / nodes if nodes > 0 else 0.,
+                     "z0_mean_rel_error": mu_error, "z0_std_rel_error": std_error, "prediction_rel_error": prediction_error,
+                     "rolling_s": rolling_seconds, "full_s": full_seconds})
+
+    incremental = [d for d in days if d["mode"] == "incremental"]
+    report = {"days": days,
+              "passed": all(d["graph_equal"] and max(d["z0_mean_rel_error"], d["z0_std_rel_error"], d["prediction_rel_error"]) <= rtol
+                            for d in days)}
+    if len(incremental) > 0:
+        report["incremental_median_s"] = float(np.median([d["rolling_s"] for d in incremental]))
+        report["full_median_s"] = float(np.median([d["full_s"] for d in incremental]))
+        report["speedup"] = report["full_median_s"] / report["incremental_median_s"]
+    return report
@@ -0,0 +1,307 @@
+'''
+Long-running local forecast service around a Forecaster (lib.forecast).
+
+Request threads preprocess their own windows; a single model thread coalesces the requests that
+arrive within max_wait seconds (up to max_batch windows) into one encoder + ODE call per (pred_length, num_samples).
+With a forecast cache on the Forecaster, request threads answer cached windows directly and only queue the others.
+'''
+import json
+import time
+import queue
+import threading
+import collections
+import numpy as np
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import lib.utils as utils
+from lib.forecast import DEFAULT_QUANTILES, quantile_column, summarize_samples, stack_windows
+
+
+class ServiceStats(object):
+    '''
+    Throughput and latency counters, safe to update from several threads.
+    '''
+
+    def __init__(self, window = 1000):
+        '''
+
+        :param window: number of recent requests kept for the latency percentiles.
+        '''
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.windows = 0
+        self.batches = 0
+        self.batch_windows = 0  # windows run by the model (cache hits excluded)
+        self.model_seconds = 0.
+        self.latencies = collections.deque(maxlen = window)
+        self.queue_waits = collections.deque(maxlen = window)
+
+    def add_request(self, latency, queue_wait, num_windows):
+        with self.lock:
+            self.requests += 1
+            self.windows += num_windows
+            self.latencies.append(latency)
+            self.queue_waits.append(queue_wait)
+
+    def add_error(self):
+        with self.lock:
+            self.errors += 1
+
+    def add_batch(self, seconds, num_windows):
+        with self.lock:
+            self.batches += 1
+            self.batch_windows += num_windows
+            self.model_seconds += seconds
+
+    def snapshot(self):
+        with self.lock:
+            uptime = time.time() - self.start_time
+            latencies = np.asarray(self.latencies) * 1000
+            queue_waits = np.asarray(self.queue_waits) * 1000
+            stats = {
+                "uptime_s": uptime,
+                "requests": self.requests,
+                "errors": self.errors,
+                "windows": self.windows,
+                "batches": self.batches,
+                "windows_per_batch": self.batch_windows / self.batches if self.batches > 0 else None,
+                "requests_per_s": self.requests / uptime,
+                "windows_per_s": self.windows / uptime,
+                "model_ms_per_batch": self.model_seconds * 1000 / self.batches if self.batches > 0 else None,
+            }
+        if len(latencies) > 0:
+            stats["latency_ms"] = {"mean": float(latencies.mean()), "p50": float(np.percentile(latencies, 50)),
+                                   "p95": float(np.percentile(latencies, 95)), "p99": float(np.percentile(latencies, 99)),
+                                   "max": float(latencies.max())}
+            stats["queue_wait_ms"] = {"mean": float(queue_waits.mean()), "max": float(queue_waits.max())}
+        return stats
+
+
+class _Request(object):
+
+    def __init__(self, windows, pred_length, num_samples = 1):
+        self.windows = windows
+        self.pred_length = pred_length
+        self.num_samples = num_samples
+        self.arrival = time.perf_counter()
+        self.started = None
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class ForecastService(object):
+    '''
+    Keeps the model warm and micro-batches concurrent forecast requests.
+    '''
+
+    def __init__(self, forecaster, max_wait = 0.01, max_batch = 64):
+        '''
+
+        :param max_wait: seconds the model thread waits for more requests after the first one arrives.
+        :param max_batch: windows per model call.
+        '''
+        self.forecaster = forecaster
+        self.max_wait = max_wait
+        self.max_batch = max_batch
+        self.stats = ServiceStats()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target = self._worker, daemon = True)
+        self.thread.start()
+
+    def _collect(self, first):
+        pending = [first]
+        num_windows = len(first.windows)
+        deadline = time.perf_counter() + self.max_wait
+        while num_windows < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                request = self.queue.get(timeout = timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                self.queue.put(None)  # stop after this batch
+                break
+            pending.append(request)
+            num_windows += len(request.windows)
+        return pending
+
+    def _run(self, requests, pred_length, num_samples):
+        windows = [w for request in requests for w in request.windows]
+        start = time.perf_counter()
+        for request in requests:
+            request.started = start
+        try:
+            predictions = self.forecaster.predict_windows(windows, pred_length, num_samples, use_cache = False)
+        except Exception as e:
+            for request in requests:
+                request.error = e
+                request.done.set()
+            return
+        self.stats.add_batch(time.perf_counter() - start, len(windows))
+        offset = 0
+        for request in requests:
+            request.result = predictions[..., offset:offset + len(request.windows), :, :, :]
+            offset += len(request.windows)
+            request.done.set()
+
+    def _worker(self):
+        while True:
+            first = self.queue.get()
+            if first is None:
+                break
+            groups = collections.OrderedDict()
+            for request in self._collect(first):
+                groups.setdefault((request.pred_length, request.num_samples), []).append(request)
+            for (pred_length, num_samples), requests in groups.items():
+                self._run(requests, pred_length, num_samples)
+
+    def predict_windows(self, windows, pred_length = None, num_samples = 1):
+        '''
+        Queue preprocessed windows (Forecaster.preprocess_window outputs) and wait for their batch.
+
+        :return: cumulative predictions [K,N,pred_length,D_out], [S,K,N,pred_length,D_out] for num_samples > 1
+        '''
+        forecaster = self.forecaster
+        if pred_length is None:
+            pred_length = forecaster.args.pred_length
+        if forecaster.cache is None:
+            request = self._submit(windows, pred_length, num_samples)
+            self.stats.add_request(time.perf_counter() - request.arrival, request.started - request.arrival, len(windows))
+            return request.result
+
+        arrival = time.perf_counter()
+        keys, predictions = forecaster.lookup(windows, pred_length, num_samples)
+        missing = [i for i, prediction in enumerate(predictions) if prediction is None]
+        queue_wait = 0.
+        if len(missing) > 0:
+            request = self._submit([windows[i] for i in missing], pred_length, num_samples)
+            queue_wait = request.started - request.arrival
+            forecaster.store([keys[i] for i in missing], request.result, num_samples)
+            for j, i in enumerate(missing):
+                predictions[i] = request.result[j] if num_samples == 1 else request.result[:, j]
+        self.stats.add_request(time.perf_counter() - arrival, queue_wait, len(windows))
+        return stack_windows(predictions, num_samples)
+
+    def _submit(self, windows, pred_length, num_samples):
+        request = _Request(windows, pred_length, num_samples)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request
+
+    def forecast(self, payload):
+        '''
+        Answer one JSON request.
+
+        :param payload: {"start_dates": [...]} or {"windows": [{"features": raw [N,T1+1,D], "graphs": raw [T1+1,N,N]}]},
+            optional "pred_length", "num_samples" (z0 draws) and "quantiles".
+        :return: JSON-serializable dict with predictions [K,N,pred_length,D_out], the sample mean for num_samples > 1,
+            then with "quantiles" {"q0.05": [K,N,pred_length,D_out], ...}
+        '''
+        forecaster = self.forecaster
+        pred_length = payload.get("pred_length", forecaster.args.pred_length)
+        if not isinstance(pred_length, int) or pred_length < 1:
+            raise ValueError("pred_length must be a positive integer")
+        num_samples = payload.get("num_samples", 1)
+        if not isinstance(num_samples, int) or num_samples < 1:
+            raise ValueError("num_samples must be a positive integer")
+        quantiles = [float(q) for q in payload.get("quantiles", DEFAULT_QUANTILES)]
+        if any(q < 0 or q > 1 for q in quantiles):
+            raise ValueError("quantiles must be in [0, 1]")
+        if "start_dates" in payload:
+            start_dates = list(payload["start_dates"])
+            windows = [forecaster.conditioning_window(utils.transfer_index(d)) for d in start_dates]
+        elif "windows" in payload:
+            start_dates = None
+            windows = [forecaster.preprocess_window(w["features"], w["graphs"]) for w in payload["windows"]]
+        else:
+            raise ValueError("Request needs 'start_dates' or 'windows'")
+        if len(windows) == 0:
+            raise ValueError("Empty request")
+
+        predictions = self.predict_windows(windows, pred_length, num_samples)
+        quantile_values = None
+        if num_samples > 1:
+            predictions, quantile_values = summarize_samples(predictions, quantiles)
+        response = {"states": forecaster.state_names, "features": forecaster.feature_out, "pred_length": pred_length,
+                    "predictions": predictions.tolist()}
+        if quantile_values is not None:
+            response["num_samples"] = num_samples
+            response["quantiles"] = {quantile_column(q): values.tolist() for q, values in zip(quantiles, quantile_values)}
+        if start_dates is not None:
+            response["start_dates"] = start_dates
+            response["dates"] = [[utils.transfer_date(utils.transfer_index(d) + t) for t in range(pred_length)]
+                                 for d in start_dates]
+        return response
+
+    def snapshot(self):
+        '''
+        Service counters, with the forecast cache counters when there is a cache.
+        '''
+        stats = self.stats.snapshot()
+        if self.forecaster.cache is not None:
+            stats["cache"] = self.forecaster.cache.snapshot()
+        return stats
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+def make_handler(service, verbose = False):
+
+    class ForecastHandler(BaseHTTPRequestHandler):
+
+        def _send(self, code, body):
+            data = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self._send(200, service.snapshot())
+            elif self.path == "/health":
+                self._send(200, {"status": "ok"})
+            else:
+                self._send(404, {"error": "unknown path " + self.path})
+
+        def do_POST(self):
+            if self.path != "/forecast":
+                self._send(404, {"error": "unknown path " + self.path})
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                payload = json.loads(self.rfile.read(length))
+                response = service.forecast(payload)
+            except (ValueError, KeyError, TypeError) as e:
+                service.stats.add_error()
+                self._send(400, {"error": str(e)})
+                return
+            except Exception as e:
+                service.stats.add_error()
+                self._send(500, {"error": repr(e)})
+                return
+            self._send(200, response)
+
+        def log_message(self, format, *args):
+            if verbose:
+                BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    return ForecastHandler
+
+
+def make_server(service, host = "127.0.0.1", port = 8000, verbose = False):
+    '''
+    :return: ThreadingHTTPServer, call serve_forever() (port 0 picks a free port, see server_address).
+    '''
+    server = ThreadingHTTPServer((host, port), make_handler(service, verbose))
+    server.daemon_threads = True
+    return server
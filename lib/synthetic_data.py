@@ -0,0 +1,211 @@
+'''
+Synthetic datasets in the layouts read by lib/load_data_covid.py and lib/load_data_social.py,
+for scaling experiments at arbitrary numbers of nodes and time steps.
+
+Covid layout (datapath/):
+    feature_dict.txt, state_info.npy (population [N])
+    <dataset>/train.npy, test.npy [N,T,7]: Confirmed, Deaths, Recovered (-1 = not reported), Active,
+        Incident_Rate, Mortality_Rate, Testing_Rate
+    <dataset>/graph_train.npy, graph_test.npy [T,N,N]: daily mobility flows, self-flows on the diagonal
+    <dataset>/test_point.csv: tab separated Start_date, End_date, Pred_Length (day 0 is 2020-04-12)
+Social layout (datapath/<dataset>/):
+    locations.npy [T,N,2], graphs.npy [T-1,N,N] (0/1), popularity.npy [N]
+'''
+import os
+import math
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+
+
+FEATURE_DICT = {'Confirmed': 0, 'Deaths': 1, 'Recovered': 2, 'Active': 3, 'Incident_Rate': 4, 'Mortality_Rate': 5,
+                'Testing_Rate': 6, 'Population': 7, 'Mobility': 8}
+
+# Day 0 of the covid datasets, see utils.transfer_index
+START_DATE = datetime(2020, 4, 12)
+
+
+def _date(index):
+    return (START_DATE + timedelta(days = int(index))).strftime("%Y-%m-%d")
+
+
+def generate_covid_features(populations, num_days, rng, num_waves = 3, missing_recovered = 0.2):
+    '''
+    Cumulative case counts from a sum of epidemic waves per state, with weekly reporting cycles
+    and Poisson noise. Deaths and recoveries follow confirmed cases with a delay.
+
+    :param populations: [N]
+    :return: [N,T,7] float64
+    '''
+    num_states = len(populations)
+    days = np.arange(num_days)
+
+    # Daily incidence per capita: Gaussian-shaped waves with state specific timing and size
+    incidence = np.zeros((num_states, num_days))
+    for _ in range(num_waves):
+        peak = rng.uniform(0, num_days * 1.2, size = (num_states, 1))
+        width = rng.uniform(num_days * 0.05, num_days * 0.2, size = (num_states, 1))
+        height = rng.lognormal(math.log(2e-4), 0.5, size = (num_states, 1))
+        incidence += height * np.exp(-0.5 * ((days - peak) / width) ** 2)
+    weekly = 1 + 0.25 * np.cos(2 * math.pi * (days + rng.integers(0, 7, size = (num_states, 1))) / 7)
+    expected = np.maximum(incidence * weekly * populations[:, None], 0) + 1
+    new_confirmed = rng.poisson(expected)
+    new_confirmed[:, 0] += rng.poisson(populations * 1e-4)  # cases before day 0
+    confirmed = np.cumsum(new_confirmed, axis = 1)
+
+    # Deaths / recoveries: delayed fractions of the new cases
+    fatality = rng.uniform(0.008, 0.025, size = (num_states, 1))
+    new_deaths = rng.binomial(np.roll(new_confirmed, 14, axis = 1), fatality)
+    new_deaths[:, :14] = rng.binomial(new_confirmed[:, :14], fatality)
+    deaths = np.cumsum(new_deaths, axis = 1)
+    recovery = rng.uniform(0.85, 0.97, size = (num_states, 1))
+    new_recovered = rng.binomial(np.roll(new_confirmed, 21, axis = 1), recovery)
+    new_recovered[:, :21] = 0
+    recovered = np.cumsum(new_recovered, axis = 1).astype(np.float64)
+    recovered = np.minimum(recovered, confirmed - deaths)
+    active = confirmed - deaths - recovered
+    unreported = rng.random(num_states) < missing_recovered
+    recovered[unreported] = -1
+
+    # Tests: a growing multiple of the cases
+    new_tests = new_confirmed * rng.uniform(8, 15, size = (num_states, 1)) + populations[:, None] * 5e-4
+    tests = np.cumsum(new_tests, axis = 1)
+
+    features = np.zeros((num_states, num_days, 7))
+    features[:, :, 0] = confirmed
+    features[:, :, 1] = deaths
+    features[:, :, 2] = recovered
+    features[:, :, 3] = active
+    features[:, :, 4] = confirmed / populations[:, None] * 1e5
+    features[:, :, 5] = deaths / np.maximum(confirmed, 1) * 100
+    features[:, :, 6] = tests / populations[:, None] * 1e5
+    return features
+
+
+def mobility_flows(populations, rng, density = 0.3):
+    '''
+    Mean daily flows of a gravity model between states placed on a plane.
+
+    :param density: fraction of non-zero off-diagonal flows.
+    :return: [N,N], self-flows on the diagonal
+    '''
+    num_states = len(populations)
+    positions = rng.uniform(0, 1, size = (num_states, 2))
+    distance = np.sqrt(((positions[:, None, :] - positions[None, :, :]) ** 2).sum(-1)) + 0.05
+    base = np.sqrt(populations[:, None] * populations[None, :]) / distance ** 2  # [N,N]
+
+    # Keep the strongest links (with some randomness) up to the requested density
+    off_diagonal = ~np.eye(num_states, dtype = bool)
+    num_links = int(round(density * num_states * (num_states - 1)))
+    score = np.where(off_diagonal, np.log(base) + rng.gumbel(size = base.shape), -np.inf).ravel()
+    mask = np.zeros(num_states * num_states, dtype = bool)
+    if num_links > 0:
+        mask[np.argpartition(-score, num_links - 1)[:num_links]] = True
+    mask = mask.reshape(num_states, num_states)
+
+    flows = np.where(mask, base, 0)
+    flows = flows / flows.sum(1, keepdims = True).clip(min = 1e-12) * populations[:, None] * 0.02  # 2% leave per day
+    flows[np.diag_indices(num_states)] = populations * rng.uniform(0.002, 0.01, size = num_states)
+    return flows
+
+
+def generate_mobility(flows, out, rng, first_day = 0):
+    '''
+    Fill out [T,N,N] (e.g. a memmap) day by day with flows under a weekly cycle and noise.
+    '''
+    num_states = flows.shape[0]
+    for t in range(out.shape[0]):
+        weekly = 1 - 0.3 * ((first_day + t) % 7 >= 5)
+        noise = rng.lognormal(0, 0.1, size = (num_states, num_states))
+        out[t] = np.round(flows * weekly * noise)
+    return out
+
+
+def generate_test_points(num_train_days, num_days, pred_lengths = (7, 14, 21), stride = 7):
+    '''
+    Test windows starting in the test period.
+    :return: DataFrame with Start_date, End_date, Pred_Length
+    '''
+    rows = []
+    for pred_length in pred_lengths:
+        start = num_train_days
+        while start + pred_length - 1 < num_days:
+            rows.append((_date(start), _date(start + pred_length - 1), pred_length))
+            start += stride
+    return pd.DataFrame(rows, columns = ["Start_date", "End_date", "Pred_Length"])
+
+
+def write_covid_dataset(datapath, dataset = "Dec", num_states = 50, num_train_days = 233, num_test_days = 31,
+                        density = 0.3, seed = 0, dtype = np.float64, pred_lengths = (7, 14, 21)):
+    '''
+    Write a synthetic covid dataset readable by lib.load_data_covid.ParseData(datapath, dataset).
+    Overwrites datapath/feature_dict.txt and datapath/state_info.npy.
+    Mobility graphs are written through memmaps, so large N does not need the [T,N,N] array in memory.
+
+    :param dtype: dtype of the graph files; float32 halves their size.
+    :return: directory of the dataset
+    '''
+    rng = np.random.default_rng(seed)
+    num_days = num_train_days + num_test_days
+    dataset_dir = os.path.join(datapath, dataset)
+    if not os.path.exists(dataset_dir):
+        os.makedirs(dataset_dir)
+
+    populations = np.round(rng.lognormal(math.log(4e6), 1.0, size = num_states)).clip(min = 5e4)
+    features = generate_covid_features(populations, num_days, rng)
+
+    flows = mobility_flows(populations, rng, density = density)
+    for name, first_day, length in [("graph_train.npy", 0, num_train_days), ("graph_test.npy", num_train_days, num_test_days)]:
+        graphs = np.lib.format.open_memmap(os.path.join(dataset_dir, name), mode = "w+", dtype = dtype,
+                                           shape = (length, num_states, num_states))
+        generate_mobility(flows, graphs, rng, first_day)
+        graphs.flush()
+        del graphs
+
+    np.save(os.path.join(dataset_dir, "train.npy"), features[:, :num_train_days])
+    np.save(os.path.join(dataset_dir, "test.npy"), features[:, num_train_days:])
+    generate_test_points(num_train_days, num_days, pred_lengths).to_csv(os.path.join(dataset_dir, "test_point.csv"),
+                                                                        sep = "\t", index = False)
+    np.save(os.path.join(datapath, "state_info.npy"), populations)
+    with open(os.path.join(datapath, "feature_dict.txt"), "w") as f:
+        f.write(str(FEATURE_DICT))
+
+    return dataset_dir
+
+
+def write_social_dataset(datapath, dataset = "social", num_nodes = 80, num_steps = 400, lattice = 5., velocity = 0.03,
+                         noise_sigma = 0.2, epsilon = 0.5, threshold = math.exp(-0.4), seed = 0):
+    '''
+    Write a synthetic social dataset readable by lib.load_data_social.ParseData, with the dynamics of
+    data/social/generate_socialNetwork.py: nodes move towards the mean direction of their neighbors,
+    and i, j are linked when exp(-d_ij^2 / (b_i b_j epsilon^2)) > threshold.
+
+    :return: directory of the dataset
+    '''
+    rng = np.random.default_rng(seed)
+    dataset_dir = os.path.join(datapath, dataset)
+    if not os.path.exists(dataset_dir):
+        os.makedirs(dataset_dir)
+
+    locations = np.zeros((num_steps, num_nodes, 2))
+    locations[0] = rng.uniform(-lattice / 2, lattice / 2, size = (num_nodes, 2))
+    popularity = rng.uniform(1, 2, size = num_nodes)
+    thetas = rng.uniform(0, 2 * math.pi, size = num_nodes)
+    b_matrix = popularity[:, None] * popularity[None, :]
+
+    graphs = np.lib.format.open_memmap(os.path.join(dataset_dir, "graphs.npy"), mode = "w+", dtype = np.int64,
+                                       shape = (num_steps - 1, num_nodes, num_nodes))
+    for t in range(1, num_steps):
+        diff = ((locations[t - 1][None, :, :] - locations[t - 1][:, None, :]) ** 2).sum(-1)
+        graph = (np.exp(-diff / b_matrix / epsilon / epsilon) > threshold).astype(np.int64)  # self-loops included
+        graphs[t - 1] = graph
+        thetas = rng.normal(graph.dot(thetas) / graph.sum(1), noise_sigma)
+        locations[t, :, 0] = locations[t - 1, :, 0] + velocity * np.cos(thetas)
+        locations[t, :, 1] = locations[t - 1, :, 1] + velocity * np.sin(thetas)
+    graphs.flush()
+    del graphs
+
+    np.save(os.path.join(dataset_dir, "locations.npy"), locations)
+    np.save(os.path.join(dataset_dir, "popularity.npy"), popularity)
+
+    return dataset_dir
@@ -1,11 +1,12 @@
 import os
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
 import torch
 import torch.nn as nn
 import numpy as np
 from tqdm import tqdm
 import scipy.sparse as sp
+import lib.checkpoint as checkpoint
 
 
 
@@ -17,6 +18,10 @@ def transfer_index(date_string):
     interval = d1-init_date
     return interval.days
 
+def transfer_date(index):
+    # inverse of transfer_index
+    return (datetime(2020,4,12) + timedelta(days=int(index))).strftime("%Y-%m-%d")
+
 def print_parameters(model):
 	for name, param in model.named_parameters():
 		if param.requires_grad:
@@ -93,6 +98,12 @@ def sample_standard_gaussian(mu, sigma):
 	r = d.sample(mu.size()).squeeze(-1)
 	return r * sigma.float() + mu.float()
 
+def autocast(device, enabled):
+	'''
+	bfloat16 autocast on the device type of device, a no-op when not enabled.
+	'''
+	return torch.autocast(device_type = torch.device(device).type, dtype = torch.bfloat16, enabled = enabled)
+
 def get_dict_template():
 	return {"data": None,
 			"time_setps": None,
@@ -135,7 +146,7 @@ def get_ckpt_model(ckpt_path, model, device):
 	if not os.path.exists(ckpt_path):
 		raise Exception("Checkpoint " + ckpt_path + " does not exist.")
 	# Load checkpoint.
-	checkpt = torch.load(ckpt_path)
+	checkpt = checkpoint.load_file(ckpt_path)
 	ckpt_args = checkpt['args']
 	state_dict = checkpt['state_dict']
 	model_dict = model.state_dict()
@@ -212,79 +223,149 @@ def inc_to_cum(pred_inc):
 	return pred_cum.to(pred_inc.device)
 
 
-def test_data_covid(model, pred_length, condition_length, dataloader,device,args,kl_coef):
+class MetricsAccumulator(object):
+	'''
+	Running sums of per-batch metrics kept on the model's device.
+	Values are only copied to the host once, in summary().
+	'''
+
+	def __init__(self, device, keys, keep_each = ()):
+		'''
+
+		:param keys: metric names to average over batches.
+		:param keep_each: metric names whose per-batch values are kept (e.g. per test point).
+		'''
+		self.device = device
+		self.keys = list(keys)
+		self.keep_each = list(keep_each)
+		self.sums = torch.zeros(len(self.keys), dtype = torch.float64, device = device)
+		self.each = {key: [] for key in self.keep_each}
+		self.count = 0
+
+	def update(self, results):
+		values = []
+		for key in self.keys:
+			var = results.get(key, 0.)
+			if isinstance(var, torch.Tensor):
+				values.append(var.detach().reshape(()).double().to(self.device))
+			else:
+				values.append(torch.tensor(float(var), dtype = torch.float64, device = self.device))
+		self.sums += torch.stack(values)
+
+		for key in self.keep_each:
+			self.each[key].append(results[key].detach().reshape(()).double())
+
+		self.count += 1
+
+	def all_reduce(self):
+		'''
+		Sum the running sums and batch counts over all ranks of the process group.
+		'''
+		if not torch.distributed.is_initialized():
+			return
+		reduced = torch.cat([self.sums, torch.tensor([float(self.count)], dtype = torch.float64, device = self.device)])
+		torch.distributed.all_reduce(reduced)
+		self.sums = reduced[:-1]
+		self.count = int(reduced[-1].item())
+
+	def summary(self):
+		'''
+
+		:return: dict of means, dict of per-batch value lists. One device-to-host transfer.
+		'''
+		flat = [self.sums / max(self.count, 1)]
+		for key in self.keep_each:
+			flat.append(torch.stack(self.each[key]) if len(self.each[key]) > 0 else torch.zeros(0, dtype = torch.float64, device = self.device))
+		flat = torch.cat(flat).cpu().tolist()
+
+		means = {key: flat[i] for i, key in enumerate(self.keys)}
+		each = {}
+		offset = len(self.keys)
+		for key in self.keep_each:
+			each[key] = flat[offset:offset + len(self.each[key])]
+			offset += len(self.each[key])
+
+		return means, each
+
+
+def test_data_covid(model, pred_length, condition_length, dataloader,device,args,kl_coef,metrics_only=False):
 
 
 	encoder, decoder, graph, num_batch = dataloader.load_test_data(pred_length=pred_length,
 	 															   condition_length=condition_length)
 
+	total, MAPE_each, RMSE_each = evaluate_test_batches(model, encoder, decoder, graph, num_batch, device, args, kl_coef,
+														metrics_only=metrics_only)
 
-	total = {}
-	total["loss"] = 0
-	total["likelihood"] = 0
-	total["MAPE"] = 0
-	total["RMSE"] = 0
-	total["MSE"] = 0
-	total["kl_first_p"] = 0
-	total["std_first_p"] = 0
-	MAPE_each = []
-	RMSE_each = []
+	return total,print_MAPE(MAPE_each),print_MAPE(RMSE_each)
 
-	n_test_batches = 0
+
+def test_data_covid_horizons(model, horizons, condition_length, dataloader, device, args, start_dates=None):
+	'''
+	MAPE / RMSE of several forecast horizons from one encoder pass and one ODE solve per start date.
+
+	:param horizons: forecast days, e.g. [7,14,21].
+	:return: {horizon: {"MAPE", "RMSE", "num_points", "MAPE_each", "RMSE_each"}}, start dates
+	'''
+	encoder, decoder, start_dates, num_batch = dataloader.load_multi_horizon_test_data(horizons, condition_length,
+																					   start_dates=start_dates)
+	return evaluate_horizons(model, encoder, decoder, num_batch, horizons, device, args), start_dates
+
+
+def evaluate_horizons(model, encoder, decoder, num_batch, horizons, device, args):
+	'''
+	Solve each test point once up to its last decoder day and score every horizon h on the first h days,
+	like a test point ending h days after its start date. Horizons beyond the available days of a point are skipped.
+	RMSE is the mean over test points of sqrt(MSE) of each point.
+	'''
+	metrics = {h: MetricsAccumulator(device, ["MAPE", "RMSE"], keep_each = ["MAPE", "RMSE"]) for h in horizons}
 
 	model.eval()
-	print("Computing loss... ")
+	print("Computing multi-horizon metrics... ")
 	with torch.no_grad():
 		for _ in tqdm(range(num_batch)):
 			batch_dict_encoder = get_next_batch_new(encoder, device)
-			batch_dict_graph = get_next_batch_new(graph, device)
 			batch_dict_decoder = get_next_batch_test(decoder, device)
 
-			results = model.compute_all_losses(batch_dict_encoder, batch_dict_decoder, batch_dict_graph, args.num_atoms,
-											   edge_lamda=args.edge_lamda, kl_coef=kl_coef, istest=True)
-
-			for key in total.keys():
-				if key in results:
-					var = results[key]
-					if isinstance(var, torch.Tensor):
-						var = var.detach().item()
-					if key =="MAPE":
-						MAPE_each.append(var)
-					elif key == "MSE": # assign value for both MSE and RMSE
-						RMSE_each.append(np.sqrt(var))
-						total["RMSE"] += np.sqrt(var)
-					total[key] += var
-
-			n_test_batches += 1
-
-			del batch_dict_encoder, batch_dict_graph, batch_dict_decoder, results
-
-		if n_test_batches > 0:
-			for key, value in total.items():
-				total[key] = total[key] / n_test_batches
+			pred_node, _, _, _ = model.get_reconstruction(batch_dict_encoder, batch_dict_decoder, args.num_atoms,
+														  time_index=batch_dict_decoder["masks"], decode_edge=False)  # [N,T2,D]
+			truth = batch_dict_decoder["data"]
+			truth_gt = batch_dict_decoder["data_gt"]
+			for h in horizons:
+				if h > truth.shape[1]:
+					continue
+				mape = model.get_loss(truth[:, :h], pred_node[:, :h], truth_gt=truth_gt[:, :h], method='MAPE', istest=True)
+				mse = model.get_loss(truth[:, :h], pred_node[:, :h], method='MSE', istest=True)
+				metrics[h].update({"MAPE": mape, "RMSE": torch.sqrt(mse.double())})
 
+			del batch_dict_encoder, batch_dict_decoder, pred_node
 
+	results = {}
+	for h in horizons:
+		total, each = metrics[h].summary()
+		results[h] = {"MAPE": total["MAPE"], "RMSE": total["RMSE"], "num_points": metrics[h].count,
+					  "MAPE_each": each["MAPE"], "RMSE_each": each["RMSE"]}
+	return results
 
 
-	return total,print_MAPE(MAPE_each),print_MAPE(RMSE_each)
-
-
-def test_data_social(model, pred_length, condition_length, dataloader, device, args, kl_coef):
+def test_data_social(model, pred_length, condition_length, dataloader, device, args, kl_coef, metrics_only=False):
 	encoder, decoder, graph, num_batch = dataloader.load_test_data(pred_length=pred_length,
 																   condition_length=condition_length)
 
-	total = {}
-	total["loss"] = 0
-	total["likelihood"] = 0
-	total["MAPE"] = 0
-	total["RMSE"] = 0
-	total["MSE"] = 0
-	total["kl_first_p"] = 0
-	total["std_first_p"] = 0
-	MAPE_each = []
-	RMSE_each = []
+	total, _, _ = evaluate_test_batches(model, encoder, decoder, graph, num_batch, device, args, kl_coef,
+										metrics_only=metrics_only)
+
+	return total
 
-	n_test_batches = 0
+
+def evaluate_test_batches(model, encoder, decoder, graph, num_batch, device, args, kl_coef, metrics_only=False):
+	'''
+	Run the test batches (one test point each) and average the metrics.
+	RMSE is the mean over test points of sqrt(MSE) of each point.
+	:return: total dict, MAPE of each test point, RMSE of each test point
+	'''
+	metrics = MetricsAccumulator(device, ["loss", "likelihood", "MAPE", "RMSE", "MSE", "kl_first_p", "std_first_p"],
+								 keep_each = ["MAPE", "RMSE"])
 
 	model.eval()
 	print("Computing loss... ")
@@ -295,26 +376,13 @@ def test_data_social(model, pred_length, condition_length, dataloader, device, a
 			batch_dict_decoder = get_next_batch_test(decoder, device)
 
 			results = model.compute_all_losses(batch_dict_encoder, batch_dict_decoder, batch_dict_graph, args.num_atoms,
-											   edge_lamda=args.edge_lamda, kl_coef=kl_coef, istest=True)
-
-			for key in total.keys():
-				if key in results:
-					var = results[key]
-					if isinstance(var, torch.Tensor):
-						var = var.detach().item()
-					if key == "MAPE":
-						MAPE_each.append(var)
-					elif key == "MSE":  # assign value for both MSE and RMSE
-						RMSE_each.append(np.sqrt(var))
-						total["RMSE"] += np.sqrt(var)
-					total[key] += var
-
-			n_test_batches += 1
+											   edge_lamda=args.edge_lamda, kl_coef=kl_coef, istest=True,
+											   metrics_only=metrics_only)
+			results["RMSE"] = torch.sqrt(results["MSE"].double())
+			metrics.update(results)
 
 			del batch_dict_encoder, batch_dict_graph, batch_dict_decoder, results
 
-		if n_test_batches > 0:
-			for key, value in total.items():
-				total[key] = total[key] / n_test_batches
+	total, each = metrics.summary()
 
-	return total
\ No newline at end of file
+	return total, each["MAPE"], each["RMSE"]
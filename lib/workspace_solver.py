@@ -0,0 +1,202 @@
+'''
+Fixed-step coupled ODE solves without per-stage allocations, for solves that need no gradients.
+
+CoupledODEWorkspace holds buffers for one (K, N, D) shape: the solver stages, the edge MLP
+activations, the edge values / degrees and the node update. The right-hand side of
+CoupledODEFunc (Edge_NRI + normalize_graph + Node_GCN) is evaluated with out= and in-place ops
+into these buffers, with the parameters read from the modules at every call. Edge features are
+never materialized as [K,N*N,2D] sender / receiver pairs: the first edge layer is split into its
+sender and receiver halves, applied per node and broadcast over the N x N pairs.
+
+Dynamically quantized linears (--quantize) are run as packed modules and copied into their buffers.
+
+Only the output trajectory [T,K*N + K*N*N,D] is allocated per solve, so callers may keep it.
+Dropout is not applied (eval mode only).
+'''
+import torch
+import torch.nn as nn
+
+
+FIXED_STEP_SOLVERS = ["euler", "midpoint", "rk4"]
+LAYER_NORM_EPS = 1e-5  # nn.LayerNorm default, as in Edge_NRI and Node_GCN
+
+
+def _layer_norm_(x, out, scale):
+    '''
+    LayerNorm over the last dimension without affine parameters, written to out.
+
+    :param scale: [rows,1] buffer for the statistics.
+    '''
+    torch.mean(x, dim = -1, keepdim = True, out = scale)
+    torch.sub(x, scale, out = out)
+    torch.linalg.vector_norm(out, dim = -1, keepdim = True, out = scale)
+    scale.pow_(2).div_(x.shape[-1]).add_(LAYER_NORM_EPS).rsqrt_()
+    out.mul_(scale)
+    return out
+
+
+def _is_quantized(linear):
+    return isinstance(linear, torch.ao.nn.quantized.dynamic.Linear)
+
+
+def supports(ode_func):
+    '''
+    The in-place right-hand side needs float or dynamically quantized (lib/quantization.py) linears in the edge function.
+    '''
+    edge_net = ode_func.edge_ode_func_net
+    linears = [edge_net.w_node2edge, edge_net.edge_self_evolve[0], edge_net.edge_self_evolve[2],
+               edge_net.w_edge2value[0], edge_net.w_edge2value[2]]
+    return all(type(linear) is nn.Linear or _is_quantized(linear) for linear in linears)
+
+
+def _linear(x, linear, out):
+    if _is_quantized(linear):
+        # Packed int8 weights: run the module (activations quantized per call), then copy into the buffer.
+        return out.copy_(linear(x))
+    return torch.addmm(linear.bias, x, linear.weight.t(), out = out)
+
+
+def _weight_and_bias(linear):
+    '''
+    Float weight and bias, dequantized for int8 linears.
+    '''
+    if _is_quantized(linear):
+        return linear.weight().dequantize(), linear.bias()
+    return linear.weight, linear.bias
+
+
+class CoupledODEWorkspace(object):
+    '''
+    Preallocated buffers and in-place right-hand side of a CoupledODEFunc for one batch shape.
+    '''
+
+    def __init__(self, ode_func, K, num_atoms, dim, method, dtype = torch.float32, device = torch.device("cpu")):
+        if method not in FIXED_STEP_SOLVERS:
+            raise ValueError("Workspace solves need a fixed-step method (%s), got %s" % (", ".join(FIXED_STEP_SOLVERS), method))
+        self.ode_func = ode_func
+        self.K = K
+        self.N = num_atoms
+        self.D = dim
+        self.method = method
+        self.K_N = K * num_atoms
+        self.inference_mode = torch.is_inference_mode_enabled()  # inference tensors can only be updated in inference mode
+        M = self.K_N * num_atoms  # edges
+        edge_net = ode_func.edge_ode_func_net
+        hidden_self = edge_net.edge_self_evolve[0].out_features
+        hidden_value = edge_net.w_edge2value[0].out_features
+
+        def empty(*shape):
+            return torch.empty(shape, dtype = dtype, device = device)
+
+        self.shape = (self.K_N + M, dim)
+        num_stages = {"euler": 1, "midpoint": 2, "rk4": 4}[method]
+        self.stages = [empty(*self.shape) for _ in range(num_stages)]  # k1..k4
+        self.stage_input = empty(*self.shape)
+        # Edge function
+        self.node_send = empty(self.K_N, dim)  # per node projections of the sender / receiver halves of w_node2edge
+        self.node_receive = empty(self.K_N, dim)
+        self.edge_from_node = empty(K, num_atoms, num_atoms, dim)
+        self.edge_norm = empty(M, dim)
+        self.edge_scale = empty(M, 1)
+        self.edge_hidden_self = empty(M, hidden_self)
+        self.edge_hidden_value = empty(M, hidden_value)
+        self.edge_value = empty(M, 1)
+        self.degree = empty(self.K_N, 1)
+        # Node function
+        self.node_norm = empty(self.K_N, dim)
+        self.node_scale = empty(self.K_N, 1)
+        self.node_transform = empty(self.K_N, dim)
+        self.node_hidden = empty(K, num_atoms, dim)
+
+    def matches(self, K, num_atoms, dim, method, dtype, device):
+        return (self.K, self.N, self.D, self.method, self.stages[0].dtype, self.stages[0].device, self.inference_mode) == \
+               (K, num_atoms, dim, method, dtype, device, torch.is_inference_mode_enabled())
+
+    def rhs(self, z, out, node_z0):
+        '''
+        CoupledODEFunc.forward in eval mode, written to out.
+
+        :param z: [K*N + K*N*N,D]
+        :param out: [K*N + K*N*N,D] buffer, must not alias z.
+        '''
+        self.ode_func.nfe += 1
+        K, N, D, K_N = self.K, self.N, self.D, self.K_N
+        edge_net = self.ode_func.edge_ode_func_net
+        node_net = self.ode_func.node_ode_func_net
+        nodes = z[:K_N]
+        edges = z[K_N:]
+        grad_node = out[:K_N]
+        grad_edge = out[K_N:]
+
+        # Edge_NRI: gelu(W [h_i || h_j] + b) = gelu(W_send h_i + W_receive h_j + b)
+        # An int8 w_node2edge is split on its dequantized weights, its activations stay float.
+        weight, bias = _weight_and_bias(edge_net.w_node2edge)  # [D,2D]
+        torch.mm(nodes, weight[:, :D].t(), out = self.node_send)
+        torch.addmm(bias, nodes, weight[:, D:].t(), out = self.node_receive)
+        torch.add(self.node_send.view(K, N, 1, D), self.node_receive.view(K, 1, N, D), out = self.edge_from_node)
+        torch.ops.aten.gelu_(self.edge_from_node)
+
+        self_evolve = edge_net.edge_self_evolve
+        _layer_norm_(edges, self.edge_norm, self.edge_scale)
+        _linear(self.edge_norm, self_evolve[0], self.edge_hidden_self).relu_()
+        _linear(self.edge_hidden_self, self_evolve[2], grad_edge)
+        grad_edge.add_(self.edge_from_node.view(-1, D))  # edges_z [K*N*N,D]
+
+        to_value = edge_net.w_edge2value
+        _linear(grad_edge, to_value[0], self.edge_hidden_value).relu_()
+        _linear(self.edge_hidden_value, to_value[2], self.edge_value).relu_()
+
+        # normalize_graph: row i of the [K*N,N] edge values holds the edges leaving node i
+        edge_value = self.edge_value.view(K_N, N)
+        torch.sum(edge_value, dim = 1, keepdim = True, out = self.degree)
+        self.degree.reciprocal_()
+        torch.nan_to_num_(self.degree, posinf = 0.)
+        edge_value.mul_(self.degree)
+
+        # Node_GCN: gelu(A LN(h) W) - LN(h) + z0
+        _layer_norm_(nodes, self.node_norm, self.node_scale)
+        torch.mm(self.node_norm, node_net.w_node, out = self.node_transform)
+        torch.bmm(edge_value.view(K, N, N), self.node_transform.view(K, N, D), out = self.node_hidden)
+        torch.ops.aten.gelu_(self.node_hidden)
+        torch.sub(self.node_hidden.view(K_N, D), self.node_norm, out = grad_node)
+        grad_node.add_(node_z0)
+        return out
+
+    def solve(self, y0, time_steps, node_z0):
+        '''
+        torchdiffeq's fixed grid solvers: one step per interval of time_steps, rk4 is the 3/8 rule.
+
+        :param y0: [K*N + K*N*N,D]
+        :return: [T,K*N + K*N*N,D]
+        '''
+        solution = torch.empty((time_steps.shape[0],) + self.shape, dtype = y0.dtype, device = y0.device)
+        solution[0].copy_(y0)
+        times = time_steps.tolist()
+        stage_input = self.stage_input
+        for i in range(len(times) - 1):
+            dt = times[i + 1] - times[i]
+            y, y_next = solution[i], solution[i + 1]
+            k1 = self.rhs(y, self.stages[0], node_z0)
+            if self.method == "euler":
+                torch.add(y, k1, alpha = dt, out = y_next)
+            elif self.method == "midpoint":
+                torch.add(y, k1, alpha = 0.5 * dt, out = stage_input)
+                k2 = self.rhs(stage_input, self.stages[1], node_z0)
+                torch.add(y, k2, alpha = dt, out = y_next)
+            else:
+                k2, k3, k4 = self.stages[1:]
+                torch.add(y, k1, alpha = dt / 3., out = stage_input)
+                self.rhs(stage_input, k2, node_z0)
+                # y + dt (k2 - k1 / 3)
+                torch.add(y, k2, alpha = dt, out = stage_input)
+                stage_input.add_(k1, alpha = -dt / 3.)
+                self.rhs(stage_input, k3, node_z0)
+                # y + dt (k1 - k2 + k3)
+                torch.add(y, k1, alpha = dt, out = stage_input)
+                stage_input.add_(k2, alpha = -dt).add_(k3, alpha = dt)
+                self.rhs(stage_input, k4, node_z0)
+                # y + dt (k1 + 3 (k2 + k3) + k4) / 8
+                k2.add_(k3)
+                torch.add(y, k1, alpha = 0.125 * dt, out = y_next)
+                y_next.add_(k2, alpha = 0.375 * dt).add_(k4, alpha = 0.125 * dt)
+        return solution
@@ -0,0 +1,104 @@
+import sys
+import json
+import argparse
+import lib.planner as planner
+
+
+# Defaults of run_models_covid.py / run_models_social.py
+FORMAT_DEFAULTS = {
+    "covid": dict(dataset='Dec', pred_length=14, condition_length=21, split_interval=3, ode_dims=20, solver='rk4',
+                  feature_out='Deaths'),
+    "social": dict(dataset='social', pred_length=10, condition_length=20, split_interval=5, ode_dims=30,
+                   solver='euler', feature_out=None),
+}
+
+parser = argparse.ArgumentParser('CG-ODE planner: memory / time estimates before launching a run. Takes the arguments of the run_models scripts.')
+parser.add_argument('--format', type=str, default='covid', choices=['covid', 'social'], help="covid (run_models_covid.py) or social (run_models_social.py)")
+parser.add_argument('--dataset', type=str, default=None)
+parser.add_argument('--datapath', type=str, default='data/', help="default data path")
+parser.add_argument('--pred_length', type=int, default=None)
+parser.add_argument('--condition_length', type=int, default=None)
+parser.add_argument('--features', type=str,
+                    default="Confirmed,Deaths,Recovered,Mortality_Rate,Testing_Rate,Population,Mobility",
+                    help="selected features")
+parser.add_argument('--split_interval', type=int, default=None)
+parser.add_argument('--feature_out', type=str, default=None)
+parser.add_argument('--training_end_time', type=int, default=320)
+parser.add_argument('--add_popularity', type=bool, default=True)
+parser.add_argument('-b', '--batch-size', type=int, default=8)
+parser.add_argument('-r', '--random-seed', type=int, default=1991, help="Random_seed")
+parser.add_argument('--dropout', type=float, default=0.2)
+parser.add_argument('--edge_lamda', type=float, default=0.5)
+parser.add_argument('--z0-encoder', type=str, default='GTrans')
+parser.add_argument('--rec-dims', type=int, default=64)
+parser.add_argument('--ode-dims', type=int, default=None)
+parser.add_argument('--rec-layers', type=int, default=1)
+parser.add_argument('--gen-layers', type=int, default=1)
+parser.add_argument('--augment_dim', type=int, default=0)
+parser.add_argument('--solver', type=str, default=None)
+
+parser.add_argument('--grad_mode', type=str, default='adjoint', choices=['adjoint', 'direct'], help="adjoint (what DiffeqSolver uses) or direct backpropagation through the solver")
+parser.add_argument('--memory_budget', type=float, default=None, help="memory budget in GB; suggests the largest batch size that fits")
+parser.add_argument('--probe_batch_sizes', type=str, default='1,4', help="comma separated batch sizes measured by the probe, empty for analytic estimates only")
+parser.add_argument('--probe_steps', type=int, default=5, help="measured training steps per probe")
+parser.add_argument('--threads', type=int, default=None, help="torch CPU threads of the probe")
+parser.add_argument('--output', type=str, default=None, help="optional JSON report")
+# Other arguments of the run_models scripts are accepted and ignored.
+args, _ = parser.parse_known_args()
+
+for key, value in FORMAT_DEFAULTS[args.format].items():
+    if getattr(args, key) is None:
+        setattr(args, key, value)
+if args.format == "social":
+    args.output_dim = 2
+    args.feature_out_index = [0, 1]
+elif args.feature_out == "Confirmed":
+    args.output_dim = 1
+    args.feature_out_index = [0]
+elif args.feature_out == "Deaths":
+    args.output_dim = 1
+    args.feature_out_index = [1]
+else:
+    args.output_dim = 2
+    args.feature_out_index = [0, 1]
+
+
+def gb(num_bytes):
+    return "%.3f GB" % (num_bytes / 1024. ** 3)
+
+
+if __name__ == '__main__':
+    loader_module = "lib.load_data_covid" if args.format == "covid" else "lib.load_data_social"
+    probe_batch_sizes = [int(k) for k in args.probe_batch_sizes.split(",") if k != ""]
+    budget = args.memory_budget * 1024 ** 3 if args.memory_budget is not None else None
+    report = planner.plan(args, loader_module, grad_mode=args.grad_mode, budget_bytes=budget,
+                          probe_batch_sizes=probe_batch_sizes, probe_steps=args.probe_steps, num_threads=args.threads)
+
+    shapes = report["dataset"]
+    est = report["estimate"]
+    print("Dataset: N=%d, T=%d, %d training windows, %d encoder edges per window" % (
+        shapes["N"], shapes["T"], shapes["num_windows"], shapes["encoder_edges"]))
+    print("Batch K=%d, D=%d, T1=%d, T2=%d, gradient mode %s" % (est["K"], est["D"], est["T1"], est["T2"], args.grad_mode))
+    print("ODE state (K*N + K*N*N)*D: %d elements (%s)" % (est["state_elems"], gb(est["state_bytes"])))
+    print("Encoder graph: %d nodes, %d edges" % (est["encoder_nodes"], est["encoder_edges"]))
+    print("Forward NFE: %d" % est["nfe_forward"])
+    print("Activations (analytic): %s" % gb(est["activation_bytes"]))
+    print("Loaded data (analytic): %s, preprocessing peak (analytic): %s" % (gb(est["data_bytes"]), gb(est["preprocessing_bytes"])))
+    print("GFLOPs per training step: " + ", ".join("%s %.3f" % (k, v / 1e9) for k, v in est["flops"].items()))
+    for p in report["probes"]:
+        print("Probe K=%d: step %.4fs, peak step memory %s, NFE %.1f" % (p["K"], p["step_s"], gb(p["peak_bytes"]), p["nfe_forward"]))
+    for warning in report.get("fit_warnings", []):
+        print("Warning: " + warning)
+    if "calibrated" in report:
+        cal = report["calibrated"]
+        print("Calibrated: training memory %s (model %s, data %s, step %s), step %.4fs, epoch %s, %.2f GFLOP/s, memory factor %s" % (
+            gb(cal["train_bytes"]), gb(cal["model_bytes"]), gb(cal["data_bytes"]), gb(cal["step_bytes"]), cal["step_s"],
+            "-" if cal["epoch_s"] is None else "%.1fs" % cal["epoch_s"], cal["flops_per_second"] / 1e9,
+            "-" if cal["memory_factor"] is None else "%.2f" % cal["memory_factor"]))
+    if "suggested_batch_size" in report:
+        print("Largest batch size within %s: %d" % (gb(budget), report["suggested_batch_size"]))
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    sys.exit(0)
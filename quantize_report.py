@@ -0,0 +1,61 @@
+import json
+import argparse
+import torch
+from lib.forecast import Forecaster
+from lib.benchmark import time_function
+import lib.quantization as quantization
+
+
+parser = argparse.ArgumentParser('CG-ODE dynamic int8 quantization: accuracy and CPU throughput report')
+parser.add_argument('--load', type=str, required=True, help="checkpoint path")
+parser.add_argument('--datapath', type=str, default=None, help="defaults to the checkpoint's datapath")
+parser.add_argument('--dataset', type=str, default=None, help="defaults to the checkpoint's dataset")
+parser.add_argument('--batch_sizes', type=str, default='1,8,32', help="comma separated numbers of windows per forward pass for the throughput comparison")
+parser.add_argument('--repeat', type=int, default=10, help="measured forward passes per batch size")
+parser.add_argument('--threads', type=int, default=1, help="torch CPU threads")
+parser.add_argument('-r', '--random-seed', type=int, default=0, help="z0 sampling seed of both models")
+parser.add_argument('--output', type=str, default=None, help="optional JSON report")
+args = parser.parse_args()
+
+
+if __name__ == '__main__':
+    torch.set_num_threads(args.threads)
+    forecaster = Forecaster(args.load, torch.device("cpu"), datapath=args.datapath, dataset=args.dataset)
+    model = forecaster.model
+    quantized = quantization.quantize_model(model)
+    ckpt_args = forecaster.args
+    report = {"quantized_modules": quantization.quantized_module_names(model),
+              "model_bytes": {"float32": quantization.model_size(model), "int8": quantization.model_size(quantized)},
+              "solver_path": {"float32": quantization.solver_path(model), "int8": quantization.solver_path(quantized)}}
+
+    # Accuracy on the test points of test_point.csv
+    loaders = forecaster.dataloader.load_test_data(pred_length=ckpt_args.pred_length, condition_length=ckpt_args.condition_length)
+    report["accuracy"] = quantization.accuracy_report(model, quantized, loaders, ckpt_args, seed=args.random_seed)
+
+    # Throughput of batched forecasts, model call only (graph batching is shared by both)
+    first = forecaster.condition_length
+    pred_length = ckpt_args.pred_length
+    report["throughput"] = []
+    for K in [int(k) for k in args.batch_sizes.split(",")]:
+        windows = [forecaster.conditioning_window(first + i % (forecaster.num_days - first + 1)) for i in range(K)]
+        batch_en, batch_de, _ = forecaster.batch_windows(windows, pred_length)
+        row = {"K": K}
+        for name, m in [("float32", model), ("int8", quantized)]:
+            forecaster.model = m
+            stats = time_function(lambda: forecaster.run_model(batch_en, batch_de, pred_length), repeat=args.repeat, warmup=1)
+            row[name] = dict(stats, windows_per_s=K / stats["median_s"])
+        row["speedup"] = row["float32"]["median_s"] / row["int8"]["median_s"]
+        report["throughput"].append(row)
+    forecaster.model = model
+
+    acc = report["accuracy"]
+    print("Model size: float32 %.1f KB, int8 %.1f KB" % (report["model_bytes"]["float32"] / 1024., report["model_bytes"]["int8"] / 1024.))
+    print("Test MAPE %.6f -> %.6f (%+.6f), RMSE %.4f -> %.4f (%+.4f)" % (
+        acc["float32"]["MAPE"], acc["int8"]["MAPE"], acc["MAPE_delta"], acc["float32"]["RMSE"], acc["int8"]["RMSE"], acc["RMSE_delta"]))
+    print("ODE solves: float32 %s, int8 %s" % (report["solver_path"]["float32"], report["solver_path"]["int8"]))
+    for row in report["throughput"]:
+        print("K=%-4d float32 %8.1f windows/s, int8 %8.1f windows/s, speedup %.2fx" % (
+            row["K"], row["float32"]["windows_per_s"], row["int8"]["windows_per_s"], row["speedup"]))
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,58 @@
+import sys
+import json
+import argparse
+import pandas as pd
+import torch
+from lib.forecast import Forecaster, write_table
+from lib.rolling import RollingForecaster, check_rolling
+import lib.utils as utils
+
+
+parser = argparse.ArgumentParser('CG-ODE rolling daily forecasts with cached encoder state')
+parser.add_argument('--load', type=str, required=True, help="checkpoint path")
+parser.add_argument('--start_date', type=str, required=True, help="first forecast day of the first run, YYYY-MM-DD")
+parser.add_argument('--days', type=int, default=7, help="number of runs, the window moves by one day per run")
+parser.add_argument('--pred_length', type=int, default=None, help="forecast days, defaults to the checkpoint's pred_length")
+parser.add_argument('--datapath', type=str, default=None, help="defaults to the checkpoint's datapath")
+parser.add_argument('--dataset', type=str, default=None, help="defaults to the checkpoint's dataset")
+parser.add_argument('--output', type=str, default='rolling_forecast.csv', help=".csv or .parquet output file")
+parser.add_argument('--check', action='store_true', help="compare every run with a full recompute and exit with status 1 on a mismatch")
+parser.add_argument('--rtol', type=float, default=1e-4, help="relative tolerance of --check on z0 and predictions")
+parser.add_argument('--report', type=str, default=None, help="optional JSON file for the --check report")
+parser.add_argument('-r', '--random-seed', type=int, default=None, help="z0 sampling seed, defaults to the checkpoint's")
+args = parser.parse_args()
+
+
+if __name__ == '__main__':
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    forecaster = Forecaster(args.load, device, datapath=args.datapath, dataset=args.dataset, seed=args.random_seed)
+    start_index = utils.transfer_index(args.start_date)
+
+    if args.check:
+        report = check_rolling(forecaster, start_index, args.days, pred_length=args.pred_length,
+                               seed=forecaster.args.random_seed, rtol=args.rtol)
+        for day in report["days"]:
+            print("%s %-11s graph %s, recomputed nodes %5.1f%%, z0 rel err %.1e / %.1e, prediction rel err %.1e, %.1f ms (full %.1f ms)" % (
+                utils.transfer_date(day["start_index"]), day["mode"], "equal" if day["graph_equal"] else "DIFFERENT",
+                100 * day["recomputed_node_fraction"], day["z0_mean_rel_error"], day["z0_std_rel_error"], day["prediction_rel_error"],
+                1000 * day["rolling_s"], 1000 * day["full_s"]))
+        if "speedup" in report:
+            print("Incremental runs: median %.1f ms vs %.1f ms full, speedup %.2fx" % (
+                1000 * report["incremental_median_s"], 1000 * report["full_median_s"], report["speedup"]))
+        print("Rolling forecasts %s the full recompute" % ("match" if report["passed"] else "DO NOT match"))
+        if args.report is not None:
+            with open(args.report, "w") as f:
+                json.dump(report, f, indent=2)
+        sys.exit(0 if report["passed"] else 1)
+
+    torch.manual_seed(forecaster.args.random_seed)
+    rolling = RollingForecaster(forecaster, args.pred_length)
+    frames = []
+    for i in range(args.days):
+        start_date = utils.transfer_date(start_index + i)
+        prediction = rolling.forecast(start_index + i)
+        frames.append(forecaster.to_frame([start_date], prediction[None]))
+    df = pd.concat(frames, ignore_index=True)
+    write_table(df, args.output)
+    print("%d forecasts (%d runs x %d states) written to %s, encoder nodes recomputed: %d of %d" % (
+        len(df), args.days, forecaster.num_states, args.output, rolling.stats["recomputed_nodes"], rolling.stats["nodes"]))
@@ -8,9 +8,16 @@ from random import SystemRandom
 import torch
 import torch.optim as optim
 import lib.utils as utils
+import lib.distributed as distributed
+import lib.instrumentation as instrumentation
+import lib.profiling as profiling
+import lib.memory as memory
+from lib.checkpoint import CheckpointManager, BestMetrics
+from lib.async_eval import AsyncEvaluator
+from lib.multi_seed import SeedTrainer
 from torch.distributions.normal import Normal
 from lib.create_coupled_ode_model import create_CoupledODE_model
-from lib.utils import test_data_covid
+from lib.utils import test_data_covid, test_data_covid_horizons
 
 
 parser = argparse.ArgumentParser('Coupled ODE')
@@ -21,6 +28,7 @@ parser.add_argument('--dataset', type=str, default='Dec', help="Dec")
 parser.add_argument('--datapath', type=str, default='data/', help="default data path")
 parser.add_argument('--pred_length', type=int, default=14, help="Number of days to predict ")
 parser.add_argument('--condition_length', type=int, default=21, help="Number days to condition on")
+parser.add_argument('--horizons', type=str, default=None, help="comma separated forecast days (e.g. 7,14,21) evaluated together on the --load model, one ODE solve per test start date")
 parser.add_argument('--features', type=str,
                     default="Confirmed,Deaths,Recovered,Mortality_Rate,Testing_Rate,Population,Mobility",
                     help="selected features")
@@ -33,6 +41,7 @@ parser.add_argument('--niters', type=int, default=100)
 parser.add_argument('--lr', type=float, default=5e-3, help="Starting learning rate.")
 parser.add_argument('-b', '--batch-size', type=int, default=8)
 parser.add_argument('-r', '--random-seed', type=int, default=1991, help="Random_seed")
+parser.add_argument('--seeds', type=str, default=None, help="comma separated random seeds trained together in this process on the same batches, one set of checkpoints per seed. -r still sets the batch order. Gradients by direct backpropagation through the solver, not the adjoint method")
 parser.add_argument('--dropout', type=float, default=0.2, help='Dropout rate (1 - keep probability).')
 parser.add_argument('--l2', type=float, default=1e-5, help='l2 regulazer')
 parser.add_argument('--optimizer', type=str, default="AdamW", help='Adam, AdamW')
@@ -46,9 +55,22 @@ parser.add_argument('--rec-layers', type=int, default=1, help="Number of layers
 parser.add_argument('--gen-layers', type=int, default=1, help="Number of layers  ODE func ")
 
 parser.add_argument('--augment_dim', type=int, default=0, help='augmented dimension')
+parser.add_argument('--bf16', action='store_true', help="Run the ODE function and decoders under bfloat16 autocast (CPU), solver state and loss stay float32")
+parser.add_argument('--compile', action='store_true', help="torch.compile the coupled ODE function, static shapes: compiled once per batch size and number of nodes")
 parser.add_argument('--solver', type=str, default="rk4", help='dopri5,rk4,euler')
 
 parser.add_argument('--alias', type=str, default="run")
+parser.add_argument('--resume', type=str, default=None, help="name of a full-state ckpt in --save to resume training from, or 'latest'")
+parser.add_argument('--keep_ckpts', type=int, default=3, help="Number of best-val / best-test / last checkpoints kept on disk, 0 keeps all")
+parser.add_argument('--async_test', action='store_true', help="Evaluate on the test set in a separate process while training continues")
+parser.add_argument('--test_threads', type=int, default=1, help="CPU threads of the asynchronous test process")
+parser.add_argument('--instrument', type=str, default=None, help="JSON-lines file for per-stage timing / NFE summaries of each epoch. None disables instrumentation.")
+parser.add_argument('--memory_report', type=str, default=None, help="JSON file for peak RSS / allocator high-water marks per preprocessing step and model stage, rewritten every epoch. None disables it.")
+parser.add_argument('--profile', type=str, default=None, help="Directory for a torch.profiler capture of a few training steps (Chrome trace + operator table); the script exits afterwards")
+parser.add_argument('--profile_warmup', type=int, default=2, help="Training steps run before the profiler starts recording")
+parser.add_argument('--profile_steps', type=int, default=5, help="Training steps recorded by the profiler")
+parser.add_argument('--nprocs', type=int, default=1, help="Number of local data-parallel CPU workers (gloo)")
+parser.add_argument('--master_port', type=int, default=29500, help="Port used by the data-parallel workers")
 args = parser.parse_args()
 
 
@@ -75,6 +97,18 @@ else:
 #####################################################################################################
 
 if __name__ == '__main__':
+    # Data parallel: the launcher re-runs this script as --nprocs workers.
+    if args.nprocs > 1 and not distributed.is_worker():
+        sys.exit(distributed.launch_workers(args.nprocs, args.master_port))
+    if args.seeds is not None and (args.nprocs > 1 or args.load is not None or args.resume is not None or args.async_test or args.profile is not None):
+        parser.error("--seeds does not support --nprocs, --load, --resume, --async_test or --profile")
+    distributed.init_distributed(args)
+    is_main = distributed.is_main_process(args)
+    if args.instrument is not None and is_main:
+        instrumentation.enable(args.instrument)
+    if args.memory_report is not None and is_main:
+        memory.enable(args.memory_report)
+
     torch.manual_seed(args.random_seed)
     np.random.seed(args.random_seed)
 
@@ -95,8 +129,10 @@ if __name__ == '__main__':
     #Loading Data
     print("predicting data at: %s" % args.dataset)
     dataloader = ParseData(args = args)
+    memory.track_methods(dataloader)
     train_encoder, train_decoder, train_graph, train_batch, num_atoms = dataloader.load_train_data(is_train = True)
-    val_encoder, val_decoder, val_graph, val_batch, _ = dataloader.load_train_data(is_train = False)
+    if is_main:
+        val_encoder, val_decoder, val_graph, val_batch, _ = dataloader.load_train_data(is_train=False)
     args.num_atoms = num_atoms
     input_dim = dataloader.num_features
 
@@ -105,71 +141,119 @@ if __name__ == '__main__':
     obsrv_std = 0.01
     obsrv_std = torch.Tensor([obsrv_std]).to(device)
     z0_prior = Normal(torch.Tensor([0.0]).to(device), torch.Tensor([1.]).to(device))
-    model = create_CoupledODE_model(args, input_dim, z0_prior, obsrv_std, device)
+    # --seeds builds one model per seed (lib/multi_seed.py)
+    if args.seeds is None:
+        model = create_CoupledODE_model(args, input_dim, z0_prior, obsrv_std, device)
+
+        # Load checkpoint for saved model
+        if args.load is not None:
+            ckpt_path = os.path.join(args.save, args.load)
+            utils.get_ckpt_model(ckpt_path, model, device)
+            print("loaded saved ckpt!")
+            #exit()
+        if args.compile:
+            model.diffeq_solver.ode_func.compile_rhs()
 
-    # Load checkpoint for saved model
-    if args.load is not None:
-        ckpt_path = os.path.join(args.save, args.load)
-        utils.get_ckpt_model(ckpt_path, model, device)
-        print("loaded saved ckpt!")
-        #exit()
+        # Same initial weights on every rank; different dropout / z0 samples per rank.
+        distributed.broadcast_parameters(model)
+        if distributed.get_world_size(args) > 1:
+            torch.manual_seed(args.random_seed + args.rank)
 
 
     # Training Setup
     log_path = "logs/" + args.alias +"_" + args.dataset +  "_Con_"  + str(args.condition_length) +  "_Pre_" + str(args.pred_length) + "_" + str(experimentID) + ".log"
     if not os.path.exists("logs/"):
         utils.makedirs("logs/")
-    logger = utils.get_logger(logpath=log_path, filepath=os.path.abspath(__file__))
+    logger = utils.get_logger(logpath=log_path, filepath=os.path.abspath(__file__), displaying=is_main, saving=is_main)
     logger.info(input_command)
     logger.info(str(args))
     logger.info(args.alias)
 
-    # Optimizer
-    if args.optimizer == "AdamW":
-        optimizer =optim.AdamW(model.parameters(),lr=args.lr,weight_decay=args.l2)
-    elif args.optimizer == "Adam":
-        optimizer = optim.Adam(model.parameters(), lr=args.lr, weight_decay=args.l2)
-    scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, 1000, eta_min=1e-9)
+    if args.seeds is None:
+        # Optimizer
+        if args.optimizer == "AdamW":
+            optimizer =optim.AdamW(model.parameters(),lr=args.lr,weight_decay=args.l2)
+        elif args.optimizer == "Adam":
+            optimizer = optim.Adam(model.parameters(), lr=args.lr, weight_decay=args.l2)
+        scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, 1000, eta_min=1e-9)
 
 
     wait_until_kl_inc = 10
-    best_test_MAPE = np.inf
-    best_test_RMSE = np.inf
-    best_val_MAPE = np.inf
-    best_val_RMSE = np.inf
+    best = BestMetrics()
     n_iters_to_viz = 1
 
+    # Checkpoints: full training state, written on a background thread
+    start_epoch = 1
+    if args.resume is not None:
+        if args.resume == "latest":
+            resume_path = CheckpointManager.latest(args.save)
+            if resume_path is None:
+                raise Exception("--resume latest: no *_last_*.ckpt checkpoint in " + args.save)
+        else:
+            resume_path = os.path.join(args.save, args.resume)
+        # RNG streams are per rank: only restored for single-process runs.
+        checkpt = CheckpointManager.load(resume_path, model, optimizer, scheduler, device,
+                                         restore_rng=distributed.get_world_size(args) == 1)
+        start_epoch = checkpt["epoch"] + 1
+        best.load_state_dict(checkpt["extra"])
+        if distributed.get_world_size(args) > 1:
+            torch.manual_seed(args.random_seed + args.rank + start_epoch)
+        # Same experiment: checkpoint names continue and --keep_ckpts also prunes the interrupted run's files.
+        experimentID = checkpt["extra"].get("experimentID", experimentID)
+        logger.info("Resumed from " + resume_path + " at epoch " + str(start_epoch))
+    ckpt_manager = CheckpointManager(args.save, keep_n=args.keep_ckpts,
+                                     manifest="experiment_" + str(experimentID) + "_" + args.dataset + "_" + args.alias + "_checkpoints.json")
+
+    def training_extra(replica=None):
+        if replica is None:
+            return dict(best.state_dict(), experimentID=experimentID)
+        return dict(replica.best.state_dict(), experimentID=experimentID, seed=replica.seed)
+
+    def training_state(epo, replica=None):
+        '''
+        Snapshot of the model, or of a --seeds replica.
+        '''
+        if replica is None:
+            return ckpt_manager.snapshot(model, optimizer, scheduler, epoch=epo, args=args, extra=training_extra(),
+                                         transform=dataloader.transform.state_dict())
+        return ckpt_manager.snapshot(replica.model, replica.optimizer, replica.scheduler, epoch=epo, args=replica.args,
+                                     extra=training_extra(replica), transform=dataloader.transform.state_dict())
+
+    def last_ckpt_name(epo, alias):
+        return "experiment_" + str(experimentID) + "_" + args.dataset + "_" + alias + "_last_epoch_" + str(epo) + ".ckpt"
+
 
     def train_single_batch(model,batch_dict_encoder,batch_dict_decoder,batch_dict_graph,kl_coef):
 
+        instrumentation.begin_batch()
         optimizer.zero_grad()
         train_res = model.compute_all_losses(batch_dict_encoder, batch_dict_decoder, batch_dict_graph,args.num_atoms,edge_lamda = args.edge_lamda, kl_coef=kl_coef,istest=False)
 
         loss = train_res["loss"]
-        loss.backward()
-        torch.nn.utils.clip_grad_norm_(model.parameters(), args.clip)
+        with instrumentation.stage("backward"):
+            loss.backward()
+        with instrumentation.stage("allreduce"):
+            distributed.all_reduce_gradients(model)
+        with instrumentation.stage("optimizer"):
+            torch.nn.utils.clip_grad_norm_(model.parameters(), args.clip)
 
-        optimizer.step()
+            optimizer.step()
+        instrumentation.end_batch()
 
-        loss_value = loss.data.item()
+        train_res["loss"] = loss.detach()
 
         del loss
         torch.cuda.empty_cache()
         # train_res, loss
-        return loss_value,train_res["MAPE"],train_res['MSE'],train_res["likelihood"],train_res["kl_first_p"],train_res["std_first_p"]
+        return train_res
 
     def train_epoch(epo):
         model.train()
-        loss_list = []
-        MAPE_list = []
-        MSE_list = []
-        likelihood_list = []
-        kl_first_p_list = []
-        std_first_p_list = []
+        metrics = utils.MetricsAccumulator(device, ["loss", "MAPE", "MSE", "likelihood", "kl_first_p", "std_first_p"])
 
         torch.cuda.empty_cache()
 
-        for itr in tqdm(range(train_batch)):
+        for itr in tqdm(range(train_batch), disable=not is_main):
 
             #utils.update_learning_rate(optimizer, decay_rate=0.999, lowest=args.lr / 10)
             wait_until_kl_inc = 1000
@@ -183,12 +267,10 @@ if __name__ == '__main__':
             batch_dict_graph = utils.get_next_batch_new(train_graph, device)
             batch_dict_decoder = utils.get_next_batch(train_decoder, device)
 
-            loss, MAPE,MSE,likelihood,kl_first_p,std_first_p = train_single_batch(model,batch_dict_encoder,batch_dict_decoder,batch_dict_graph,kl_coef)
+            train_res = train_single_batch(model,batch_dict_encoder,batch_dict_decoder,batch_dict_graph,kl_coef)
 
             #saving results
-            loss_list.append(loss), MAPE_list.append(MAPE), MSE_list.append(MSE),likelihood_list.append(
-               likelihood)
-            kl_first_p_list.append(kl_first_p), std_first_p_list.append(std_first_p)
+            metrics.update(train_res)
 
             del batch_dict_encoder, batch_dict_graph, batch_dict_decoder
                 #train_res, loss
@@ -196,17 +278,22 @@ if __name__ == '__main__':
 
         scheduler.step()
 
-        message_train = 'Epoch {:04d} [Train seq (cond on sampled tp)] | Loss {:.6f} | MAPE {:.6F} | RMSE {:.6F} | Likelihood {:.6f} | KL fp {:.4f} | FP STD {:.4f}|'.format(
-            epo,
-            np.mean(loss_list), np.mean(MAPE_list),np.sqrt(np.mean(MSE_list)), np.mean(likelihood_list),
-            np.mean(kl_first_p_list), np.mean(std_first_p_list))
+        # Single host sync per epoch (averaged over all ranks)
+        metrics.all_reduce()
+        train_avg, _ = metrics.summary()
+        instrumentation.write_epoch(epo)
+
+        return train_message(epo, train_avg),kl_coef
 
-        return message_train,kl_coef
+    def train_message(epo, train_avg):
+        return 'Epoch {:04d} [Train seq (cond on sampled tp)] | Loss {:.6f} | MAPE {:.6F} | RMSE {:.6F} | Likelihood {:.6f} | KL fp {:.4f} | FP STD {:.4f}|'.format(
+            epo,
+            train_avg["loss"], train_avg["MAPE"],np.sqrt(train_avg["MSE"]), train_avg["likelihood"],
+            train_avg["kl_first_p"], train_avg["std_first_p"])
 
-    def val_epoch(epo,kl_coef):
+    def val_epoch(epo,kl_coef,model):
         model.eval()
-        MAPE_list = []
-        MSE_list = []
+        metrics = utils.MetricsAccumulator(device, ["MAPE", "MSE"])
 
 
         torch.cuda.empty_cache()
@@ -220,20 +307,21 @@ if __name__ == '__main__':
                                                  args.num_atoms, edge_lamda=args.edge_lamda, kl_coef=kl_coef,
                                                  istest=False)
 
-            MAPE_list.append(val_res['MAPE']), MSE_list.append(val_res['MSE'])
+            metrics.update(val_res)
             del batch_dict_encoder, batch_dict_graph, batch_dict_decoder
             # train_res, loss
             torch.cuda.empty_cache()
 
 
+        val_avg, _ = metrics.summary()
         message_val = 'Epoch {:04d} [Val seq (cond on sampled tp)] |  MAPE {:.6F} | RMSE {:.6F} |'.format(
             epo,
-            np.mean(MAPE_list), np.sqrt(np.mean(MSE_list)))
+            val_avg["MAPE"], np.sqrt(val_avg["MSE"]))
 
-        return message_val, np.mean(MAPE_list),np.sqrt(np.mean(MSE_list))
+        return message_val, val_avg["MAPE"], np.sqrt(val_avg["MSE"])
 
     # Test once: for loaded model
-    if args.load is not None:
+    if args.load is not None and is_main:
         test_res, MAPE_each, RMSE_each = test_data_covid(model, args.pred_length, args.condition_length, dataloader,
                                                    device=device, args=args, kl_coef=0)
 
@@ -247,82 +335,160 @@ if __name__ == '__main__':
         logger.info(MAPE_each)
         logger.info(RMSE_each)
 
-    # Training and Testing
-    for epo in range(1, args.niters + 1):
-
-        message_train, kl_coef = train_epoch(epo)
-        message_val, MAPE_val, RMSE_val = val_epoch(epo,kl_coef)
-
-        if epo % n_iters_to_viz == 0:
-            # Logging Train and Val
-            logger.info("Experiment " + str(experimentID))
-            logger.info(message_train)
-            logger.info(message_val)
-
+        if args.horizons is not None:
+            horizons = sorted(int(h) for h in args.horizons.split(","))
+            horizon_res, start_dates = test_data_covid_horizons(model, horizons, args.condition_length, dataloader,
+                                                                device=device, args=args)
+            logger.info("Multi-horizon test on %d start dates: %s" % (len(start_dates), ",".join(start_dates)))
+            for h in horizons:
+                res = horizon_res[h]
+                logger.info('Horizon {:3d} days [Test seq] | MAPE {:.6F} | RMSE {:.6F} | points {:d}|'.format(
+                    h, res["MAPE"], res["RMSE"], res["num_points"]))
+
+    def report_test(epo, test_res, MAPE_each, RMSE_each, MAPE_val, RMSE_val, state, replica=None):
+        '''
+        Log the test result of epoch epo, update the best metrics and save best checkpoints
+        from state, the snapshot taken when epo was evaluated.
+        :param replica: SeedReplica of --seeds, None for the model
+        '''
+        run_best, alias, label, kind_suffix = (best, args.alias, "", "") if replica is None else \
+            (replica.best, replica.args.alias, replica.label, replica.kind_suffix)
+        ckpt_saves = []
+
+        message_test = label + 'Epoch {:04d} [Test seq (cond on sampled tp)] | MAPE {:.6F} | RMSE {:.6F}|'.format(
+            epo,
+            test_res["MAPE"], test_res["RMSE"])
 
-            # Testing
-            model.eval()
-            test_res,MAPE_each,RMSE_each = test_data_covid(model, args.pred_length, args.condition_length, dataloader,
-                                 device=device, args = args, kl_coef=kl_coef)
-            message_test = 'Epoch {:04d} [Test seq (cond on sampled tp)] | MAPE {:.6F} | RMSE {:.6F}|'.format(
-                epo,
-                test_res["MAPE"], test_res["RMSE"])
-
-
-            if MAPE_val < best_val_MAPE:
-                best_val_MAPE = MAPE_val
-                best_val_RMSE = RMSE_val
-                logger.info("Best Val!")
-                ckpt_path = os.path.join(args.save, "experiment_" + str(
-                    experimentID) + "_" + args.dataset + "_" + args.alias + "_" + str(
-                    args.condition_length) + "_" + str(
-                    args.pred_length) + "_epoch_" + str(epo) + "_mape_" + str(
-                    test_res["MAPE"]) + '.ckpt')
-                torch.save({
-                    'args': args,
-                    'state_dict': model.state_dict(),
-                }, ckpt_path)
-
-
-
-            logger.info(message_test)
-            logger.info(MAPE_each)
-            logger.info(RMSE_each)
 
+        if run_best.update_val(MAPE_val, RMSE_val):
+            logger.info(label + "Best Val!")
+            ckpt_name = ("experiment_" + str(
+                experimentID) + "_" + args.dataset + "_" + alias + "_" + str(
+                args.condition_length) + "_" + str(
+                args.pred_length) + "_epoch_" + str(epo) + "_mape_" + str(
+                test_res["MAPE"]) + '.ckpt')
+            ckpt_saves.append(("best_val", ckpt_name))
 
-            if test_res["MAPE"] < best_test_MAPE:
-                best_test_MAPE = test_res["MAPE"]
-                best_test_RMSE = test_res["RMSE"]
-                message_best = 'Epoch {:04d} [Test seq (cond on sampled tp)] | Best Test MAPE {:.6f}|Best Test RMSE {:.6f}|'.format(epo,
-                                                                                                        best_test_MAPE,best_test_RMSE)
-                logger.info(MAPE_each)
-                logger.info(RMSE_each)
-                logger.info(message_best)
-                ckpt_path = os.path.join(args.save, "experiment_" + str(
-                    experimentID) +  "_" + args.dataset + "_" + args.alias+ "_" + str(
-                    args.condition_length) + "_" + str(
-                    args.pred_length) + "_epoch_" + str(epo) + "_mape_" + str(
-                    best_test_MAPE) + '.ckpt')
-                torch.save({
-                    'args': args,
-                    'state_dict': model.state_dict(),
-                }, ckpt_path)
 
 
-            torch.cuda.empty_cache()
-            
+        logger.info(message_test)
+        logger.info(MAPE_each)
+        logger.info(RMSE_each)
 
 
+        if run_best.update_test(test_res["MAPE"], test_res["RMSE"]):
+            message_best = label + 'Epoch {:04d} [Test seq (cond on sampled tp)] | Best Test MAPE {:.6f}|Best Test RMSE {:.6f}|'.format(epo,
+                                                                                                    run_best.test_MAPE,run_best.test_RMSE)
+            logger.info(MAPE_each)
+            logger.info(RMSE_each)
+            logger.info(message_best)
+            ckpt_name = ("experiment_" + str(
+                experimentID) +  "_" + args.dataset + "_" + alias+ "_" + str(
+                args.condition_length) + "_" + str(
+                args.pred_length) + "_epoch_" + str(epo) + "_mape_" + str(
+                run_best.test_MAPE) + '.ckpt')
+            ckpt_saves.append(("best_test", ckpt_name))
+
+        # Weights of the evaluated epoch, bookkeeping as of now.
+        state = dict(state, extra=training_extra(replica))
+        for kind, ckpt_name in ckpt_saves:
+            ckpt_manager.save(state, ckpt_name, kind=kind + kind_suffix)
+
+    # Several seeds on shared batches (lib/multi_seed.py), then the validation, test and checkpoints above per seed.
+    if args.seeds is not None:
+        trainer = SeedTrainer([int(s) for s in args.seeds.split(",")], args, input_dim, z0_prior, obsrv_std, device)
+        logger.info(trainer.describe())
+        for epo in range(1, args.niters + 1):
+            train_avgs, kl_coef = trainer.train_epoch(train_encoder, train_decoder, train_graph, train_batch)
+            test_encoder, test_decoder, test_graph, test_batch = dataloader.load_test_data(pred_length=args.pred_length,
+                                                                                           condition_length=args.condition_length)
+            logger.info("Experiment " + str(experimentID))
+            for replica, train_avg in zip(trainer.replicas, train_avgs):
+                with replica.rng():
+                    message_val, MAPE_val, RMSE_val = val_epoch(epo, kl_coef, replica.model)
+                    test_res, MAPE_each, RMSE_each = utils.evaluate_test_batches(replica.model, test_encoder, test_decoder, test_graph,
+                                                                                 test_batch, device, args, kl_coef, metrics_only=True)
+                logger.info(replica.label + train_message(epo, train_avg))
+                logger.info(replica.label + message_val)
+                state = training_state(epo, replica)
+                report_test(epo, test_res, utils.print_MAPE(MAPE_each), utils.print_MAPE(RMSE_each), MAPE_val, RMSE_val, state, replica)
+                ckpt_manager.save(state, last_ckpt_name(epo, replica.args.alias), kind="last" + replica.kind_suffix)
+        for replica in trainer.replicas:
+            logger.info(replica.label + 'Best Val MAPE {:.6f} | Best Test MAPE {:.6f} | Best Test RMSE {:.6f}|'.format(
+                replica.best.val_MAPE, replica.best.test_MAPE, replica.best.test_RMSE))
+        ckpt_manager.close()
+        sys.exit(0)
+
+    # Profiling: capture a few training steps, then exit.
+    if args.profile is not None:
+        profiling.annotate_model(model)
+        model.train()
 
+        def profile_step(itr):
+            batch_dict_encoder = utils.get_next_batch_new(train_encoder, device)
+            batch_dict_graph = utils.get_next_batch_new(train_graph, device)
+            batch_dict_decoder = utils.get_next_batch(train_decoder, device)
+            train_single_batch(model, batch_dict_encoder, batch_dict_decoder, batch_dict_graph, kl_coef=1)
+
+        prefix = args.dataset + "_" + args.alias + "_rank_" + str(args.rank)
+        trace_path, table_path = profiling.profile_steps(profile_step, args.profile_warmup, args.profile_steps,
+                                                         args.profile, prefix)
+        logger.info("Profiler trace: " + trace_path)
+        logger.info("Operator table: " + table_path)
+        ckpt_manager.close()
+        distributed.cleanup()
+        sys.exit(0)
+
+    # Asynchronous testing: a separate process evaluates weight snapshots while training continues.
+    evaluator = None
+    if args.async_test and is_main:
+        evaluator = AsyncEvaluator(args, input_dim, "lib.load_data_covid", num_threads=args.test_threads)
 
+    # Training and Testing
+    for epo in range(start_epoch, args.niters + 1):
 
+        message_train, kl_coef = train_epoch(epo)
+        distributed.assert_parameters_synced(model)
+        # Validation, testing, logging and checkpointing only happen on rank 0.
+        if not is_main:
+            continue
+        message_val, MAPE_val, RMSE_val = val_epoch(epo,kl_coef,model)
 
+        if epo % n_iters_to_viz == 0:
+            # Logging Train and Val
+            logger.info("Experiment " + str(experimentID))
+            logger.info(message_train)
+            logger.info(message_val)
 
 
+            # Testing
+            state = training_state(epo)
+            if evaluator is not None:
+                finished = evaluator.submit(epo, state["state_dict"], kl_coef, payload=(MAPE_val, RMSE_val, state))
+                finished += evaluator.poll()
+            else:
+                model.eval()
+                test_res,MAPE_each,RMSE_each = test_data_covid(model, args.pred_length, args.condition_length, dataloader,
+                                     device=device, args = args, kl_coef=kl_coef, metrics_only=True)
+                finished = [(epo, (test_res, MAPE_each, RMSE_each), (MAPE_val, RMSE_val, state))]
 
+            for test_epo, (test_res, MAPE_each, RMSE_each), (test_MAPE_val, test_RMSE_val, test_state) in finished:
+                report_test(test_epo, test_res, MAPE_each, RMSE_each, test_MAPE_val, test_RMSE_val, test_state)
 
 
+            torch.cuda.empty_cache()
 
+        # Latest state for resuming, serialized in the background.
+        ckpt_manager.save(training_state(epo), last_ckpt_name(epo, args.alias), kind="last")
+        memory.write_report({"dataset": args.dataset, "num_atoms": args.num_atoms, "batch_size": args.batch_size,
+                             "condition_length": args.condition_length, "pred_length": args.pred_length,
+                             "device": str(device), "epoch": epo})
 
+    if evaluator is not None:
+        for test_epo, (test_res, MAPE_each, RMSE_each), (test_MAPE_val, test_RMSE_val, test_state) in evaluator.drain():
+            report_test(test_epo, test_res, MAPE_each, RMSE_each, test_MAPE_val, test_RMSE_val, test_state)
+        evaluator.close()
 
+    ckpt_manager.close()
 
+    distributed.cleanup()
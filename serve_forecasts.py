@@ -0,0 +1,93 @@
+import sys
+import json
+import threading
+import argparse
+import urllib.request
+import torch
+from lib.forecast import Forecaster
+from lib.serving import ForecastService, make_server
+from lib.forecast_cache import ForecastCache
+import lib.utils as utils
+
+
+parser = argparse.ArgumentParser('CG-ODE local forecast service')
+parser.add_argument('--load', type=str, required=True, help="checkpoint path")
+parser.add_argument('--datapath', type=str, default=None, help="defaults to the checkpoint's datapath")
+parser.add_argument('--dataset', type=str, default=None, help="defaults to the checkpoint's dataset")
+parser.add_argument('--host', type=str, default='127.0.0.1', help="bind address, localhost only by default")
+parser.add_argument('--port', type=int, default=8000)
+parser.add_argument('--max_wait_ms', type=float, default=10, help="latency window for coalescing concurrent requests")
+parser.add_argument('--max_batch', type=int, default=64, help="maximum windows per encoder + ODE call")
+parser.add_argument('--quantize', action='store_true', help="dynamic int8 quantization of the linear layers (CPU)")
+parser.add_argument('--cache_mb', type=float, default=256, help="memory budget of the forecast cache (LRU), 0 disables caching")
+parser.add_argument('--cache_dir', type=str, default=None, help="optional on-disk forecast cache tier")
+parser.add_argument('--threads', type=int, default=None, help="torch CPU threads")
+parser.add_argument('--verbose', action='store_true', help="log every request")
+parser.add_argument('--smoke_test', type=int, default=0, help="start on a free localhost port, send this many concurrent requests, print /stats and exit")
+args = parser.parse_args()
+
+
+def post(url, payload):
+    request = urllib.request.Request(url, data=json.dumps(payload).encode(), headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def smoke_test(server, forecaster, num_requests):
+    url = "http://127.0.0.1:%d" % server.server_address[1]
+    # Every valid start date of the dataset, one per request.
+    first = forecaster.condition_length
+    start_dates = [utils.transfer_date(first + i % (forecaster.num_days - first + 1)) for i in range(num_requests)]
+    responses = [None] * num_requests
+
+    def send(i):
+        responses[i] = post(url + "/forecast", {"start_dates": [start_dates[i]]})
+
+    threads = [threading.Thread(target=send, args=(i,)) for i in range(num_requests)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    failed = [i for i, r in enumerate(responses) if r is None]
+
+    # Raw conditioning window of the same layout as train.npy / graph_train.npy
+    features, graphs = forecaster.raw_days(0, first + 1)
+    response = post(url + "/forecast", {"windows": [{"features": features.tolist(), "graphs": graphs.tolist()}]})
+    if len(response["predictions"]) != 1:
+        failed.append("windows")
+
+    with urllib.request.urlopen(url + "/stats") as response:
+        stats = json.loads(response.read())
+    print(json.dumps(stats, indent=2))
+    if len(failed) > 0:
+        print("%d request(s) failed" % len(failed))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    device = torch.device("cuda:0" if torch.cuda.is_available() and not args.quantize else "cpu")
+    cache = None
+    if args.cache_mb > 0 or args.cache_dir is not None:
+        cache = ForecastCache(max_bytes=int(args.cache_mb * 1024 * 1024), directory=args.cache_dir)
+    forecaster = Forecaster(args.load, device, datapath=args.datapath, dataset=args.dataset, quantize=args.quantize, cache=cache)
+    service = ForecastService(forecaster, max_wait=args.max_wait_ms / 1000., max_batch=args.max_batch)
+
+    if args.smoke_test > 0:
+        server = make_server(service, "127.0.0.1", 0, args.verbose)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        status = smoke_test(server, forecaster, args.smoke_test)
+        server.shutdown()
+        service.close()
+        sys.exit(status)
+
+    server = make_server(service, args.host, args.port, args.verbose)
+    print("Serving forecasts on http://%s:%d (POST /forecast, GET /stats, GET /health)" % server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    service.close()